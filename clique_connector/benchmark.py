@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from rx.concurrency import AsyncIOScheduler
+from time import perf_counter
+
+from .connector import Connector
+from .memory import MemoryTransport
+from .retry import RetryPolicy
+from .stats import percentile
+
+
+async def run(requests=100, concurrency=10, agents=1, host=None,
+              prefetch=1, consume=True, interval=None, retries=0):
+    """Drives provided number of machine requests, at most concurrency
+    at a time, against agents waiting for machines and measures the
+    whole handshake of each request, retried up to retries times.
+    Runs against an in-process broker unless a RabbitMQ host is
+    provided, in which case broker counters aren't available.
+    Returns the results as a dict.
+    """
+
+    scheduler = AsyncIOScheduler()
+    options = dict(consume=consume)
+    transport = None
+
+    if host is None:
+        transport = MemoryTransport()
+        options['transport'] = transport
+
+    def connector():
+        connector = Connector(host or '127.0.0.1', **options)
+
+        if interval is not None:
+            connector.messenger.LISTENER_INTERVAL = interval
+
+        return connector
+
+    async def confirm(**kwargs):
+        return True
+
+    async def create(name, **kwargs):
+        return dict(host=name, username='root')
+
+    workers = [connector() for _ in range(agents)]
+    subscriptions = []
+
+    for worker in workers:
+        stop, observable = worker.wait_for_machines(confirm, create,
+                                                    scheduler, prefetch)
+        subscriptions.append((stop, observable.subscribe(
+            on_error=lambda e: logging.error('Agent failed: %s', e))))
+
+    requester = connector()
+    await requester.start()
+
+    retry = RetryPolicy(retries=retries, timeout=Connector.MACHINE_TIMEOUT)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def request(index):
+        nonlocal failures
+
+        async with semaphore:
+            started = perf_counter()
+
+            try:
+                await requester.request_machine(
+                    'benchmark-%d' % index, 'alpine', 1, 512, 128,
+                    'public-key', retry=retry)
+            except Exception as error:
+                logging.warning('Request failed: %s', error)
+                failures += 1
+                return
+
+            latencies.append(perf_counter() - started)
+
+    if transport is not None:
+        transport.broker.counters.clear()
+
+    started = perf_counter()
+    await asyncio.gather(*[request(i) for i in range(requests)])
+    elapsed = perf_counter() - started
+
+    counters = dict(transport.broker.counters) \
+        if transport is not None else None
+
+    for stop, subscription in subscriptions:
+        subscription.dispose()
+        stop()
+
+    for each in workers + [requester]:
+        each.messenger.close()
+
+    latencies.sort()
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    results = dict(
+        requests=requests,
+        concurrency=concurrency,
+        agents=agents,
+        prefetch=prefetch,
+        consume=consume,
+        retries=retries,
+        broker='memory' if transport is not None else host,
+        failures=failures,
+        seconds=round(elapsed, 3),
+        requests_per_second=round(len(latencies) / elapsed, 3)
+        if elapsed else None,
+        latency=dict(
+            p50=ms(percentile(latencies, 50)),
+            p99=ms(percentile(latencies, 99)),
+            mean=ms(sum(latencies) / len(latencies)
+                    if latencies else None),
+            max=ms(latencies[-1] if latencies else None)))
+
+    if counters is not None:
+        results['broker_counters'] = counters
+        results['round_trips_per_request'] = \
+            round(counters.get('round_trips', 0) / requests, 3)
+        results['queues_created_per_request'] = \
+            round(counters.get('queues_created', 0) / requests, 3)
+
+    return results
+
+
+def main(argv=None):
+    """Runs the handshake benchmark from the command line and prints
+    the results as JSON, like so:
+        python -m clique_connector.benchmark --requests 1000 --agents 4
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the create-machine handshake.')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='number of machine requests')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='requests in flight at a time')
+    parser.add_argument('--agents', type=int, default=1,
+                        help='number of agents waiting for machines')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='requests each agent takes on at a time')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='times each request is retried')
+    parser.add_argument('--host',
+                        help='RabbitMQ host, the in-process broker is '
+                             'used if not set')
+    parser.add_argument('--poll', action='store_true',
+                        help='poll queues instead of consuming them')
+    parser.add_argument('--interval', type=int,
+                        help='poll interval in milliseconds')
+    parser.add_argument('--output',
+                        help='write results to this file instead of '
+                             'stdout')
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(requests=args.requests,
+                                          concurrency=args.concurrency,
+                                          agents=args.agents,
+                                          host=args.host,
+                                          prefetch=args.prefetch,
+                                          consume=not args.poll,
+                                          interval=args.interval,
+                                          retries=args.retries))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
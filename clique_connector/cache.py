@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class TtlCache:
+    """A bounded cache of values which expire ttl seconds after they
+    were put. The oldest values are evicted when more than size values
+    are put.
+
+    Use like so:
+        cache = TtlCache(size=1024, ttl=600)
+
+        cache.put('key', 'value')
+        cache.get('key') # Returns 'value', or None when expired
+    """
+
+    SIZE = 1024
+    TTL = 600
+
+    def __init__(self, size=SIZE, ttl=TTL):
+        self.size = size
+        self.ttl = ttl
+        self.__values = OrderedDict()
+
+    def __len__(self):
+        self.expire()
+
+        return len(self.__values)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def expire(self):
+        """Evicts expired values.
+        """
+
+        now = monotonic()
+
+        while self.__values:
+            key, (expires, _) = next(iter(self.__values.items()))
+
+            if expires > now:
+                break
+
+            del self.__values[key]
+
+    def get(self, key):
+        """Returns the value by provided key, or None.
+        """
+
+        self.expire()
+        entry = self.__values.get(key)
+
+        return None if entry is None else entry[1]
+
+    def put(self, key, value):
+        """Puts a value by provided key, which expires in ttl seconds.
+        """
+
+        self.__values.pop(key, None)
+        self.__values[key] = (monotonic() + self.ttl, value)
+
+        while len(self.__values) > self.size:
+            self.__values.popitem(last=False)
+
+    def pop(self, key, value=None):
+        """Removes the value by provided key, but only if it's provided
+        value when given.
+        Returns the removed value or None.
+        """
+
+        entry = self.__values.get(key)
+
+        if entry is None or (value is not None and entry[1] is not value):
+            return None
+
+        del self.__values[key]
+
+        return entry[1]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from time import time
+
+
+class CapacityIndex:
+    """Keeps track of the free resources agents advertise in the status
+    exchange and picks agents capable of creating requested machines.
+
+    Agents which haven't advertised for max_age seconds are considered
+    gone. A picked agent's resources are reserved until it advertises
+    again, so that concurrent requests are spread between agents.
+
+    Use like so:
+        index = CapacityIndex()
+
+        # For each capacity status
+        index.update(agent_uuid, cpu=4, mem=8192, disc=512)
+
+        # Get an agent uuid or None
+        agent_uuid = index.pick(cpu=1, mem=512, disc=128)
+    """
+
+    MAX_AGE = 30
+
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self.__agents = {}
+
+    def __len__(self):
+        return len(self.__agents)
+
+    def __contains__(self, uuid):
+        return uuid in self.__agents
+
+    def update(self, uuid, cpu, mem, disc):
+        """Sets the free resources of an agent.
+        """
+
+        self.__agents[uuid] = (time(), dict(cpu=cpu, mem=mem, disc=disc))
+
+    def remove(self, uuid):
+        """Forgets about an agent.
+        """
+
+        self.__agents.pop(uuid, None)
+
+    def pick(self, cpu, mem, disc, exclude=()):
+        """Picks the agent with the most free memory among the ones with
+        enough free resources for the requested machine, except for
+        provided agent uuids to exclude.
+        Returns the agent's uuid or None if no agent fits.
+        """
+
+        now = time()
+        picked = None
+
+        for uuid, (updated, free) in list(self.__agents.items()):
+            if now - updated > self.max_age:
+                del self.__agents[uuid]
+                continue
+
+            if uuid in exclude or \
+                    free['cpu'] < cpu or \
+                    free['mem'] < mem or \
+                    free['disc'] < disc:
+                continue
+
+            if picked is None or free['mem'] > picked[1]['mem']:
+                picked = (uuid, free)
+
+        if picked is None:
+            return None
+
+        uuid, free = picked
+        free['cpu'] -= cpu
+        free['mem'] -= mem
+        free['disc'] -= disc
+
+        return uuid
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import json
+
+from hashlib import blake2b, md5
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class JsonCodec:
+    """Encodes and decodes message bodies as json with the standard
+    library. The default codec.
+    """
+
+    content_type = 'application/json'
+
+    def dumps(self, contents):
+        return json.dumps(contents).encode('utf8')
+
+    def loads(self, body):
+        return json.loads(body)
+
+
+class OrjsonCodec(JsonCodec):
+    """Encodes and decodes message bodies as json with orjson
+    (https://github.com/ijl/orjson). Interchangeable with JsonCodec.
+    """
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('OrjsonCodec requires orjson')
+
+    def dumps(self, contents):
+        return orjson.dumps(contents)
+
+    def loads(self, body):
+        return orjson.loads(body)
+
+
+class MsgpackCodec:
+    """Encodes and decodes message bodies with msgpack
+    (https://msgpack.org). Both ends has to be able to decode msgpack.
+    """
+
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('MsgpackCodec requires msgpack')
+
+    def dumps(self, contents):
+        return msgpack.packb(contents, use_bin_type=True)
+
+    def loads(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+
+def get_codec(content_type):
+    """Returns a codec for decoding provided content type, prefering
+    the fastest one available.
+    """
+
+    if content_type == MsgpackCodec.content_type:
+        return MsgpackCodec()
+
+    if orjson is not None:
+        return OrjsonCodec()
+
+    return JsonCodec()
+
+
+def md5_checksum(body):
+    """The default checksum, compatible with earlier versions.
+    """
+
+    return md5(body).hexdigest()
+
+
+def blake2_checksum(body):
+    """A faster checksum from the standard library.
+    """
+
+    return blake2b(body, digest_size=16).hexdigest()
+
+
+def xxhash_checksum(body):
+    """The fastest, non-cryptographic, checksum by xxhash
+    (https://github.com/ifduyue/python-xxhash).
+    """
+
+    if xxhash is None:
+        raise ImportError('xxhash_checksum requires xxhash')
+
+    return xxhash.xxh3_128_hexdigest(body)
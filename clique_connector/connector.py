@@ -6,14 +6,23 @@ Copyright (c) 2016 Olof Montin <olof@montin.net>
 This file is part of clique-connector.
 """
 
+import asyncio
 import logging
 
+from amqpstorm import AMQPError
 from functools import partial
 from rx import Observable
 from rx.concurrency import AsyncIOScheduler
+from time import perf_counter
+from uuid import uuid4
 
+from .cache import TtlCache
+from .capacity import CapacityIndex
+from .fairness import FairShare
 from .messenger import Messenger
-from .util import listener_error, filter_message
+from .retry import RetryPolicy
+from .stats import StatsStore
+from .util import listener_error, run_callback, takes_argument
 
 
 class Connector:
@@ -21,11 +30,25 @@ class Connector:
     creating the logistics of creating and responding with virtual
     machines.
 
+    Requests are timed out and retried by a retry policy, see
+    RetryPolicy. The default one retries up to MACHINE_RETRIES times,
+    waits MACHINE_TIMEOUT seconds for each response to a request and
+    CONFIRM_TIMEOUT seconds for an agent's response to be confirmed.
+    Once confirmed, the agent streams progress events while it creates
+    the machine, at least a heartbeat every PROGRESS_HEARTBEAT seconds,
+    and each one extends the wait for the machine by another respond
+    timeout.
+
+    Options are passed on to the messenger, see Messenger. Handshake
+    stage latencies, retries, timeouts and rejects are reported to the
+    messenger's metrics sink, see the metrics module.
+
     Use like so:
         connector = Connector('127.0.0.1')
 
-        # Request a virtual machine
-        machine = await connector.create_machine(
+        # Request a virtual machine, as a coroutine or an observable
+        # through create_machine
+        machine = await connector.request_machine(
             'some-random-machine', # Machine name
             'ubuntu-16.04', # Image name
             1, # CPU
@@ -49,20 +72,52 @@ class Connector:
         channel_close()
     """
 
-    def __init__(self, host):
+    MACHINE_RETRIES = 10
+    MACHINE_TIMEOUT = 5
+    CONFIRM_TIMEOUT = 1
+    STATS_INTERVAL = 10
+    STATS_PREFETCH = 100
+    STATS_BATCH_TIME = 1
+    IDEMPOTENCY_SIZE = 1024
+    IDEMPOTENCY_TTL = 600
+    LIFECYCLE_TIMEOUT = 10
+    LIFECYCLE_CONCURRENCY = 16
+    PROGRESS_HEARTBEAT = 1
+    MACHINE_REJECTED = 'machine-rejected'
+    ADVERTISE_INTERVAL = CapacityIndex.MAX_AGE // 3
+
+    def __init__(self, host, retry=None, **options):
         self.host = host
+        self.options = options
+        self.retry = retry or RetryPolicy(
+            retries=self.MACHINE_RETRIES,
+            timeout=self.MACHINE_TIMEOUT,
+            timeouts=dict(confirm=self.CONFIRM_TIMEOUT))
+        self.capacity = CapacityIndex()
+        self.stats = StatsStore()
+        self.created = TtlCache(self.IDEMPOTENCY_SIZE,
+                                self.IDEMPOTENCY_TTL)
+        self.handling = set()
         self.__messenger = None
 
     @property
     def messenger(self):
-        """Sets and returns a messenger instance
+        """Sets and returns a messenger instance, which connects when
+        first used.
         """
 
         if self.__messenger is None:
-            self.__messenger = Messenger(self.host)
+            self.__messenger = Messenger(self.host, **self.options)
 
         return self.__messenger
 
+    async def start(self):
+        """Connects the messenger and announces that it's online, see
+        Messenger.start.
+        """
+
+        return await self.messenger.start()
+
     def get_response(self, timeout, scheduler, checksum):
         """Creates a listener for a single response by provided checksum.
         The timeout sets how long the listener should wait.
@@ -77,171 +132,829 @@ class Connector:
             .first() \
             .tap(lambda m: m.ack()) \
             .tap(lambda _: stop()) \
-            .timeout(timeout) \
+            .timeout(timeout, scheduler=scheduler) \
             .catch_exception(partial(listener_error, stop))
 
-    def publish_response(self, kwargs, message):
-        """Publish a response and returns with the message checksum.
+    def publish_response(self, kwargs, message, message_type=None):
+        """Publish a response to provided message, without decoding it,
+        of provided message type if any, and returns with the response's
+        checksum.
         """
 
-        body = message.json()
-
-        return self.messenger.publish_response(body['uuid'],
-                                               body['checksum'],
+        return self.messenger.publish_response(message.uuid,
+                                               message.checksum,
+                                               message_type,
                                                **kwargs)
 
-    def create_machine(self, name, image, cpu,
-                       mem, disc, pkey, retries=0,
-                       scheduler=AsyncIOScheduler()):
-        """Creates a create-machine request and listens for a response.
-        Returns with an observable which generates a single value with
-        the virtual machine. The machine response is a dict:
+    async def request_machine(self, name, image, cpu,
+                              mem, disc, pkey, retries=0, *, key=None,
+                              retry=None, progress=None, priority=None,
+                              tenant=None):
+        """Creates a create-machine request and waits for a response.
+        Retries the whole request by provided retry policy, or the
+        connector's, counting from provided retries, if any step fails
+        or times out. The request stage waits for an agent to respond
+        and the respond stage for the machine.
+        The request goes straight to an agent with enough free resources
+        if the capacity index knows of one, see watch_capacity, and to
+        any agent otherwise. Agents already tried are not picked again,
+        except for an agent which confirmed the request, which gets the
+        retry if it listens for requests sent straight to it. An agent
+        which turns down a request sent straight to it says so, and the
+        request goes on to the next agent right away.
+        Every attempt carries the same idempotency key, a random one
+        unless provided, so that an agent which is already creating the
+        machine replays its response rather than creating another one.
+        Progress, if provided, is called with each progress event of the
+        creation as a dict with progress set to its stage: accepted when
+        the agent starts creating the machine, whatever stages the
+        agent's create callback reports and ready, with host and
+        username, when the machine has arrived. The event carries the
+        agent's uuid as well. Heartbeats only extend the deadline.
+        Priority is the request's priority in the command queue, if
+        the messenger's max_priority makes it a priority queue. Tenant
+        names who the request is for, for agents sharing their
+        capacity fairly between tenants, see wait_for_machines.
+        Returns the virtual machine as a dict:
             { 'host': '127.0.0.1',
               'username': 'root' }
         """
 
-        def retry(error):
-            """The built-in retry in ReactiveX whouldn't do it,
-            so I hade write this in order to retry the while observable
-            chain.
-            """
+        retry = retry or self.retry
+        deadline = retry.start()
+        key = key or str(uuid4())
+        tried = set()
+        retried = set()
+        preferred = None
+        metrics = self.messenger.metrics
+
+        while True:
+            if preferred is not None:
+                target, preferred = preferred, None
+            else:
+                target = self.capacity.pick(cpu, mem, disc,
+                                            exclude=tried)
+
+            if target is not None:
+                tried.add(target)
+
+            agent = None
+
+            if metrics.enabled:
+                started = perf_counter()
+
+            try:
+                checksum = self.messenger.publish_command(
+                    command='machine-requested',
+                    target=target,
+                    name=name,
+                    image=image,
+                    cpu=cpu,
+                    mem=mem,
+                    disc=disc,
+                    pkey=pkey,
+                    key=key,
+                    tenant=tenant,
+                    priority=priority)
+
+                logging.debug('Machine requested: %s', checksum)
 
-            if retries < 10:
-                logging.warning('Retrying request machine: %d/10',
-                                retries + 1)
-
-                return self.create_machine(
-                    name, image, cpu, mem, disc, pkey, retries + 1,
-                    scheduler)
-
-            raise error
-
-        return Observable.start(partial(
-                self.messenger.publish_command,
-                command='machine-requested',
-                name=name,
-                image=image,
-                cpu=cpu,
-                mem=mem,
-                disc=disc,
-                pkey=pkey), scheduler=scheduler) \
-            .tap(lambda cs: logging.debug('Machine requested: %s',
-                                          cs)) \
-            .flat_map(
                 # Wait for the first response for machine-request
                 # command.
-                partial(self.get_response, 5000, scheduler)) \
-            .tap(lambda m: logging.debug('Machine confirmed %s',
-                                         m.body)) \
-            .map(
+                confirm = await self.messenger.wait_for_response(
+                    checksum, retry.stage_timeout('request', deadline))
+
+                if confirm.message_type == self.MACHINE_REJECTED:
+                    # The agent no longer fits the machine, try the next
+                    # one without waiting
+                    logging.debug('Machine rejected by %s', confirm.uuid)
+                    continue
+
+                logging.debug('Machine confirmed %s', confirm.body)
+
+                agent = confirm.uuid
+
+                if metrics.enabled:
+                    confirmed = perf_counter()
+                    metrics.observe('handshake_seconds',
+                                    confirmed - started,
+                                    stage='request')
+
                 # Confirm the response and make the agent actually
                 # create the virtual machine.
-                partial(self.publish_response, {})) \
-            .flat_map(
-                # Wait for the machine...
-                partial(self.get_response, 5000, scheduler)) \
-            .map(lambda m: m.json()) \
-            .tap(partial(logging.debug, 'Machine response: %s')) \
-            .map(
-                # Map the machine message for something useful.
-                lambda m: dict(host=m['host'],
-                               username=m['username'])) \
-            .catch_exception(retry) \
-            .first()
-
-    def stop_machine(self, name):
-        pass
-
-    def send_stats(self):
-        pass
+                checksum = self.publish_response({}, confirm)
+
+                # Wait for the machine, every progress event resets
+                # the timeout.
+                responses = self.messenger.responses(
+                    checksum,
+                    partial(retry.stage_timeout, 'respond', deadline))
+
+                try:
+                    async for response in responses:
+                        machine = response.json()
+
+                        if 'progress' not in machine:
+                            break
+
+                        logging.debug('Machine progress: %s', machine)
+
+                        if progress is not None and \
+                                machine['progress'] != 'heartbeat':
+                            progress(machine)
+                finally:
+                    await responses.aclose()
+
+                logging.debug('Machine response: %s', machine)
+
+                if metrics.enabled:
+                    finished = perf_counter()
+                    metrics.observe('handshake_seconds',
+                                    finished - confirmed,
+                                    stage='respond')
+                    metrics.observe('machine_seconds',
+                                    finished - started)
+
+                machine = dict(host=machine['host'],
+                               username=machine['username'])
+
+                if progress is not None:
+                    progress(dict(machine,
+                                  progress='ready',
+                                  uuid=agent))
+
+                return machine
+            except Exception as error:
+                if isinstance(error, asyncio.TimeoutError):
+                    metrics.increment('machine_timeouts')
+
+                if not retry.should_retry(retries, deadline):
+                    raise
+
+                retries += 1
+                metrics.increment('machine_retries')
+
+                # The agent which confirmed may be creating the machine
+                # already, so give it the retry if it can be reached.
+                if agent is not None and agent not in retried and \
+                        agent in self.capacity:
+                    retried.add(agent)
+                    preferred = agent
+
+                delay = retry.backoff(retries, deadline)
+
+                logging.warning('Retrying request machine in %.2fs: '
+                                '%d/%d', delay, retries, retry.retries)
+
+                await asyncio.sleep(delay)
+
+    def create_machine(self, name, image, cpu,
+                       mem, disc, pkey, retries=0,
+                       scheduler=AsyncIOScheduler(), *, key=None,
+                       retry=None, progress=None, priority=None,
+                       tenant=None):
+        """Creates a create-machine request and listens for a response.
+        Returns with an observable which generates a single value with
+        the virtual machine, see request_machine.
+        """
+
+        return Observable.defer(
+            lambda: Observable.from_future(
+                asyncio.ensure_future(
+                    self.request_machine(name, image, cpu,
+                                         mem, disc, pkey, retries,
+                                         key=key,
+                                         retry=retry,
+                                         progress=progress,
+                                         priority=priority,
+                                         tenant=tenant),
+                    loop=scheduler.loop)))
+
+    async def stream_machine(self, name, image, cpu,
+                             mem, disc, pkey, retries=0, *, key=None,
+                             retry=None, priority=None, tenant=None):
+        """Requests a machine like request_machine and yields its
+        progress events as they arrive, the last one being ready with
+        the machine's host and username.
+        Raises what request_machine raises, after the events so far.
+
+        Use like so:
+            async for event in connector.stream_machine(...):
+                print(event['progress'])
+        """
+
+        events = asyncio.Queue()
+        request = asyncio.ensure_future(
+            self.request_machine(name, image, cpu, mem, disc, pkey,
+                                 retries,
+                                 key=key,
+                                 retry=retry,
+                                 progress=events.put_nowait,
+                                 priority=priority,
+                                 tenant=tenant))
+        request.add_done_callback(lambda _: events.put_nowait(None))
+
+        try:
+            while True:
+                event = await events.get()
+
+                if event is None:
+                    break
+
+                yield event
+
+            request.result()
+        finally:
+            request.cancel()
+
+    def machine_command(self, command, names=None,
+                        timeout=LIFECYCLE_TIMEOUT,
+                        scheduler=AsyncIOScheduler()):
+        """Broadcasts a machine lifecycle command for provided machine
+        names, in a single message, to all agents, see manage_machines.
+        Returns an observable of per machine results as they stream back
+        from the agents, dicts with name, agent and either result or
+        error. It completes when there's a result for every name, after
+        which names which no agent answered for within timeout seconds
+        get a 'timeout' error. Without names, it completes after timeout
+        with whatever the agents answered.
+        """
+
+        def subscribe(observer):
+            pending = set(names) if names is not None else None
+            checksum = self.messenger.publish_broadcast(command,
+                                                        names=names)
+            stop, observable = self.messenger \
+                                   .get_response_listener(checksum,
+                                                          scheduler)
+            subscriptions = []
+            done = []
+
+            def dispose():
+                if done:
+                    return
+
+                done.append(True)
+
+                for subscription in subscriptions:
+                    subscription.dispose()
+
+                stop()
+
+            def finish(_=None):
+                if done:
+                    return
+
+                dispose()
+
+                for name in sorted(pending or ()):
+                    observer.on_next(dict(name=name, agent=None,
+                                          error='timeout'))
+
+                observer.on_completed()
+
+            def on_next(message):
+                message.ack()
+                response = message.json()
+
+                for result in response['results']:
+                    if pending is not None:
+                        if result['name'] not in pending:
+                            continue
+
+                        pending.discard(result['name'])
+
+                    observer.on_next(dict(result, agent=response['uuid']))
+
+                if pending is not None and not pending:
+                    finish()
+
+            subscriptions.append(observable.subscribe(on_next))
+            subscriptions.append(
+                Observable.timer(int(timeout * 1000),
+                                 scheduler=scheduler)
+                .subscribe(finish))
+
+            if pending is not None and not pending:
+                finish()
+
+            # Unsubscribing only stops listening, nothing is emitted
+            return dispose
+
+        return Observable.create(subscribe)
+
+    def stop_machines(self, names, timeout=LIFECYCLE_TIMEOUT,
+                      scheduler=AsyncIOScheduler()):
+        """Stops machines by provided names, in a single message.
+        Returns an observable of per machine results, see
+        machine_command.
+        """
+
+        return self.machine_command('machine-stop', list(names),
+                                    timeout, scheduler)
+
+    def stop_machine(self, name, timeout=LIFECYCLE_TIMEOUT,
+                     scheduler=AsyncIOScheduler()):
+        """Stops a machine by name.
+        Returns an observable of its result, see machine_command.
+        """
+
+        return self.stop_machines([name], timeout, scheduler)
+
+    def delete_machines(self, names, timeout=LIFECYCLE_TIMEOUT,
+                        scheduler=AsyncIOScheduler()):
+        """Deletes machines by provided names, in a single message.
+        Returns an observable of per machine results, see
+        machine_command.
+        """
+
+        return self.machine_command('machine-delete', list(names),
+                                    timeout, scheduler)
+
+    def delete_machine(self, name, timeout=LIFECYCLE_TIMEOUT,
+                       scheduler=AsyncIOScheduler()):
+        """Deletes a machine by name.
+        Returns an observable of its result, see machine_command.
+        """
+
+        return self.delete_machines([name], timeout, scheduler)
+
+    def list_machines(self, timeout=LIFECYCLE_TIMEOUT,
+                      scheduler=AsyncIOScheduler()):
+        """Lists the machines of all agents which answer within
+        timeout seconds.
+        Returns an observable of machines, with name, agent and result,
+        see machine_command.
+        """
+
+        return self.machine_command('machine-list', None, timeout,
+                                    scheduler)
+
+    def manage_machines(self,
+                        stop_callback=None,
+                        delete_callback=None,
+                        list_callback=None,
+                        scheduler=AsyncIOScheduler(),
+                        concurrency=LIFECYCLE_CONCURRENCY,
+                        executor=None):
+        """Creates a broadcast listener for machine lifecycle commands.
+        The stop and delete callbacks are called with the name of each
+        machine in a command, up to concurrency at a time, and return
+        None if this agent doesn't have the machine, otherwise anything
+        to respond with as its result. Errors are responded with as
+        well. Results are streamed back one machine at a time.
+        The list callback returns a list of the agent's machines, as
+        dicts with name, which is responded with in one go.
+        Callbacks may be coroutine functions, otherwise they're run in
+        provided executor, or the event loop's default one.
+        Returns a channel close function and the listener observable,
+        of the number of results responded with per command.
+        """
+
+        stop, observable = self.messenger \
+                               .get_broadcast_listener(scheduler)
+        callbacks = {'machine-stop': stop_callback,
+                     'machine-delete': delete_callback}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def handle_name(callback, name, message):
+            async with semaphore:
+                try:
+                    result = await run_callback(scheduler.loop, executor,
+                                                callback, name=name)
+                except Exception as error:
+                    logging.error('Could not handle machine %s: %s',
+                                  name, error)
+                    result = dict(name=name, error=str(error))
+                else:
+                    if result is None:
+                        return 0
+
+                    result = dict(name=name, result=result)
+
+            self.publish_response(dict(results=[result]), message)
+
+            return 1
+
+        async def handle_command(message):
+            command = message.json()
+            callback = callbacks.get(command['command'])
+
+            try:
+                if command['command'] == 'machine-list':
+                    if list_callback is None:
+                        return 0
+
+                    machines = await run_callback(scheduler.loop,
+                                                  executor,
+                                                  list_callback)
+                    self.publish_response(
+                        dict(results=[dict(name=machine['name'],
+                                           result=machine)
+                                      for machine in machines]),
+                        message)
+
+                    return len(machines)
+
+                if callback is None:
+                    return 0
+
+                counts = await asyncio.gather(
+                    *[handle_name(callback, name, message)
+                      for name in command['names']])
+
+                return sum(counts)
+            except Exception as error:
+                logging.error('Error while managing machines: %s', error)
+                return 0
+            finally:
+                message.ack()
+
+        handled = observable \
+            .tap(lambda m: logging.debug('Lifecycle command: %s', m.body)) \
+            .flat_map(lambda m: Observable.from_future(
+                asyncio.ensure_future(handle_command(m),
+                                      loop=scheduler.loop)))
+
+        return stop, handled.catch_exception(partial(listener_error, stop))
+
+    def send_stats(self, stats, interval=STATS_INTERVAL,
+                   scheduler=AsyncIOScheduler()):
+        """Publish a sample of this agent's statistics in the status
+        exchange right away and then every interval seconds, as returned
+        by provided stats callback in a dict of numbers. Keep samples
+        compact, they're kept by listeners for minutes.
+        Returns a stop function.
+        """
+
+        def publish(_):
+            try:
+                self.messenger.publish_stats(stats=stats())
+            except Exception as error:
+                logging.warning('Could not send stats: %s', error)
+
+        subscription = Observable.interval(interval * 1000,
+                                           scheduler=scheduler) \
+            .start_with(None) \
+            .subscribe(publish)
+
+        return subscription.dispose
+
+    def advertise_capacity(self, capacity):
+        """Publish the free resources of this agent in the status
+        exchange, as returned by provided capacity callback in a dict
+        with cpu, mem and disc.
+        Returns the message's checksum.
+        """
+
+        return self.messenger.publish_stats(capacity=capacity())
+
+    def watch_capacity(self, scheduler=AsyncIOScheduler()):
+        """Listens for advertised agent capacities in the status
+        exchange and keeps the capacity index up to date, so that
+        machine requests can be sent straight to fitting agents.
+        Returns a stop function.
+        """
+
+        stop, observable = self.messenger \
+                               .get_status_listener(scheduler)
+
+        def update(message):
+            message.ack()
+            status = message.json()
+
+            if 'capacity' in status:
+                self.capacity.update(status['uuid'],
+                                     **status['capacity'])
+
+        subscription = observable.subscribe(update)
+
+        def dispose():
+            subscription.dispose()
+            stop()
+
+        return dispose
 
     def wait_for_machines(self,
                           confirm_callback,
                           create_callback,
-                          scheduler=AsyncIOScheduler()):
+                          scheduler=AsyncIOScheduler(),
+                          prefetch=1,
+                          concurrency=None,
+                          executor=None,
+                          capacity=None,
+                          cancel_callback=None,
+                          fair=False,
+                          advertise_interval=ADVERTISE_INTERVAL):
         """Creates a command listener for incoming machine requests.
         The confirm callback is used to confirm that the agent are
         capable of creating the requested machine.
         The create callback is used to create the actual virtual
         machine.
+        Create callbacks which take a progress argument are passed a
+        function to report the stages of the creation to the requester
+        with, like progress('image-pulled') or
+        progress('booting', percent=50), from any thread. The agent
+        reports accepted itself, and sends heartbeats while creating.
+        The cancel callback, if provided, is called with the same
+        arguments when a confirmed machine isn't created after all,
+        because the requester went away or the create callback failed.
+        Callbacks may be coroutine functions, otherwise they're run in
+        provided executor, or the event loop's default one, so that
+        they don't block the listener.
+        Prefetch sets how many requests the agent takes on at a time and
+        concurrency how many of them may be handled at once, which
+        defaults to prefetch. A prefetch of 0 takes on and handles any
+        number of requests at once. If fair is set, requests waiting for one
+        of those slots take turns by tenant, so that a tenant's bulk
+        request doesn't hold up everyone else's, see FairShare. It only
+        makes a difference when prefetch is larger than concurrency.
+        The capacity callback returns the agent's free resources as a
+        dict with cpu, mem and disc. If provided, it's advertised when
+        listening starts, after every request and every
+        advertise_interval seconds, well within the capacity index's
+        max age, so that idle agents aren't forgotten. The agent listens
+        for requests sent straight to it as well. Those are responded to
+        as rejected when they aren't confirmed, rather than requeued.
+        Retried requests, by their idempotency key, aren't confirmed or
+        created again while the key is in the connector's created cache,
+        the machine being created, or created, is responded with.
+        Requests being handled are kept in the connector's handling set,
+        see drain.
         Returns a channel close function and the listener observable.
         """
 
         stop, observable = self.messenger \
-                               .get_command_listener(scheduler)
-
-        def handle_error(message, error):
-            """If by any reason the communication between the listener
-            (agent) and the requester (api) whould brake, this error
-            catcher will just acknowledge the message and continue
-            listening.
-            """
-
-            logging.error(
-                'Error while listening for machines: %s',
-                error)
-            message.ack()
-            return Observable.just(None)
-
-        def handle_confirm(message):
+                               .get_command_listener('machine-requested',
+                                                     scheduler,
+                                                     prefetch)
+        # A prefetch of 0 is unlimited in AMQP, and so is concurrency
+        share = FairShare(concurrency or prefetch or None)
+        metrics = self.messenger.metrics
+        loop = scheduler.loop
+        reports_progress = takes_argument(create_callback, 'progress')
+
+        async def call(stage, callback, **kwargs):
+            if metrics.enabled:
+                started = perf_counter()
+
+            try:
+                return await run_callback(scheduler.loop, executor,
+                                          callback, **kwargs)
+            finally:
+                if metrics.enabled:
+                    metrics.observe('handshake_seconds',
+                                    perf_counter() - started,
+                                    stage=stage)
+
+        def report(confirm, stage, **details):
+            self.publish_response(dict(details, progress=stage), confirm)
+
+        def progress(confirm, stage, **details):
+            loop.call_soon_threadsafe(
+                partial(report, confirm, stage, **details))
+
+        async def heartbeat(confirm):
+            while True:
+                await asyncio.sleep(self.PROGRESS_HEARTBEAT)
+                report(confirm, 'heartbeat')
+
+        async def handle_request(requeue, message):
             """Confirm if agent is capable of creating requested
-            machine. If not, then reject and requeue the message.
+            machine, if not then reject and requeue the message, unless
+            it was sent straight to this agent. Otherwise response with
+            the availability, wait for a confirm and respond with the
+            created machine, or the one created for the same idempotency
+            key.
+            If by any reason the communication between the listener
+            (agent) and the requester (api) whould brake, the message
+            is just acknowledged.
+            Returns the checksum of the machine response or None.
             """
 
             machine = message.json()
+            kwargs = dict(name=machine['name'],
+                          image=machine['image'],
+                          cpu=machine['cpu'],
+                          mem=machine['mem'],
+                          disc=machine['disc'],
+                          pkey=machine['pkey'])
+            key = machine.get('key')
+            tenant = machine.get('tenant') if fair else None
+
+            async with share.slot(tenant):
+                created = self.created.get(key) \
+                    if key is not None else None
+                pending = False
+
+                try:
+                    if created is not None:
+                        logging.info('Duplicate machine request: %s', key)
+                        metrics.increment('machine_duplicates')
+                    elif not await call('confirm', confirm_callback,
+                                        **kwargs):
+                        metrics.increment('machine_rejects')
+
+                        if not requeue:
+                            # Nobody else gets this one, so let the
+                            # requester move on rather than time out
+                            self.publish_response({}, message,
+                                                  self.MACHINE_REJECTED)
+
+                        message.reject(requeue=requeue)
+                        return None
+                    else:
+                        pending = True
+
+                    # Response with your availability and listen for a
+                    # confirm
+                    confirm = await self.messenger.wait_for_response(
+                        self.publish_response({}, message),
+                        self.retry.stage_timeout('confirm'))
+
+                    logging.debug('Machine confirmed: %s', confirm.body)
+
+                    report(confirm, 'accepted')
+
+                    # Create the actual machine, unless it's already
+                    # being created
+                    if created is None:
+                        if reports_progress:
+                            kwargs['progress'] = partial(progress, confirm)
+
+                        created = asyncio.ensure_future(
+                            call('create', create_callback, **kwargs))
+                        kwargs.pop('progress', None)
+
+                        if key is not None:
+                            self.created.put(key, created)
+
+                    beating = asyncio.ensure_future(heartbeat(confirm))
+
+                    try:
+                        vm = await asyncio.shield(created)
+                    except Exception:
+                        # Let a retry create it again
+                        self.created.pop(key, created)
+                        raise
+                    finally:
+                        beating.cancel()
+
+                    pending = False
+
+                    logging.debug('Responding with machine: %s', vm)
 
-            if confirm_callback(name=machine['name'],
-                                image=machine['image'],
-                                cpu=machine['cpu'],
-                                mem=machine['mem'],
-                                disc=machine['disc'],
-                                pkey=machine['pkey']):
-                return True
-
-            message.reject(requeue=True)
-
-            return False
-
-        return stop, observable \
-            .where(partial(filter_message,
-                           dict(command='machine-requested'))) \
-            .tap(lambda m: logging.debug('Machine requested: %s',
-                                         m.body)) \
-            .where(handle_confirm) \
-            .flat_map(
-                # Incoming machine request
-                lambda cm:
-                    # Response with your availability
-                    Observable.just(self.publish_response({}, cm))
-                    # Listens for a confirm
-                    .flat_map(partial(self.get_response,
-                                      1000,
-                                      scheduler))
-                    .tap(
-                        lambda m:
-                            logging.debug('Machine confirmed: %s',
-                                          m.body))
-                    .map(lambda m: (cm.json(), m))
-                    # Create the actual machine
-                    .map(lambda cm_m: (create_callback(
-                            name=cm_m[0]['name'],
-                            image=cm_m[0]['image'],
-                            cpu=cm_m[0]['cpu'],
-                            mem=cm_m[0]['mem'],
-                            disc=cm_m[0]['disc'],
-                            pkey=cm_m[0]['pkey']),
-                        cm_m[1]))
-                    .tap(
-                        lambda vm_m:
-                        logging.debug('Responding with machine: %s',
-                                      vm_m[0]))
                     # Respond with the machine
-                    .map(lambda vm_m: self.publish_response(*vm_m))
-                    .tap(lambda _: cm.ack())
-                    .catch_exception(partial(handle_error, cm))
-                    .where(lambda m: m is not None)
-            ) \
+                    checksum = self.publish_response(vm, confirm)
+                except Exception as error:
+                    if isinstance(error, asyncio.TimeoutError):
+                        metrics.increment('machine_timeouts')
+
+                    logging.error(
+                        'Error while listening for machines: %s',
+                        error)
+
+                    if pending and cancel_callback is not None:
+                        try:
+                            await call('cancel', cancel_callback,
+                                       **kwargs)
+                        except Exception as error:
+                            logging.error('Could not cancel machine: %s',
+                                          error)
+
+                    message.ack()
+                    return None
+                finally:
+                    if capacity is not None:
+                        self.advertise_capacity(capacity)
+
+            message.ack()
+
+            return checksum
+
+        def handling(requeue, message):
+            task = asyncio.ensure_future(handle_request(requeue, message),
+                                         loop=scheduler.loop)
+            self.handling.add(task)
+            task.add_done_callback(self.handling.discard)
+
+            def subscribe(observer):
+                def done(task):
+                    result = None
+
+                    if task.cancelled():
+                        pass
+                    elif task.exception() is not None:
+                        # A failed request mustn't stop the listener
+                        logging.error('Machine request failed: %s',
+                                      task.exception())
+                    else:
+                        result = task.result()
+
+                    observer.on_next(result)
+                    observer.on_completed()
+
+                task.add_done_callback(done)
+
+                # Requests being handled should be drained rather than
+                # cancelled, so disposing only detaches
+                return lambda: task.remove_done_callback(done)
+
+            return Observable.create(subscribe)
+
+        def handle(requeue, observable):
+            return observable \
+                .tap(lambda m: logging.debug('Machine requested: %s',
+                                             m.body)) \
+                .flat_map(partial(handling, requeue))
+
+        handled = handle(True, observable)
+
+        if capacity is not None:
+            stop_shared = stop
+            stop_targeted, targeted = self.messenger \
+                .get_command_listener('machine-requested',
+                                      scheduler,
+                                      prefetch,
+                                      target=self.messenger.uuid)
+
+            def advertise(_):
+                try:
+                    self.advertise_capacity(capacity)
+                except Exception as error:
+                    logging.warning('Could not advertise capacity: %s',
+                                    error)
+
+            advertising = Observable.interval(
+                int(advertise_interval * 1000), scheduler=scheduler) \
+                .start_with(None) \
+                .subscribe(advertise)
+
+            def stop():
+                advertising.dispose()
+                stop_shared()
+                stop_targeted()
+
+            handled = Observable.merge(handled, handle(False, targeted))
+
+        return stop, handled \
+            .where(lambda m: m is not None) \
             .catch_exception(partial(listener_error, stop))
 
-    def listen_for_stats(self):
-        pass
+    async def drain(self, timeout=None):
+        """Waits for the machine requests being handled to finish, at
+        most timeout seconds if provided. Stop taking on new requests
+        first, by disposing the subscription to wait_for_machines'
+        observable.
+        Returns the number of requests still being handled.
+        """
+
+        if self.handling:
+            await asyncio.wait(list(self.handling), timeout=timeout)
+
+        return len(self.handling)
+
+    def listen_for_stats(self, scheduler=AsyncIOScheduler(),
+                         prefetch=STATS_PREFETCH,
+                         batch_time=STATS_BATCH_TIME):
+        """Listens for statistics samples in the status exchange and
+        keeps the connector's stats store up to date, see StatsStore.
+        Every agent seen in the status exchange is kept track of.
+        Samples are taken on in batches of up to prefetch messages, or
+        whatever arrived within batch_time seconds, and each batch is
+        acknowledged at once.
+        Returns a stop function.
+        """
+
+        stop, observable = self.messenger \
+                               .get_status_listener(scheduler, prefetch)
+
+        def update(batch):
+            for message in batch:
+                status = message.json()
+
+                if 'stats' in status:
+                    self.stats.add(status['uuid'],
+                                   status['time'],
+                                   status['stats'])
+                else:
+                    self.stats.touch(status['uuid'])
+
+            try:
+                batch[-1].ack(multiple=True)
+            except AMQPError as error:
+                logging.debug('Could not ack stats: %s', error)
+
+            self.stats.expire()
+
+        subscription = observable \
+            .buffer_with_time_or_count(batch_time * 1000, prefetch,
+                                       scheduler=scheduler) \
+            .where(lambda batch: len(batch) > 0) \
+            .subscribe(update)
+
+        def dispose():
+            subscription.dispose()
+            stop()
+
+        return dispose
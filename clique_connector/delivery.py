@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import logging
+
+from amqpstorm import AMQPChannelError, AMQPConnectionError
+from time import perf_counter
+
+
+class Delivery:
+    """Wraps a received amqpstorm message and decodes its body at most
+    once, by the codec for the message's content type.
+
+    The checksum of a message is sent as its message id, rather than
+    as a part of the body, so the body is encoded just once. It's put
+    back into the decoded contents.
+
+    The body is kept as the raw bytes received. The sender's uuid, the
+    checksum and the message type are read from the message properties,
+    so replying to a message doesn't decode it at all. Other fields are
+    read from the decoded contents, like delivery['name'].
+
+    The decoded contents are shared by everyone asking for them and
+    should not be modified.
+    """
+
+    def __init__(self, message, codec, metrics=None):
+        self.message = message
+        self.codec = codec
+        self.metrics = metrics
+        self.__contents = None
+
+    @property
+    def body(self):
+        return self.message.body
+
+    @property
+    def correlation_id(self):
+        return self.message.correlation_id
+
+    @property
+    def content_type(self):
+        return self.message.content_type
+
+    @property
+    def message_type(self):
+        return self.message.message_type
+
+    @property
+    def uuid(self):
+        """The uuid of the messenger which sent the message, from its
+        app id, or from the contents for senders which don't set it.
+        """
+
+        return self.message.app_id or self.json()['uuid']
+
+    @property
+    def checksum(self):
+        return self.message.message_id or self.json()['checksum']
+
+    def __getitem__(self, name):
+        return self.json()[name]
+
+    def __contains__(self, name):
+        return name in self.json()
+
+    def get(self, name, default=None):
+        return self.json().get(name, default)
+
+    def json(self):
+        """Returns the decoded contents of the message. Named after
+        amqpstorm's Message.json, whatever the content type.
+        """
+
+        if self.__contents is None:
+            timed = self.metrics is not None and self.metrics.enabled
+
+            if timed:
+                started = perf_counter()
+
+            contents = self.codec.loads(self.message.body)
+
+            if timed:
+                self.metrics.observe('decode_seconds',
+                                     perf_counter() - started)
+
+            if 'checksum' not in contents:
+                contents['checksum'] = self.message.message_id
+
+            self.__contents = contents
+
+        return self.__contents
+
+    def settle(self, settle, **kwargs):
+        """Acknowledges or rejects the message by provided settle
+        function, unless the channel it came on is gone. The broker
+        requeues the messages of lost channels and redelivers them on
+        the new ones, so there's nothing to settle then.
+        """
+
+        try:
+            settle(**kwargs)
+        except AMQPConnectionError as error:
+            logging.debug('Message lost with its connection: %s', error)
+        except AMQPChannelError as error:
+            if not self.message.channel.is_closed:
+                raise
+
+            logging.debug('Message lost with its channel: %s', error)
+
+    def ack(self, multiple=False):
+        """Acknowledges the message, or every message up to and
+        including it on its channel if multiple is set.
+        """
+
+        if multiple:
+            self.settle(self.message.channel.basic.ack,
+                        delivery_tag=self.message.delivery_tag,
+                        multiple=True)
+        else:
+            self.settle(self.message.ack)
+
+    def nack(self, requeue=True):
+        self.settle(self.message.nack, requeue=requeue)
+
+    def reject(self, requeue=True):
+        self.settle(self.message.reject, requeue=requeue)
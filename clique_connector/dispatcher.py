@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import logging
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class ReplyDispatcher:
+    """Routes messages from a single reply queue to whoever waits for
+    them by the message's correlation id, which is the checksum of the
+    message being replied to.
+
+    Replies arriving before anyone waits for them are kept, up to
+    max_pending messages, since a reply may very well beat the waiter
+    to it. The oldest ones are acknowledged and dropped beyond that.
+
+    Use like so:
+        dispatcher = ReplyDispatcher()
+
+        # Get called for every reply to checksum
+        unsubscribe = dispatcher.subscribe(checksum, callback)
+
+        # Called by the reply queue consumer
+        dispatcher.dispatch(message)
+    """
+
+    MAX_PENDING = 1024
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.__lock = Lock()
+        self.__subscribers = {}
+        self.__pending = OrderedDict()
+        self.__pending_count = 0
+
+    def subscribe(self, correlation_id, callback):
+        """Calls provided callback with every reply by provided
+        correlation id, starting with the ones already received.
+        Returns an unsubscribe function.
+        """
+
+        with self.__lock:
+            self.__subscribers[correlation_id] = callback
+            pending = self.__pending.pop(correlation_id, [])
+            self.__pending_count -= len(pending)
+
+        for message in pending:
+            callback(message)
+
+        return lambda: self.unsubscribe(correlation_id, callback)
+
+    def unsubscribe(self, correlation_id, callback=None):
+        """Stops calling the callback for provided correlation id.
+        """
+
+        with self.__lock:
+            if callback in (None,
+                            self.__subscribers.get(correlation_id)):
+                self.__subscribers.pop(correlation_id, None)
+
+    def dispatch(self, message):
+        """Hands a reply over to its subscriber or keeps it until
+        someone subscribes.
+        """
+
+        correlation_id = message.correlation_id
+        dropped = []
+
+        with self.__lock:
+            callback = self.__subscribers.get(correlation_id)
+
+            if callback is None:
+                self.__pending.setdefault(correlation_id, []) \
+                             .append(message)
+                self.__pending_count += 1
+
+                while self.__pending_count > self.max_pending:
+                    _, messages = self.__pending.popitem(last=False)
+                    self.__pending_count -= len(messages)
+                    dropped.extend(messages)
+
+        for stale in dropped:
+            logging.debug('Dropping unclaimed reply to %s',
+                          stale.correlation_id)
+            stale.ack()
+
+        if callback is not None:
+            callback(message)
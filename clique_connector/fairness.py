@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+
+class FairShare:
+    """Lets concurrency tasks run at a time, like a semaphore, but hands
+    free slots out round-robin by tenant rather than first come, first
+    served. A tenant with a thousand waiting tasks gets every other slot
+    when another tenant has one waiting, not the thousand first ones.
+    Tasks of the same tenant run in order. If concurrency is None,
+    every task runs right away.
+
+    Use like so:
+        share = FairShare(4)
+
+        async with share.slot('some-tenant'):
+            ...
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.free = concurrency
+        self.__waiting = OrderedDict()
+
+    def __len__(self):
+        return sum(len(waiters) for waiters in self.__waiting.values())
+
+    def tenants(self):
+        """Returns the tenants with tasks waiting, in turn order.
+        """
+
+        return list(self.__waiting)
+
+    async def acquire(self, tenant=None):
+        """Waits for a slot by provided tenant's turn.
+        """
+
+        if self.concurrency is None:
+            return
+
+        if self.free > 0 and not self.__waiting:
+            self.free -= 1
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.__waiting.setdefault(tenant, deque()).append(waiter)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Got the slot while being cancelled, pass it on
+                self.release()
+
+            raise
+
+    def release(self):
+        """Hands a slot over to the next tenant in turn, or frees it.
+        """
+
+        if self.concurrency is None:
+            return
+
+        while self.__waiting:
+            tenant, waiters = next(iter(self.__waiting.items()))
+            waiter = waiters.popleft()
+
+            # The tenant's turn is over, it goes last if it has more
+            del self.__waiting[tenant]
+
+            if waiters:
+                self.__waiting[tenant] = waiters
+
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.free += 1
+
+    @asynccontextmanager
+    async def slot(self, tenant=None):
+        """Holds a slot, taken by provided tenant's turn, in a with
+        statement.
+        """
+
+        await self.acquire(tenant)
+
+        try:
+            yield
+        finally:
+            self.release()
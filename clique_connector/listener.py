@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import logging
+
+from amqpstorm import AMQPConnectionError, AMQPError
+
+
+class Listener:
+    """A queue listener which survives reconnects of its messenger.
+
+    The listener's channel is created and its queue is declared right
+    away by provided queue argument generator callback. Either start
+    consuming the queue or get messages one by one.
+
+    When the messenger has reconnected, the listener is restarted on a
+    new channel and consumes the queue again if it did before.
+    """
+
+    def __init__(self, messenger, listen_args_generator, prefetch=1):
+        self.messenger = messenger
+        self.listen_args_generator = listen_args_generator
+        self.prefetch = prefetch
+        self.on_message = None
+        self.on_error = None
+        self.tag = None
+        self.closed = False
+        self.channel, self.queue = messenger.listener_channel(
+            listen_args_generator, prefetch)
+
+        messenger.register(self)
+
+    def start(self, on_message, on_error=None):
+        """Starts consuming the queue, see Messenger.start_consumer.
+        If the connection is down, consuming starts when the messenger
+        has reconnected.
+        """
+
+        self.on_message = on_message
+        self.on_error = on_error
+
+        try:
+            self.tag = self.messenger.start_consumer(self.channel,
+                                                     self.queue,
+                                                     on_message,
+                                                     on_error)
+        except AMQPConnectionError as error:
+            logging.debug('Consumer waits for reconnect: %s', error)
+
+    def restart(self):
+        """Recreates the channel and consumes the queue again, if it
+        did before. Called by the messenger after reconnecting.
+        """
+
+        if self.closed:
+            return
+
+        self.channel, self.queue = self.messenger.listener_channel(
+            self.listen_args_generator, self.prefetch)
+
+        if self.on_message is not None:
+            self.start(self.on_message, self.on_error)
+
+    def fail(self, error):
+        """Passes an error on to on_error, if consuming.
+        """
+
+        if self.on_error is not None:
+            self.on_error(error)
+
+    def get(self):
+        """Gets a single message from the queue as a delivery.
+        Returns None if there are none, or if the connection is down
+        while the messenger reconnects.
+        """
+
+        try:
+            message = self.channel.basic.get(auto_decode=False,
+                                             **self.queue)
+        except AMQPConnectionError as error:
+            logging.debug('Could not get message: %s', error)
+            return None
+
+        if message is None:
+            return None
+
+        return self.messenger.decode(message)
+
+    def cancel(self):
+        """Stops consuming the queue.
+        """
+
+        self.on_message = None
+        self.on_error = None
+
+        if self.tag is not None and not self.channel.is_closed:
+            try:
+                self.channel.basic.cancel(self.tag)
+            except AMQPError as error:
+                logging.debug('Could not cancel consumer: %s', error)
+
+    def close(self):
+        """Closes the listener's channel for good.
+        """
+
+        self.closed = True
+        self.messenger.unregister(self)
+
+        try:
+            self.channel.close()
+        except AMQPError as error:
+            logging.debug('Could not close listener channel: %s', error)
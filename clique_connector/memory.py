@@ -0,0 +1,666 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+import json
+
+from amqpstorm import AMQPChannelError, AMQPConnectionError
+from collections import Counter, deque
+from itertools import count
+from threading import RLock
+from uuid import uuid4
+
+
+class MemoryTransport:
+    """A messenger transport to an in-process broker, for testing and
+    benchmarking without RabbitMQ. Messengers sharing a transport share
+    its broker.
+
+    Use like so:
+        transport = MemoryTransport()
+
+        agent = Messenger('agent', transport=transport)
+        api = Messenger('api', transport=transport)
+    """
+
+    def __init__(self, broker=None):
+        self.broker = broker or MemoryBroker()
+
+    def connect(self, host, heartbeat):
+        return MemoryConnection(self.broker)
+
+    def message(self, channel, body, properties):
+        return MemoryMessage(channel, body, properties)
+
+    def consume(self, channel, queue, on_message, on_error):
+        return channel.basic.consume(on_message, **queue)
+
+
+class MemoryBroker:
+    """An in-process broker with queues, the default exchange, direct
+    and fanout exchanges, acknowledgements, rejects and requeues.
+
+    Messages are delivered to consumers by the asyncio event loop, and
+    consumers are called in the loop's thread. Everything else may be
+    called from any thread.
+
+    The broker counts what's going on in its counters: round_trips for
+    methods which would wait for a reply from a real broker,
+    queues_created, published and delivered messages.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.lock = RLock()
+        self.queues = {}
+        self.exchanges = {}
+        self.counters = Counter()
+
+    def declare_queue(self, channel, name='', exclusive=False,
+                      auto_delete=False, arguments=None):
+        with self.lock:
+            if not name:
+                name = 'amq.gen-%s' % uuid4()
+
+            queue = self.queues.get(name)
+
+            if queue is None:
+                queue = MemoryQueue(name,
+                                    channel.connection if exclusive
+                                    else None,
+                                    auto_delete,
+                                    arguments or {})
+                self.queues[name] = queue
+                self.counters['queues_created'] += 1
+            elif queue.owner not in (None, channel.connection):
+                raise AMQPChannelError(
+                    "RESOURCE_LOCKED - cannot obtain exclusive access to "
+                    "locked queue '%s'" % name)
+            elif queue.arguments != (arguments or {}):
+                raise AMQPChannelError(
+                    "PRECONDITION_FAILED - inequivalent arguments for "
+                    "queue '%s'" % name)
+
+            if exclusive:
+                channel.connection.exclusive.add(name)
+
+            return dict(queue=name,
+                        message_count=len(queue.messages),
+                        consumer_count=len(queue.consumers))
+
+    def delete_queue(self, name, if_unused=False, if_empty=False):
+        with self.lock:
+            queue = self.queues.get(name)
+
+            if queue is None:
+                return dict(message_count=0)
+
+            if if_unused and queue.consumers:
+                raise AMQPChannelError(
+                    "PRECONDITION_FAILED - queue '%s' in use" % name)
+
+            if if_empty and queue.messages:
+                raise AMQPChannelError(
+                    "PRECONDITION_FAILED - queue '%s' not empty" % name)
+
+            del self.queues[name]
+
+            for exchange in self.exchanges.values():
+                exchange.unbind(name)
+
+            return dict(message_count=len(queue.messages))
+
+    def list_queues(self):
+        """Returns the queues like RabbitMQ's management API lists
+        them, as dicts with name, messages, consumers, exclusive,
+        auto_delete and arguments.
+        """
+
+        with self.lock:
+            return [dict(name=name,
+                         messages=len(queue.messages),
+                         consumers=len(queue.consumers),
+                         exclusive=queue.owner is not None,
+                         auto_delete=queue.auto_delete,
+                         arguments=dict(queue.arguments))
+                    for name, queue in self.queues.items()]
+
+    def queue(self, name):
+        queue = self.queues.get(name)
+
+        if queue is None:
+            raise AMQPChannelError("NOT_FOUND - no queue '%s'" % name)
+
+        return queue
+
+    def declare_exchange(self, name, exchange_type='direct'):
+        with self.lock:
+            if name not in self.exchanges:
+                self.exchanges[name] = MemoryExchange(name,
+                                                      exchange_type)
+
+    def bind(self, queue, exchange, routing_key=''):
+        with self.lock:
+            self.queue(queue)
+
+            if exchange not in self.exchanges:
+                raise AMQPChannelError("NOT_FOUND - no exchange '%s'" %
+                                       exchange)
+
+            self.exchanges[exchange].bind(queue, routing_key)
+
+    def route(self, exchange, routing_key):
+        """Returns the names of the queues a message is routed to.
+        """
+
+        if exchange == '':
+            return [routing_key] if routing_key in self.queues else []
+
+        if exchange not in self.exchanges:
+            raise AMQPChannelError("NOT_FOUND - no exchange '%s'" %
+                                   exchange)
+
+        return self.exchanges[exchange].route(routing_key)
+
+    def publish(self, body, routing_key, exchange, properties):
+        with self.lock:
+            self.counters['published'] += 1
+
+            for name in self.route(exchange, routing_key):
+                self.queues[name].put(body, dict(properties))
+                self.schedule(name)
+
+    def requeue(self, name, body, properties):
+        with self.lock:
+            queue = self.queues.get(name)
+
+            if queue is not None:
+                queue.messages.appendleft((body, properties, True))
+                self.schedule(name)
+
+    def get(self, channel, name, no_ack=False):
+        with self.lock:
+            queue = self.queue(name)
+
+            if not queue.messages:
+                return None
+
+            return channel.deliver(name, *queue.messages.popleft(),
+                                   no_ack=no_ack)
+
+    def consume(self, channel, name, callback, consumer_tag='',
+                no_ack=False):
+        with self.lock:
+            queue = self.queue(name)
+            tag = consumer_tag or 'ctag-%s' % uuid4()
+            queue.consumers.append(MemoryConsumer(tag, channel,
+                                                  callback, no_ack))
+            self.schedule(name)
+
+            return tag
+
+    def cancel(self, channel, tag):
+        with self.lock:
+            for name, queue in list(self.queues.items()):
+                consumers = [c for c in queue.consumers
+                             if c.tag != tag or c.channel is not channel]
+
+                if len(consumers) == len(queue.consumers):
+                    continue
+
+                queue.consumers = consumers
+
+                if queue.auto_delete and not consumers:
+                    self.delete_queue(name)
+
+    def schedule(self, name):
+        """Schedules delivery of a queue's messages in the event loop.
+        """
+
+        self.loop.call_soon_threadsafe(self.dispatch, name)
+
+    def dispatch(self, name):
+        """Delivers as many messages as the queue's consumers can take,
+        round-robin.
+        """
+
+        deliveries = []
+
+        with self.lock:
+            queue = self.queues.get(name)
+
+            while queue is not None and queue.messages:
+                consumer = queue.next_consumer()
+
+                if consumer is None:
+                    break
+
+                message = consumer.channel.deliver(
+                    name, *queue.messages.popleft(),
+                    no_ack=consumer.no_ack)
+                deliveries.append((consumer.callback, message))
+
+            self.counters['delivered'] += len(deliveries)
+
+        for callback, message in deliveries:
+            callback(message)
+
+
+class MemoryQueue:
+
+    def __init__(self, name, owner, auto_delete, arguments):
+        self.name = name
+        self.owner = owner
+        self.auto_delete = auto_delete
+        self.arguments = arguments
+        self.messages = deque()
+        self.consumers = []
+        self.__next = 0
+
+    def put(self, body, properties):
+        """Adds a message to the queue, ahead of the ones with lower
+        priority if it's a priority queue.
+        """
+
+        message = (body, properties, False)
+        max_priority = self.arguments.get('x-max-priority')
+
+        if max_priority is None:
+            self.messages.append(message)
+            return
+
+        def rank(properties):
+            return min(properties.get('priority') or 0, max_priority)
+
+        priority = rank(properties)
+        index = len(self.messages)
+
+        while index and rank(self.messages[index - 1][1]) < priority:
+            index -= 1
+
+        self.messages.insert(index, message)
+
+    def next_consumer(self):
+        """Returns the next consumer, round-robin, whose channel may take
+        another message, or None.
+        """
+
+        for i in range(len(self.consumers)):
+            consumer = self.consumers[(self.__next + i) %
+                                      len(self.consumers)]
+
+            if consumer.channel.ready:
+                self.__next = (self.__next + i + 1) % len(self.consumers)
+                return consumer
+
+        return None
+
+
+class MemoryExchange:
+
+    def __init__(self, name, exchange_type):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.bindings = set()
+
+    def bind(self, queue, routing_key):
+        self.bindings.add((queue, routing_key))
+
+    def unbind(self, queue):
+        self.bindings = set((q, k) for q, k in self.bindings
+                            if q != queue)
+
+    def route(self, routing_key):
+        return sorted(set(queue for queue, key in self.bindings
+                          if self.exchange_type == 'fanout' or
+                          key == routing_key))
+
+
+class MemoryConsumer:
+
+    def __init__(self, tag, channel, callback, no_ack):
+        self.tag = tag
+        self.channel = channel
+        self.callback = callback
+        self.no_ack = no_ack
+
+
+class MemoryConnection:
+    """An amqpstorm like connection to a memory broker.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.exclusive = set()
+        self.exceptions = []
+        self.is_open = True
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self, rpc_timeout=None):
+        self.check_for_errors()
+        self.broker.counters['round_trips'] += 1
+
+        channel = MemoryChannel(self)
+        self.channels.append(channel)
+
+        return channel
+
+    def check_for_errors(self):
+        if self.exceptions:
+            raise self.exceptions[0]
+
+        if not self.is_open:
+            raise AMQPConnectionError('connection closed')
+
+    def close(self):
+        if not self.is_open:
+            return
+
+        for channel in list(self.channels):
+            channel.close()
+
+        with self.broker.lock:
+            for name in self.exclusive:
+                self.broker.delete_queue(name)
+
+        self.is_open = False
+
+    def kill(self, error=None):
+        """Breaks the connection, as if the broker went away.
+        """
+
+        self.exceptions.append(error or
+                               AMQPConnectionError('connection lost'))
+        self.close()
+
+
+class MemoryChannel:
+    """An amqpstorm like channel to a memory broker.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.basic = MemoryBasic(self)
+        self.exchange = MemoryExchangeMethods(self)
+        self.queue = MemoryQueueMethods(self)
+        self.tx = MemoryTx(self)
+        self.prefetch = 0
+        self.unacked = {}
+        self.transaction = None
+        self.is_open = True
+        self.__tags = count(1)
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    @property
+    def ready(self):
+        """Whether the channel may take another unacknowledged message.
+        """
+
+        return self.is_open and (not self.prefetch or
+                                 len(self.unacked) < self.prefetch)
+
+    def check_for_errors(self):
+        self.connection.check_for_errors()
+
+        if not self.is_open:
+            raise AMQPChannelError('channel closed')
+
+    def rpc(self):
+        """Checks for errors and counts a method which would have been
+        a round trip to a real broker.
+        """
+
+        self.check_for_errors()
+        self.broker.counters['round_trips'] += 1
+
+    def deliver(self, queue, body, properties, redelivered, no_ack=False):
+        tag = next(self.__tags)
+        message = MemoryMessage(self, body, properties,
+                                dict(delivery_tag=tag,
+                                     redelivered=redelivered))
+
+        if not no_ack:
+            self.unacked[tag] = (queue, body, properties)
+
+        return message
+
+    def settle(self, tag, requeue=False, multiple=False):
+        with self.broker.lock:
+            if tag not in self.unacked:
+                raise AMQPChannelError(
+                    'PRECONDITION_FAILED - unknown delivery tag %s' % tag)
+
+            tags = sorted(t for t in self.unacked if t <= tag) \
+                if multiple else [tag]
+
+            for tag in tags:
+                queue, body, properties = self.unacked.pop(tag)
+
+                if requeue:
+                    self.broker.requeue(queue, body, properties)
+
+            for name, queue in self.broker.queues.items():
+                if any(c.channel is self for c in queue.consumers):
+                    self.broker.schedule(name)
+
+    def close(self, reply_code=200, reply_text=''):
+        if not self.is_open:
+            return
+
+        with self.broker.lock:
+            self.is_open = False
+
+            if self.connection.is_open:
+                self.broker.counters['round_trips'] += 1
+
+            for name, queue in list(self.broker.queues.items()):
+                for consumer in queue.consumers:
+                    if consumer.channel is self:
+                        self.broker.cancel(self, consumer.tag)
+
+            for tag in sorted(self.unacked, reverse=True):
+                queue, body, properties = self.unacked.pop(tag)
+                self.broker.requeue(queue, body, properties)
+
+        if self in self.connection.channels:
+            self.connection.channels.remove(self)
+
+
+class MemoryBasic:
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def qos(self, prefetch_count=0, prefetch_size=0, global_=False):
+        self.channel.rpc()
+        self.channel.prefetch = prefetch_count
+
+    def get(self, queue='', no_ack=False, to_dict=False,
+            auto_decode=True):
+        self.channel.rpc()
+
+        return self.channel.broker.get(self.channel, queue, no_ack)
+
+    def consume(self, callback=None, queue='', consumer_tag='',
+                exclusive=False, no_ack=False, no_local=False,
+                arguments=None):
+        self.channel.rpc()
+
+        return self.channel.broker.consume(self.channel, queue, callback,
+                                           consumer_tag, no_ack)
+
+    def cancel(self, consumer_tag=''):
+        self.channel.rpc()
+        self.channel.broker.cancel(self.channel, consumer_tag)
+
+    def publish(self, body, routing_key, exchange='', properties=None,
+                mandatory=False, immediate=False):
+        self.channel.check_for_errors()
+
+        args = (body, routing_key, exchange, properties or {})
+
+        if self.channel.transaction is not None:
+            self.channel.transaction.append(args)
+        else:
+            self.channel.broker.publish(*args)
+
+    def ack(self, delivery_tag=0, multiple=False):
+        self.channel.check_for_errors()
+        self.channel.settle(delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.channel.check_for_errors()
+        self.channel.settle(delivery_tag, requeue, multiple)
+
+    def reject(self, delivery_tag=0, requeue=True):
+        self.channel.check_for_errors()
+        self.channel.settle(delivery_tag, requeue)
+
+
+class MemoryQueueMethods:
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def declare(self, queue='', passive=False, durable=False,
+                exclusive=False, auto_delete=False, arguments=None):
+        self.channel.rpc()
+
+        if passive:
+            return dict(queue=queue,
+                        message_count=len(
+                            self.channel.broker.queue(queue).messages))
+
+        return self.channel.broker.declare_queue(self.channel, queue,
+                                                 exclusive, auto_delete,
+                                                 arguments)
+
+    def delete(self, queue='', if_unused=False, if_empty=False):
+        self.channel.rpc()
+
+        return self.channel.broker.delete_queue(queue, if_unused,
+                                                if_empty)
+
+    def purge(self, queue):
+        self.channel.rpc()
+
+        with self.channel.broker.lock:
+            messages = self.channel.broker.queue(queue).messages
+            message_count = len(messages)
+            messages.clear()
+
+        return dict(message_count=message_count)
+
+    def bind(self, queue='', exchange='', routing_key='',
+             arguments=None):
+        self.channel.rpc()
+        self.channel.broker.bind(queue, exchange, routing_key)
+
+
+class MemoryExchangeMethods:
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def declare(self, exchange='', exchange_type='direct',
+                passive=False, durable=False, auto_delete=False,
+                arguments=None):
+        self.channel.rpc()
+        self.channel.broker.declare_exchange(exchange, exchange_type)
+
+
+class MemoryTx:
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def select(self):
+        self.channel.rpc()
+        self.channel.transaction = []
+
+    def commit(self):
+        self.channel.rpc()
+
+        with self.channel.broker.lock:
+            for args in self.channel.transaction:
+                self.channel.broker.publish(*args)
+
+        self.channel.transaction = []
+
+    def rollback(self):
+        self.channel.rpc()
+        self.channel.transaction = []
+
+
+class MemoryMessage:
+    """An amqpstorm like message, for publishing or as delivered by a
+    memory broker.
+    """
+
+    def __init__(self, channel, body, properties=None, method=None):
+        self.channel = channel
+        self.body = body
+        self.properties = properties or {}
+        self.method = method or {}
+
+    @property
+    def content_type(self):
+        return self.properties.get('content_type')
+
+    @property
+    def correlation_id(self):
+        return self.properties.get('correlation_id')
+
+    @property
+    def message_id(self):
+        return self.properties.get('message_id')
+
+    @property
+    def app_id(self):
+        return self.properties.get('app_id')
+
+    @property
+    def message_type(self):
+        return self.properties.get('message_type')
+
+    @property
+    def priority(self):
+        return self.properties.get('priority')
+
+    @property
+    def delivery_tag(self):
+        return self.method.get('delivery_tag')
+
+    @property
+    def redelivered(self):
+        return self.method.get('redelivered')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def publish(self, routing_key, exchange='', mandatory=False,
+                immediate=False):
+        self.channel.basic.publish(self.body, routing_key, exchange,
+                                   self.properties)
+
+    def ack(self):
+        self.channel.basic.ack(self.delivery_tag)
+
+    def nack(self, requeue=True):
+        self.channel.basic.nack(self.delivery_tag, requeue=requeue)
+
+    def reject(self, requeue=True):
+        self.channel.basic.reject(self.delivery_tag, requeue=requeue)
@@ -6,42 +6,110 @@ Copyright (c) 2016 Olof Montin <olof@montin.net>
 This file is part of clique-connector.
 """
 
-import json
+import asyncio
 import logging
 
-from amqpstorm import Connection, \
-                      Message
+from amqpstorm import AMQPConnectionError, AMQPError
+from collections import deque
+from contextlib import contextmanager
 from functools import partial
-from hashlib import md5
+from itertools import count
 from os import uname
 from rx import Observable
 from rx.concurrency import AsyncIOScheduler
-from time import time
-from uuid import uuid1
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep, time
+from uuid import uuid1, uuid4
+from weakref import WeakKeyDictionary
+
+from .codec import JsonCodec, get_codec, md5_checksum
+from .delivery import Delivery
+from .dispatcher import ReplyDispatcher
+from .listener import Listener
+from .metrics import NullMetrics
+from .pool import ChannelPool
+from .transport import AmqpTransport
 
 
 class Messenger:
     """Wraps a RabbitMQ connection through the amqpstorm library
     (https://github.com/eandersson/amqpstorm) and creates command,
-    status and unique response queues for both publishing and listening.
+    status and response queues for both publishing and listening.
 
-    The command queue is like a round-robin task/job queue. Used for
-    sending tasks to agents.
+    Commands are published to a direct exchange with the command as
+    routing key, which routes them to a queue per command. Each command
+    queue is like a round-robin task/job queue, used for sending tasks
+    to agents. Listeners only get the commands they listen to.
 
     The status queue is rather an exchange with type fanout, which goes
-    out to all listeners. It's used for logging statistics.
+    out to all listeners. It's used for logging statistics. Commands
+    for every messenger, like machine lifecycle commands, are broadcast
+    the same way through a broadcast exchange.
+
+    Every messenger owns a single exclusive and auto-deleted reply
+    queue. Responses are published to the reply queue of the messenger
+    which sent the original message, with the original message's
+    checksum as correlation id, and are routed to their listeners by a
+    reply dispatcher.
 
     All listeners uses Reactive X Observables (http://reactivex.io).
+    By default listeners are consumers which gets messages pushed from
+    RabbitMQ as they arrive. Set consume to False to fall back on
+    polling the queues by interval.
+
+    Message bodies are encoded by a codec, json by default, and
+    checksummed by a checksum function, md5 by default. See the codec
+    module for faster ones. Received messages are wrapped as
+    deliveries which decode their bodies at most once.
+
+    The host may be a list of RabbitMQ cluster nodes, or a comma
+    separated string of them. The messenger opens as many connections
+    as the connections option says, spread over the nodes, and new
+    channels for publishing and listening take turns between the
+    healthy ones.
+
+    Connections are watched by a health check, backed by AMQP
+    heartbeats. If a connection is lost, its listeners are moved to a
+    healthy connection, if there is one, and it reconnects with an
+    exponential backoff, failing over to the next node when its own
+    can't be reached. Publishes are buffered while no connection is
+    healthy, up to publish_buffer messages.
+
+    Set max_priority to declare command queues as priority queues, see
+    https://www.rabbitmq.com/priority.html, so that commands published
+    with a higher priority, up to max_priority, are taken first. Every
+    messenger of a cluster has to agree on it, as RabbitMQ refuses to
+    redeclare a queue with other arguments. Delete the command queues to
+    change it.
+
+    Reply queues are exclusive and auto-deleted, so they go away with
+    their messenger's connection. Set reply_ttl to have RabbitMQ drop
+    replies which haven't been consumed in that many seconds. See the
+    sweeper module for reply queues left behind by earlier versions.
+
+    Creating a messenger has no side effects, it connects when first
+    used. Start it to connect and announce it's online up front.
+
+    The broker is reached through a transport, RabbitMQ by default. See
+    the memory module for an in-process broker.
+
+    Publishes, consumed messages and encode and decode times are
+    reported to a metrics sink, which drops them by default. See the
+    metrics module.
 
     Use like so:
         messenger = Messenger('127.0.0.1')
 
+        # Connect and publish an online status
+        await messenger.start()
+
         # Publish a command
         checksum_of_command = messenger.publish_command('some-command',
                                                         key='value')
 
         # Listen for commands
-        channel_close, observable = messenger.get_command_listener()
+        channel_close, observable = messenger.get_command_listener(
+            'some-command')
 
         # Get first command and close channel
         command = await observable \
@@ -66,21 +134,71 @@ class Messenger:
         response = await observable \
                          .first() \
                          .tap(lambda _: channel_close())
+
+        # Or just wait for it, 5 seconds at the most
+        response = await messenger.wait_for_response(
+            checksum_of_command, 5)
     """
 
     LISTENER_INTERVAL = 100
-    COMMAND_QUEUE_NAME = 'clique-command'
-    RESPONSE_QUEUE_NAME = 'clique-response-%s-%s'
+    COMMAND_EXCHANGE_NAME = 'clique-commands'
+    COMMAND_QUEUE_NAME = 'clique-command-%s'
+    RESPONSE_QUEUE_NAME = 'clique-response-%s'
     STATUS_EXCHANGE_NAME = 'clique-status'
     STATUS_QUEUE_NAME = 'clique-status-%s'
-
-    def __init__(self, host):
-        self.host = host
+    BROADCAST_EXCHANGE_NAME = 'clique-broadcast'
+    BROADCAST_QUEUE_NAME = 'clique-broadcast-%s'
+    CONNECTIONS = 1
+    PUBLISH_CHANNELS = 4
+    PUBLISH_BUFFER = 1000
+    HEARTBEAT = 10
+    HEALTH_INTERVAL = 1
+    RECONNECT_DELAY = 0.1
+    RECONNECT_MAX_DELAY = 5
+
+    def __init__(self, host, consume=True,
+                 publish_channels=PUBLISH_CHANNELS,
+                 codec=None, checksum=md5_checksum,
+                 heartbeat=HEARTBEAT,
+                 publish_buffer=PUBLISH_BUFFER,
+                 transport=None,
+                 metrics=None,
+                 connections=CONNECTIONS,
+                 username='guest',
+                 password='guest',
+                 max_priority=None,
+                 reply_ttl=None):
+        self.hosts = host.split(',') if isinstance(host, str) \
+            else list(host)
+        self.host = self.hosts[0]
+        self.transport = transport or AmqpTransport(username, password)
+        self.connections = connections
+        self.consume = consume
+        self.publish_channels = publish_channels
+        self.heartbeat = heartbeat
+        self.publish_buffer = publish_buffer
+        self.codec = codec or JsonCodec()
+        self.checksum = checksum
+        self.metrics = metrics or NullMetrics()
+        self.max_priority = max_priority
+        self.reply_ttl = reply_ttl
+        self.__codecs = {self.codec.content_type: self.codec}
         self.__uuid = None
-        self.__connection = None
-        self.__channel = None
-
-        self.publish_online()
+        self.__connections = [None] * connections
+        self.__connect_lock = Lock()
+        self.__failovers = [0] * connections
+        self.__turns = count()
+        self.__owners = WeakKeyDictionary()
+        self.__publish_pool = None
+        self.__confirm_pool = None
+        self.__declared = WeakKeyDictionary()
+        self.__dispatcher = None
+        self.__replies = None
+        self.__listeners = set()
+        self.__listeners_lock = Lock()
+        self.__outbox = deque()
+        self.__unhealthy = Event()
+        self.__closed = False
 
     @property
     def uuid(self):
@@ -92,26 +210,368 @@ class Messenger:
 
         return self.__uuid
 
+    async def start(self):
+        """Connects in the event loop's default executor, without
+        blocking the loop, then sets up the reply queue while publishing
+        the online status.
+        Returns the online message's checksum.
+        """
+
+        loop = asyncio.get_event_loop()
+
+        await loop.run_in_executor(None, lambda: self.connection)
+
+        checksum, _ = await asyncio.gather(
+            loop.run_in_executor(None, self.publish_online),
+            loop.run_in_executor(None, lambda: self.dispatcher))
+
+        return checksum
+
     @property
     def connection(self):
-        """Sets and returns a RabbitMQ connection.
+        """Sets and returns a RabbitMQ connection, the next healthy one
+        of the messenger's connections in turn, and starts watching
+        their health. Connections are only made when first used.
+        Raises AMQPConnectionError while all of them reconnect.
+        """
+
+        if self.__connections[0] is None:
+            with self.__connect_lock:
+                if self.__connections[0] is None:
+                    connections = [self.connect(slot)
+                                   for slot in range(self.connections)]
+                    self.__connections[:] = connections
+
+                    Thread(target=self.watch, daemon=True).start()
+
+        start = next(self.__turns)
+
+        for turn in range(self.connections):
+            connection = self.__connections[(start + turn) %
+                                            self.connections]
+
+            if not connection.exceptions:
+                return connection
+
+        self.__unhealthy.set()
+
+        raise AMQPConnectionError('Reconnecting to AMQP: %s' %
+                                  ', '.join(self.hosts))
+
+    def channel(self):
+        """Opens a channel on the next healthy connection.
+        """
+
+        connection = self.connection
+        channel = connection.channel()
+        self.__owners[channel] = connection
+
+        return channel
+
+    def connect(self, slot=0):
+        """Creates a new connection through the transport for provided
+        connection slot. Slots are spread over the hosts, and fail over
+        to the next host when theirs can't be reached.
+        Raises the last error if no host could be reached.
+        """
+
+        for _ in self.hosts:
+            host = self.hosts[(slot + self.__failovers[slot]) %
+                              len(self.hosts)]
+
+            try:
+                return self.transport.connect(host, self.heartbeat)
+            except AMQPError as error:
+                logging.warning('Could not connect to AMQP %s: %s',
+                                host, error)
+                self.__failovers[slot] += 1
+                failure = error
+
+        raise failure
+
+    def watch(self):
+        """Checks the health of the connections every HEALTH_INTERVAL
+        seconds, or when told one is unhealthy, and reconnects the ones
+        which were lost. Stops when the messenger or all connections are
+        closed on purpose.
+        """
+
+        while not self.__closed:
+            self.__unhealthy.wait(self.HEALTH_INTERVAL)
+            self.__unhealthy.clear()
+
+            connections = list(self.__connections)
+
+            if self.__closed or None in connections:
+                return
+
+            if all(c.is_closed and not c.exceptions
+                   for c in connections):
+                logging.debug('Connections closed, stops watching')
+                return
+
+            for slot, connection in enumerate(connections):
+                if connection.exceptions:
+                    self.reconnect(slot)
+
+    def reconnect(self, slot=0):
+        """Reconnects provided connection slot with an exponential
+        backoff until it succeeds or the messenger is closed. The
+        listeners of the lost connection are moved to a healthy one
+        right away, if there is one, and restarted after reconnecting
+        otherwise. Then publishes what was buffered meanwhile.
+        """
+
+        lost = self.__connections[slot]
+
+        logging.warning('Lost connection to AMQP: %s',
+                        lost.exceptions[0])
+
+        for pool in (self.__publish_pool, self.__confirm_pool):
+            if pool is not None:
+                pool.close()
+
+        self.__publish_pool = None
+        self.__confirm_pool = None
+
+        self.restart(lost)
+
+        delay = self.RECONNECT_DELAY
+
+        while not self.__closed:
+            try:
+                connection = self.connect(slot)
+                break
+            except AMQPError as error:
+                logging.warning('Reconnect to AMQP failed, retrying in '
+                                '%.1f s: %s', delay, error)
+                sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+        else:
+            return
+
+        self.__connections[slot] = connection
+
+        self.restart(lost)
+        self.flush()
+
+    def restart(self, lost):
+        """Restarts the listeners which were on provided lost
+        connection. Listeners which can't be restarted while reconnecting
+        are left for later.
+        """
+
+        with self.__listeners_lock:
+            listeners = [listener for listener in self.__listeners
+                         if self.__owners.get(listener.channel) is lost]
+
+        for listener in listeners:
+            try:
+                listener.restart()
+            except AMQPConnectionError as error:
+                logging.debug('Listener waits for reconnect: %s', error)
+            except AMQPError as error:
+                logging.error('Could not restart listener: %s', error)
+                listener.fail(error)
+
+    def register(self, listener):
+        """Registers a listener to be restarted after reconnecting.
         """
 
-        if self.__connection is None:
-            logging.debug('Connect to AMQP: %s', self.host)
-            self.__connection = Connection(self.host, 'guest', 'guest')
+        with self.__listeners_lock:
+            self.__listeners.add(listener)
 
-        return self.__connection
+    def unregister(self, listener):
+        """Unregisters a closed listener.
+        """
+
+        with self.__listeners_lock:
+            self.__listeners.discard(listener)
+
+    @property
+    def publish_pool(self):
+        """Sets and returns a pool of long-lived publish channels.
+        """
+
+        if self.__publish_pool is None:
+            self.__publish_pool = ChannelPool(
+                self.channel,
+                self.publish_channels)
+
+        return self.__publish_pool
+
+    @property
+    def confirm_pool(self):
+        """Sets and returns a pool of long-lived transactional publish
+        channels, used for publishing confirmed batches.
+        """
+
+        def channel():
+            channel = self.channel()
+            channel.tx.select()
+
+            return channel
 
-    def command_queue(self, channel):
-        """Declares a command queue in provided channel.
-        Returns a dict with a routing_key.
-        Can be used by both publishing and listening.
+        if self.__confirm_pool is None:
+            self.__confirm_pool = ChannelPool(channel,
+                                              self.publish_channels)
+
+        return self.__confirm_pool
+
+    @property
+    def dispatcher(self):
+        """Sets and returns the reply dispatcher, which gets its
+        messages from this messenger's reply queue.
         """
 
-        channel.queue.declare(self.COMMAND_QUEUE_NAME)
+        if self.__dispatcher is None:
+            dispatcher = ReplyDispatcher()
+            replies = Listener(self, self.reply_queue, 0)
+            replies.start(dispatcher.dispatch)
+
+            self.__replies = replies
+            self.__dispatcher = dispatcher
 
-        return dict(routing_key=self.COMMAND_QUEUE_NAME)
+        return self.__dispatcher
+
+    def ensure_reply_queue(self):
+        """Makes sure this messenger's reply queue is there, and
+        listened to, to receive responses before publishing something
+        to be responded to.
+        """
+
+        return self.dispatcher
+
+    def close(self):
+        """Closes the reply and publish channels and the RabbitMQ
+        connection.
+        """
+
+        self.__closed = True
+        self.__unhealthy.set()
+
+        if self.__replies is not None:
+            self.__replies.close()
+            self.__replies = None
+            self.__dispatcher = None
+
+        for pool in (self.__publish_pool, self.__confirm_pool):
+            if pool is not None:
+                pool.close()
+
+        self.__publish_pool = None
+        self.__confirm_pool = None
+
+        for slot, connection in enumerate(self.__connections):
+            if connection is not None:
+                connection.close()
+
+            self.__connections[slot] = None
+
+    def declare_once(self, channel, name, declare):
+        """Calls provided declare function unless a queue or an
+        exchange by provided name has already been declared in
+        provided channel.
+        """
+
+        declared = self.__declared.setdefault(channel, set())
+
+        if name not in declared:
+            declare()
+            declared.add(name)
+
+    def command_routing_key(self, command, target=None):
+        """Returns the routing key for provided command, or for provided
+        command to a single target messenger by its uuid.
+        """
+
+        if target is None:
+            return command
+
+        return '%s.%s' % (command, target)
+
+    def declare_command(self, command, channel, target=None):
+        """Declares the command exchange and a queue for provided
+        command bound to it in provided channel. A queue for a target
+        is exclusive to that target's messenger. Queues are priority
+        queues if the messenger has a max priority.
+        Returns the name of the queue.
+        """
+
+        routing_key = self.command_routing_key(command, target)
+        name = self.COMMAND_QUEUE_NAME % routing_key
+
+        def declare():
+            logging.debug('Declaring command queue: %s', name)
+
+            self.declare_command_exchange(channel)
+            channel.queue.declare(name,
+                                  exclusive=target is not None,
+                                  auto_delete=target is not None,
+                                  arguments=self.command_arguments())
+            channel.queue.bind(queue=name,
+                               exchange=self.COMMAND_EXCHANGE_NAME,
+                               routing_key=routing_key)
+
+        self.declare_once(channel, name, declare)
+
+        return name
+
+    def command_arguments(self):
+        """Returns the arguments command queues are declared with.
+        """
+
+        if self.max_priority is None:
+            return None
+
+        return {'x-max-priority': self.max_priority}
+
+    def command_properties(self, priority=None):
+        """Returns the properties commands are published with.
+        """
+
+        if priority is None:
+            return None
+
+        return dict(priority=priority)
+
+    def declare_command_exchange(self, channel):
+        """Declares the command exchange in provided channel.
+        """
+
+        self.declare_once(channel,
+                          self.COMMAND_EXCHANGE_NAME,
+                          partial(channel.exchange.declare,
+                                  exchange=self.COMMAND_EXCHANGE_NAME,
+                                  exchange_type='direct'))
+
+    def command_exchange(self, command, channel, target=None):
+        """Declares the command exchange and the queue for provided
+        command in provided channel, so that commands are kept until
+        someone listens to them. A command to a target is only routed
+        to the target's own queue, which is declared by the target.
+        Returns a dict with exchange and routing_key.
+        Can only be used when publishing.
+        """
+
+        if target is None:
+            self.declare_command(command, channel)
+        else:
+            self.declare_command_exchange(channel)
+
+        return dict(exchange=self.COMMAND_EXCHANGE_NAME,
+                    routing_key=self.command_routing_key(command,
+                                                         target))
+
+    def command_queue(self, command, channel, target=None):
+        """Declares the queue for provided command, optionally for
+        provided target only, in provided channel.
+        Returns a dict with queue.
+        Can only be used for listening.
+        """
+
+        return dict(queue=self.declare_command(command, channel,
+                                               target))
 
     def status_exchange(self, channel):
         """Declares a status exchange in provided channel.
@@ -119,82 +579,266 @@ class Messenger:
         Can only be used when publishing.
         """
 
-        logging.debug('Declaring status exchange: %s',
-                      self.STATUS_EXCHANGE_NAME)
+        def declare():
+            logging.debug('Declaring status exchange: %s',
+                          self.STATUS_EXCHANGE_NAME)
+
+            channel.exchange.declare(exchange=self.STATUS_EXCHANGE_NAME,
+                                     exchange_type='fanout')
 
-        channel.exchange.declare(exchange=self.STATUS_EXCHANGE_NAME,
-                                 exchange_type='fanout')
+        self.declare_once(channel, self.STATUS_EXCHANGE_NAME, declare)
 
         return dict(exchange=self.STATUS_EXCHANGE_NAME,
                     routing_key='')
 
     def status_queue(self, channel):
         """Declaring a unique status queue binded to the status
-        exchange in provided channel.
+        exchange in provided channel. Every status listener gets a
+        queue of its own, so that each of them gets every status.
         Returns a dict with queue.
         Can only be used for listening.
         """
 
-        name = self.STATUS_QUEUE_NAME % self.uuid
+        name = self.STATUS_QUEUE_NAME % ('%s-%s' % (self.uuid,
+                                                    uuid4().hex[:8]))
         logging.debug('Declaring status queue: %s', name)
 
         channel.queue.declare(name,
-                              exclusive=True)
+                              exclusive=True,
+                              auto_delete=True)
         channel.queue.bind(queue=name,
                            **(self.status_exchange(channel)))
 
         return dict(queue=name)
 
-    def response_queue(self, uuid, checksum, channel):
-        """Declares a unique response queue in provided channel based
-        on uuid and checksum.
-        Returns a dict with routing_key.
-        Can be used by both publishing and listening.
+    def broadcast_exchange(self, channel):
+        """Declares the broadcast exchange in provided channel.
+        Returns a dict with exchange and routing_key.
+        Can only be used when publishing.
+        """
+
+        self.declare_once(channel,
+                          self.BROADCAST_EXCHANGE_NAME,
+                          partial(channel.exchange.declare,
+                                  exchange=self.BROADCAST_EXCHANGE_NAME,
+                                  exchange_type='fanout'))
+
+        return dict(exchange=self.BROADCAST_EXCHANGE_NAME,
+                    routing_key='')
+
+    def broadcast_queue(self, channel):
+        """Declares this messenger's exclusive and auto-deleted
+        broadcast queue, bound to the broadcast exchange, in provided
+        channel.
+        Returns a dict with queue.
+        Can only be used for listening.
+        """
+
+        name = self.BROADCAST_QUEUE_NAME % self.uuid
+
+        logging.debug('Declaring broadcast queue: %s', name)
+
+        channel.queue.declare(name,
+                              exclusive=True,
+                              auto_delete=True)
+        channel.queue.bind(queue=name,
+                           **(self.broadcast_exchange(channel)))
+
+        return dict(queue=name)
+
+    def reply_queue(self, channel):
+        """Declares this messenger's exclusive and auto-deleted reply
+        queue in provided channel.
+        Returns a dict with queue.
+        Can only be used for listening.
+        """
+
+        name = self.RESPONSE_QUEUE_NAME % self.uuid
+
+        logging.debug('Declaring reply queue: %s', name)
+
+        channel.queue.declare(name,
+                              exclusive=True,
+                              auto_delete=True,
+                              arguments=self.reply_arguments())
+
+        return dict(queue=name)
+
+    def reply_arguments(self):
+        """Returns the arguments the reply queue is declared with, its
+        message TTL in milliseconds.
         """
 
-        name = self.RESPONSE_QUEUE_NAME % (uuid, checksum)
-        logging.debug('Declaring response queue: %s', name)
+        if self.reply_ttl is None:
+            return None
+
+        return {'x-message-ttl': int(self.reply_ttl * 1000)}
 
-        channel.queue.declare(name)
+    def response_queue(self, uuid, channel):
+        """Returns a dict with routing_key to the reply queue of the
+        messenger by provided uuid. The reply queue is declared by its
+        owner, so nothing is declared in provided channel.
+        Can only be used when publishing.
+        """
 
-        return dict(routing_key=name)
+        return dict(routing_key=self.RESPONSE_QUEUE_NAME % uuid)
 
     def encode_message(self, **kwargs):
-        """Adds the messenger's uuid, time and the body's checksum
-        to the message and encodes it to json.
+        """Adds the messenger's uuid and time to the message, encodes
+        it by the messenger's codec and checksums the encoded body.
         The message's body is set by keywork arguments.
-        Returns the message checksum and the message body as a json
-        string.
+        Returns the message checksum and the encoded message body.
         """
 
-        props = dict(uuid=self.uuid,
-                     time=time(),
-                     **kwargs)
-        checksum = md5(json.dumps(props).encode('utf8')).hexdigest()
-        props['checksum'] = checksum
+        if not self.metrics.enabled:
+            body = self.codec.dumps(dict(uuid=self.uuid,
+                                         time=time(),
+                                         **kwargs))
 
-        return checksum, json.dumps(props)
+            return self.checksum(body), body
 
-    def publish(self, contents, publish_args_generator):
+        started = perf_counter()
+        body = self.codec.dumps(dict(uuid=self.uuid,
+                                     time=time(),
+                                     **kwargs))
+        checksum = self.checksum(body)
+        self.metrics.observe('encode_seconds', perf_counter() - started)
+
+        return checksum, body
+
+    def decode(self, message):
+        """Wraps a received message as a delivery which decodes the
+        message's body by the codec for its content type.
+        """
+
+        content_type = message.content_type
+
+        if content_type not in self.__codecs:
+            self.__codecs[content_type] = get_codec(content_type)
+
+        return Delivery(message, self.__codecs[content_type],
+                        self.metrics)
+
+    def encode_messages(self, messages):
+        """Encodes a list of (contents, publish_args_generator,
+        properties) message tuples in one go.
+        Returns a list of (checksum, body, publish_args_generator,
+        properties) tuples.
+        """
+
+        return [self.encode_message(**contents) +
+                (publish_args_generator, properties)
+                for contents, publish_args_generator, properties
+                in messages]
+
+    def publish(self, contents, publish_args_generator,
+                properties=None):
         """Publish a message to the RabbitMQ connection with a
-        temporary channel created for just this task.
+        long-lived channel borrowed from the publish pool.
         Message contents provided as a dict and a publish message
-        argument generator as a function callback.
+        argument generator as a function callback. Additional message
+        properties can be provided as a dict.
         Returns a checksum of the message body.
         """
-        channel = self.connection.channel()
-        checksum, body = self.encode_message(**contents)
 
-        logging.debug('Publish message: %s', body)
+        return self.publish_many([(contents,
+                                   publish_args_generator,
+                                   properties)])[0]
+
+    def publish_many(self, messages, confirm=False):
+        """Publish a list of (contents, publish_args_generator,
+        properties) message tuples, see publish, on a single channel.
+        If confirm is set, the messages are published in a transaction
+        and this returns when the broker has taken all of them, or
+        raises if it didn't. Otherwise the messages are buffered if the
+        connection is down, until reconnected.
+        Returns a list of the messages' checksums.
+        """
 
-        message = Message.create(channel,
-                                 body,
-                                 {'content_type': 'application/json'})
-        message.publish(**publish_args_generator(channel))
+        encoded = self.encode_messages(messages)
 
-        channel.close()
+        try:
+            self.publish_encoded(encoded, confirm)
+        except AMQPConnectionError as error:
+            if confirm or \
+                    len(self.__outbox) + len(encoded) > self.publish_buffer:
+                raise
 
-        return checksum
+            logging.warning('Buffering %d messages: %s',
+                            len(encoded), error)
+            self.__outbox.extend(encoded)
+            self.metrics.increment('messages_buffered', len(encoded))
+
+        return [checksum for checksum, _, _, _ in encoded]
+
+    def publish_encoded(self, encoded, confirm=False):
+        """Publish a list of encoded messages, see encode_messages, on a
+        single channel.
+        """
+
+        pool = self.confirm_pool if confirm else self.publish_pool
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+        with pool.channel() as channel:
+            for checksum, body, publish_args_generator, properties \
+                    in encoded:
+                if debug:
+                    logging.debug('Publish message: %s', checksum)
+
+                message = self.transport.message(
+                    channel,
+                    body,
+                    dict(content_type=self.codec.content_type,
+                         message_id=checksum,
+                         app_id=self.uuid,
+                         **(properties or {})))
+                message.publish(**publish_args_generator(channel))
+
+            if confirm:
+                channel.tx.commit()
+
+        self.metrics.increment('messages_published', len(encoded))
+
+    def flush(self):
+        """Publish messages buffered while the connection was down.
+        They are put back if the connection is lost again.
+        """
+
+        if not self.__outbox:
+            return
+
+        encoded = [self.__outbox.popleft()
+                   for _ in range(len(self.__outbox))]
+
+        logging.debug('Publish %d buffered messages', len(encoded))
+
+        try:
+            self.publish_encoded(encoded)
+        except AMQPConnectionError as error:
+            logging.warning('Could not publish buffered messages: %s',
+                            error)
+            self.__outbox.extendleft(reversed(encoded))
+
+    @contextmanager
+    def batch(self, confirm=False):
+        """Collects messages published through the returned batch and
+        publishes all of them at once with publish_many when the with
+        statement ends. The checksums are found in the batch's
+        checksums list afterwards.
+
+        Use like so:
+            with messenger.batch(confirm=True) as batch:
+                for name in names:
+                    batch.publish_command('some-command', name=name)
+
+            checksums = batch.checksums
+        """
+
+        batch = Batch(self)
+
+        yield batch
+
+        batch.checksums = self.publish_many(batch.messages, confirm)
 
     def publish_online(self):
         """Publish a statistics message about this messenger in the
@@ -204,22 +848,50 @@ class Messenger:
 
         return self.publish_stats(uname=uname())
 
-    def publish_command(self, command, **kwargs):
-        """Publish a command to the command queue and returns the
-        message's checksum.
+    def publish_command(self, command, target=None, priority=None,
+                        **kwargs):
+        """Publish a command to the command queue, or to the queue of a
+        single target messenger by its uuid, and returns the message's
+        checksum. Makes sure the reply queue is there to receive
+        responses before publishing. Priority only matters if the
+        command queues are priority queues, see max_priority.
         """
 
+        self.ensure_reply_queue()
+
         return self.publish(dict(command=command, **kwargs),
-                            self.command_queue)
+                            partial(self.command_exchange,
+                                    command,
+                                    target=target),
+                            self.command_properties(priority))
+
+    def publish_response(self, uuid, checksum, message_type=None,
+                         **kwargs):
+        """Publish a response by uuid and checksum to the reply queue
+        of the messenger by provided uuid and returns with the message's
+        checksum. The message type, if provided, is sent as the AMQP
+        type property. Responses may be responded to as well, so the
+        reply queue is made sure to be there before publishing.
+        """
+
+        self.ensure_reply_queue()
 
-    def publish_response(self, uuid, checksum, **kwargs):
-        """Publish a response by uuid and checksum to the unique
-        response queue and returns with the message's checksum.
+        return self.publish(kwargs,
+                            partial(self.response_queue, uuid),
+                            self.response_properties(checksum,
+                                                     message_type))
+
+    def response_properties(self, checksum, message_type=None):
+        """Returns the properties of a response by checksum, with
+        provided message type if any.
         """
 
-        return self.publish(kwargs, partial(self.response_queue,
-                                            uuid,
-                                            checksum))
+        properties = dict(correlation_id=checksum)
+
+        if message_type is not None:
+            properties['message_type'] = message_type
+
+        return properties
 
     def publish_stats(self, **stats):
         """Publish statistics in the statistics exchange and returns
@@ -228,61 +900,301 @@ class Messenger:
 
         return self.publish(stats, self.status_exchange)
 
+    def publish_broadcast(self, command, **kwargs):
+        """Publish a command to every messenger listening to the
+        broadcast exchange and returns the message's checksum. Makes
+        sure the reply queue is there to receive responses before
+        publishing.
+        """
+
+        self.ensure_reply_queue()
+
+        return self.publish(dict(command=command, **kwargs),
+                            self.broadcast_exchange)
+
     def get_listener(self, listen_args_generator,
-                     scheduler=AsyncIOScheduler()):
-        """Get a listener as an observable that fetches messages
-        by interval by provided queue argument generator callback.
-        Creates a new channel for this purpose.
+                     scheduler=AsyncIOScheduler(), prefetch=1):
+        """Get a listener as an observable by provided queue argument
+        generator callback. Depending on the messenger's consume setting
+        it's either a consumer or a poller. Prefetch sets how many
+        unacknowledged messages the listener may hold at a time.
         Returns the channel's close function and the observable.
         """
 
-        channel = self.connection.channel()
+        if self.consume:
+            return self.get_consumer(listen_args_generator, scheduler,
+                                     prefetch)
+
+        return self.get_poller(listen_args_generator, scheduler,
+                               prefetch)
+
+    def listener_channel(self, listen_args_generator, prefetch=1):
+        """Creates a new channel for listening and declares the queue
+        by provided queue argument generator callback.
+        Returns the channel and the queue arguments.
+        """
+
+        channel = self.channel()
         queue = listen_args_generator(channel)
 
-        # Take one message at a time. This setting will force the client
-        # to acknoledge the message before it will be able to recieve
-        # another one.
-        channel.basic.qos(1)
+        # Take prefetch messages at a time, one by default. This setting
+        # will force the client to acknoledge a message before it will
+        # be able to recieve another one beyond that.
+        channel.basic.qos(prefetch)
 
         if 'routing_key' in queue:
             queue = dict(queue=queue['routing_key'])
 
+        return channel, queue
+
+    def get_consumer(self, listen_args_generator,
+                     scheduler=AsyncIOScheduler(), prefetch=1):
+        """Get a listener as an observable which gets messages pushed
+        from RabbitMQ by provided queue argument generator callback.
+        Creates a new channel for this purpose and starts consuming
+        when subscribed to.
+        Returns the channel's close function and the observable.
+        """
+
+        listener = Listener(self, listen_args_generator, prefetch)
+
+        def subscribe(observer):
+            """Hands each message over to the scheduler's event loop.
+            """
+
+            def on_message(message):
+                scheduler.loop.call_soon_threadsafe(observer.on_next,
+                                                    message)
+
+            def on_error(error):
+                scheduler.loop.call_soon_threadsafe(observer.on_error,
+                                                    error)
+
+            listener.start(on_message, on_error)
+
+            return listener.cancel
+
+        return listener.close, Observable.create(subscribe)
+
+    def start_consumer(self, channel, queue, on_message,
+                       on_error=None):
+        """Starts consuming provided queue in provided channel through
+        the transport, which calls on_message with each message as a
+        delivery. Errors are passed on to on_error unless the channel
+        was closed on purpose, or the connection was lost and is about
+        to be reconnected.
+        Returns the consumer tag.
+        """
+
+        metrics = self.metrics
+
+        def on_consumer_message(message):
+            metrics.increment('messages_consumed')
+            on_message(self.decode(message))
+
+        def on_consumer_error(error):
+            if isinstance(error, AMQPConnectionError):
+                logging.debug('Consumer lost connection: %s', error)
+                self.__unhealthy.set()
+            else:
+                logging.debug('Consumer stopped: %s', error)
+
+                if on_error is not None and not channel.is_closed:
+                    on_error(error)
+
+        return self.transport.consume(
+            channel,
+            queue,
+            on_consumer_message,
+            on_consumer_error)
+
+    def get_poller(self, listen_args_generator,
+                   scheduler=AsyncIOScheduler(), prefetch=1):
+        """Get a listener as an observable that fetches messages
+        by interval by provided queue argument generator callback.
+        Creates a new channel for this purpose.
+        Returns the channel's close function and the observable.
+        """
+
+        listener = Listener(self, listen_args_generator, prefetch)
+
         # Creates a non-blocking interval based asyncio observable.
         # It has to be an interval for the non-blocking purpose.
         # The asyncio scheduler is necessary for the awaitables.
         observable = Observable.interval(self.LISTENER_INTERVAL,
                                          scheduler=scheduler) \
-            .map(lambda _: channel.basic.get(**queue)) \
+            .map(lambda _: listener.get()) \
             .where(lambda m: m is not None) \
-            .tap(lambda m: logging.debug('Got message %s', m.body))
+            .tap(lambda _: self.metrics.increment('messages_consumed'))
 
-        return channel.close, observable
+        return listener.close, observable
 
-    def get_status_listener(self, scheduler=AsyncIOScheduler()):
+    def get_status_listener(self, scheduler=AsyncIOScheduler(),
+                            prefetch=1):
         """Gets a status exchange listener and returns the channel's
-        close function and an observable.
+        close function and an observable. Raise prefetch to take on
+        statuses in batches, see Connector.listen_for_stats.
         """
 
         logging.debug('Listens to status')
-        return self.get_listener(self.status_queue, scheduler)
+        return self.get_listener(self.status_queue, scheduler, prefetch)
+
+    def get_command_listener(self, command,
+                             scheduler=AsyncIOScheduler(),
+                             prefetch=1,
+                             target=None):
+        """Gets a listener for provided command's queue and returns the
+        channel's close function and an observable. Set target to this
+        messenger's uuid to listen for commands to this messenger only.
+        """
 
-    def get_command_listener(self, scheduler=AsyncIOScheduler()):
-        """Gets a command queue listener and returns the channel's
-        close function and an observable.
+        logging.debug('Listens to %s commands', command)
+        return self.get_listener(partial(self.command_queue,
+                                         command,
+                                         target=target),
+                                 scheduler,
+                                 prefetch)
+
+    def get_broadcast_listener(self, scheduler=AsyncIOScheduler(),
+                               prefetch=1):
+        """Gets a listener for broadcast commands and returns the
+        channel's close function and an observable.
         """
 
-        logging.debug('Listens to commands')
-        return self.get_listener(self.command_queue, scheduler)
+        logging.debug('Listens to broadcasts')
+        return self.get_listener(self.broadcast_queue, scheduler,
+                                 prefetch)
 
     def get_response_listener(self, checksum,
                               scheduler=AsyncIOScheduler()):
-        """Gets a response queue listener based on this messenger's uuid
-        and provided checksum.
-        Returns the channel's close function and an observable.
+        """Gets a listener for responses to provided checksum from this
+        messenger's reply queue.
+        Returns the listener's close function and an observable.
         """
 
         logging.debug('Listens to responses for %s', checksum)
-        return self.get_listener(partial(self.response_queue,
-                                         self.uuid,
-                                         checksum),
-                                 scheduler)
+
+        dispatcher = self.dispatcher
+
+        def subscribe(observer):
+            return dispatcher.subscribe(
+                checksum,
+                lambda m: scheduler.loop.call_soon_threadsafe(
+                    observer.on_next, m))
+
+        return partial(dispatcher.unsubscribe, checksum), \
+            Observable.create(subscribe)
+
+    async def wait_for_response(self, checksum, timeout):
+        """Waits for the first response to provided checksum from this
+        messenger's reply queue, timeout in seconds. The response is
+        acknowledged before it's returned.
+        Raises asyncio.TimeoutError if no response arrived in time.
+        """
+
+        loop = asyncio.get_event_loop()
+        response = loop.create_future()
+
+        def resolve(message):
+            if not response.done():
+                response.set_result(message)
+
+        unsubscribe = self.dispatcher.subscribe(
+            checksum,
+            lambda m: loop.call_soon_threadsafe(resolve, m))
+
+        try:
+            message = await asyncio.wait_for(response, timeout)
+        finally:
+            unsubscribe()
+
+        message.ack()
+
+        return message
+
+    async def responses(self, checksum, timeout):
+        """Yields the responses to provided checksum from this
+        messenger's reply queue as they arrive, acknowledged, for as long
+        as the caller iterates. Timeout is how many seconds to wait for
+        each response, or a function returning it.
+        Raises asyncio.TimeoutError if a response didn't arrive in time.
+
+        Use like so:
+            responses = messenger.responses(checksum, 5)
+
+            try:
+                async for response in responses:
+                    ...
+            finally:
+                await responses.aclose()
+        """
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        unsubscribe = self.dispatcher.subscribe(
+            checksum,
+            lambda m: loop.call_soon_threadsafe(queue.put_nowait, m))
+
+        try:
+            while True:
+                message = await asyncio.wait_for(
+                    queue.get(),
+                    timeout() if callable(timeout) else timeout)
+                message.ack()
+
+                yield message
+        finally:
+            unsubscribe()
+
+
+class Batch:
+    """Collects messages for Messenger.batch. Publishing methods mirror
+    the messenger's, but nothing is published until the batch is.
+    """
+
+    def __init__(self, messenger):
+        self.messenger = messenger
+        self.messages = []
+        self.checksums = None
+
+    def publish_command(self, command, target=None, priority=None,
+                        **kwargs):
+        """Adds a command, optionally to a target, to the batch.
+        """
+
+        self.messenger.ensure_reply_queue()
+        self.messages.append((dict(command=command, **kwargs),
+                              partial(self.messenger.command_exchange,
+                                      command,
+                                      target=target),
+                              self.messenger.command_properties(
+                                  priority)))
+
+    def publish_response(self, uuid, checksum, message_type=None,
+                         **kwargs):
+        """Adds a response by uuid and checksum to the batch.
+        """
+
+        self.messenger.ensure_reply_queue()
+        self.messages.append((kwargs,
+                              partial(self.messenger.response_queue,
+                                      uuid),
+                              self.messenger.response_properties(
+                                  checksum, message_type)))
+
+    def publish_stats(self, **stats):
+        """Adds statistics to the batch.
+        """
+
+        self.messages.append((stats,
+                              self.messenger.status_exchange,
+                              None))
+
+    def publish_broadcast(self, command, **kwargs):
+        """Adds a broadcast command to the batch.
+        """
+
+        self.messenger.ensure_reply_queue()
+        self.messages.append((dict(command=command, **kwargs),
+                              self.messenger.broadcast_exchange,
+                              None))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from collections import defaultdict
+from threading import Lock
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class NullMetrics:
+    """The default metrics sink, which drops everything.
+
+    Instrumented code checks enabled before timing anything, so metrics
+    cost next to nothing when they're not collected.
+
+    Counters:
+        messages_published, messages_buffered, messages_consumed,
+        machine_retries, machine_timeouts, machine_rejects,
+        machine_duplicates
+    Timings, in seconds:
+        encode_seconds, decode_seconds, machine_seconds and
+        handshake_seconds by stage. The requester's stages are request,
+        until the agent is available, and respond, until the machine
+        has arrived. The agent's stages are confirm and create, the
+        time spent in its callbacks.
+    """
+
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+
+class CallbackMetrics(NullMetrics):
+    """Passes metrics on to provided callbacks, which are called with
+    the metric's name, value and labels as keyword arguments.
+    """
+
+    enabled = True
+
+    def __init__(self, on_increment=None, on_observe=None):
+        self.on_increment = on_increment
+        self.on_observe = on_observe
+
+    def increment(self, name, value=1, **labels):
+        if self.on_increment is not None:
+            self.on_increment(name, value, **labels)
+
+    def observe(self, name, seconds, **labels):
+        if self.on_observe is not None:
+            self.on_observe(name, seconds, **labels)
+
+
+class RegistryMetrics(NullMetrics):
+    """Keeps counters and timing summaries in memory, by name and
+    labels, to be read whenever. Safe to use from any thread.
+
+    Use like so:
+        metrics = RegistryMetrics()
+        connector = Connector('127.0.0.1', metrics=metrics)
+
+        metrics.counter('machine_retries')
+        metrics.timing('handshake_seconds', stage='request')
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__counters = defaultdict(int)
+        self.__timings = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        with self.__lock:
+            self.__counters[self.key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+
+        with self.__lock:
+            timing = self.__timings.get(key)
+
+            if timing is None:
+                self.__timings[key] = dict(count=1, sum=seconds,
+                                           min=seconds, max=seconds)
+            else:
+                timing['count'] += 1
+                timing['sum'] += seconds
+                timing['min'] = min(timing['min'], seconds)
+                timing['max'] = max(timing['max'], seconds)
+
+    def counter(self, name, **labels):
+        """Returns the value of a counter.
+        """
+
+        return self.__counters.get(self.key(name, labels), 0)
+
+    def timing(self, name, **labels):
+        """Returns a dict with count, sum, min and max of a timing, or
+        None if nothing was observed.
+        """
+
+        timing = self.__timings.get(self.key(name, labels))
+
+        return dict(timing) if timing is not None else None
+
+    def collect(self):
+        """Returns all counters and timings as a list of (name, labels,
+        value) tuples, labels as a dict.
+        """
+
+        with self.__lock:
+            return [(name, dict(labels), value)
+                    for (name, labels), value
+                    in list(self.__counters.items()) +
+                    [(key, dict(timing))
+                     for key, timing in self.__timings.items()]]
+
+
+class PrometheusMetrics(NullMetrics):
+    """Exports metrics through prometheus_client
+    (https://github.com/prometheus/client_python), as counters and
+    histograms prefixed by namespace, in provided registry or the
+    default one.
+    """
+
+    enabled = True
+
+    def __init__(self, namespace='clique', registry=None):
+        if prometheus_client is None:
+            raise ImportError('PrometheusMetrics requires '
+                              'prometheus_client')
+
+        self.namespace = namespace
+        self.registry = registry or prometheus_client.REGISTRY
+        self.__metrics = {}
+        self.__lock = Lock()
+
+    def metric(self, kind, name, labels):
+        """Sets and returns a metric of provided kind by name.
+        """
+
+        metric = self.__metrics.get(name)
+
+        if metric is None:
+            with self.__lock:
+                metric = self.__metrics.get(name)
+
+                if metric is None:
+                    metric = kind(name, name.replace('_', ' '),
+                                  sorted(labels),
+                                  namespace=self.namespace,
+                                  registry=self.registry)
+                    self.__metrics[name] = metric
+
+        return metric.labels(**labels) if labels else metric
+
+    def increment(self, name, value=1, **labels):
+        self.metric(prometheus_client.Counter, name, labels).inc(value)
+
+    def observe(self, name, seconds, **labels):
+        self.metric(prometheus_client.Histogram, name,
+                    labels).observe(seconds)
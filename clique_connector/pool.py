@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import logging
+
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import BoundedSemaphore
+
+
+class ChannelPool:
+    """A bounded pool of long-lived channels.
+
+    Channels are created on demand by provided channel factory, up to
+    size channels at a time. Borrowing a channel when all of them are
+    in use blocks until one is given back. Channels which got closed or
+    failed while borrowed are thrown away and replaced.
+
+    Use like so:
+        pool = ChannelPool(connection.channel, 4)
+
+        with pool.channel() as channel:
+            channel.basic.publish('body', 'some-queue')
+    """
+
+    def __init__(self, channel_factory, size):
+        self.channel_factory = channel_factory
+        self.size = size
+        self.__idle = LifoQueue()
+        self.__slots = BoundedSemaphore(size)
+        self.__closed = False
+
+    def acquire(self):
+        """Borrows an open channel from the pool, creates a new one if
+        none is idle.
+        """
+
+        self.__slots.acquire()
+
+        try:
+            while True:
+                try:
+                    channel = self.__idle.get_nowait()
+                except Empty:
+                    logging.debug('Opening pooled channel')
+                    return self.channel_factory()
+
+                if channel.is_open:
+                    return channel
+        except BaseException:
+            self.__slots.release()
+            raise
+
+    def release(self, channel, discard=False):
+        """Gives a borrowed channel back to the pool. A discarded or
+        closed channel is closed and not reused, as are channels given
+        back after the pool was closed.
+        """
+
+        try:
+            if discard or self.__closed or not channel.is_open:
+                discard_channel(channel)
+            else:
+                self.__idle.put(channel)
+        finally:
+            self.__slots.release()
+
+    @contextmanager
+    def channel(self):
+        """Borrows a channel for the duration of the with statement.
+        The channel is discarded if anything goes wrong.
+        """
+
+        channel = self.acquire()
+
+        try:
+            yield channel
+        except BaseException:
+            self.release(channel, discard=True)
+            raise
+
+        self.release(channel)
+
+    def close(self):
+        """Closes all idle channels, and borrowed ones when they're
+        given back.
+        """
+
+        self.__closed = True
+
+        while True:
+            try:
+                discard_channel(self.__idle.get_nowait())
+            except Empty:
+                return
+
+
+def discard_channel(channel):
+    """Closes a channel, ignoring errors from an already broken one.
+    """
+
+    try:
+        channel.close()
+    except Exception as error:
+        logging.debug('Error while closing pooled channel: %s', error)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from random import random
+from time import monotonic
+
+
+class RetryPolicy:
+    """Sets how long each stage of a request may take and how it's
+    retried: up to retries times, after an exponential backoff from
+    delay to max_delay seconds. Jitter is the fraction of each backoff
+    which is random, so that requesters don't retry all at once.
+
+    Stage timeouts default to timeout seconds, set others in the
+    timeouts dict by stage name. The deadline, if set, bounds the whole
+    request including retries and backoffs, in seconds.
+
+    Use like so:
+        policy = RetryPolicy(retries=3,
+                             timeouts=dict(request=2, respond=60),
+                             deadline=120)
+        connector = Connector('127.0.0.1', retry=policy)
+    """
+
+    RETRIES = 10
+    DELAY = 0.1
+    MAX_DELAY = 5
+    MULTIPLIER = 2
+    JITTER = 0.5
+    TIMEOUT = 5
+
+    def __init__(self, retries=RETRIES, delay=DELAY,
+                 max_delay=MAX_DELAY, multiplier=MULTIPLIER,
+                 jitter=JITTER, timeout=TIMEOUT, timeouts=None,
+                 deadline=None):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.deadline = deadline
+
+    def start(self):
+        """Returns the deadline of a request started now, as monotonic
+        time, or None.
+        """
+
+        if self.deadline is None:
+            return None
+
+        return monotonic() + self.deadline
+
+    def remaining(self, deadline):
+        """Returns the seconds left until provided deadline, or None
+        if there's no deadline.
+        """
+
+        if deadline is None:
+            return None
+
+        return deadline - monotonic()
+
+    def stage_timeout(self, stage, deadline=None):
+        """Returns the timeout of provided stage, cut short by provided
+        deadline.
+        Raises asyncio.TimeoutError if the deadline has passed.
+        """
+
+        timeout = self.timeouts.get(stage, self.timeout)
+        remaining = self.remaining(deadline)
+
+        if remaining is None:
+            return timeout
+
+        if remaining <= 0:
+            raise asyncio.TimeoutError('Deadline exceeded')
+
+        return min(timeout, remaining)
+
+    def should_retry(self, retries, deadline=None):
+        """Whether a request which has been retried provided number of
+        times may be retried again before provided deadline.
+        """
+
+        remaining = self.remaining(deadline)
+
+        return retries < self.retries and \
+            (remaining is None or remaining > 0)
+
+    def backoff(self, retries, deadline=None):
+        """Returns the seconds to wait before retry number retries,
+        counting from 1, never past provided deadline.
+        """
+
+        delay = min(self.max_delay,
+                    self.delay * self.multiplier ** (retries - 1))
+        delay -= delay * self.jitter * random()
+        remaining = self.remaining(deadline)
+
+        if remaining is not None:
+            delay = min(delay, max(0, remaining))
+
+        return delay
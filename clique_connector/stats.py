@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from array import array
+from math import ceil, isnan
+from threading import Lock
+from time import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NAN = float('nan')
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of provided sorted values,
+    or None if there are none.
+    """
+
+    if not values:
+        return None
+
+    index = max(0, ceil(percent / 100 * len(values)) - 1)
+
+    return values[min(index, len(values) - 1)]
+
+
+class StatsStore:
+    """Keeps the numeric statistics agents publish as time series in
+    compact ring buffers of capacity samples per agent, to be queried in
+    memory.
+
+    Storage is columnar: one flat array of send times and one flat
+    array of 32 bit floats per statistic, with a row of capacity slots
+    per agent. Missing values are NaN. Rows of agents which are gone are
+    reused. Queries over all agents are vectorized with NumPy if it's
+    installed, and plain loops otherwise.
+
+    Windows are counted back from an agent's latest sample by the
+    agent's own clock, so clock skew between agents doesn't matter.
+    Agents which haven't been seen for max_age seconds are forgotten on
+    expire.
+
+    Use like so:
+        store = StatsStore()
+
+        # For each stats message
+        store.add(agent_uuid, sent_time, dict(load=0.5, mem=2048))
+
+        # Last value, mean, min, max and percentiles of the last minute
+        store.summary(agent_uuid, 60)['load']['p99']
+
+        # Fleet-wide
+        store.fleet_sum('mem')
+        store.top('load', 10)
+    """
+
+    CAPACITY = 3600
+    PERCENTILES = (50, 90, 99)
+    MAX_AGE = 300
+
+    def __init__(self, capacity=CAPACITY, percentiles=PERCENTILES,
+                 max_age=MAX_AGE):
+        self.capacity = capacity
+        self.percentiles = percentiles
+        self.max_age = max_age
+        self.__lock = Lock()
+        self.__rows = {}
+        self.__uuids = []
+        self.__free = []
+        self.__seen = array('d')
+        self.__heads = array('q')
+        self.__counts = array('q')
+        self.__times = array('d')
+        self.__columns = {}
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def agents(self):
+        """Returns the uuids of all known agents.
+        """
+
+        return list(self.__rows)
+
+    def names(self):
+        """Returns the names of all statistics.
+        """
+
+        return list(self.__columns)
+
+    def blank(self, typecode, rows=1):
+        return array(typecode, [NAN]) * (rows * self.capacity)
+
+    def row(self, uuid):
+        """Returns the row of an agent, which is set up if it's new.
+        """
+
+        row = self.__rows.get(uuid)
+
+        if row is not None:
+            return row
+
+        if self.__free:
+            row = self.__free.pop()
+            start = row * self.capacity
+            end = start + self.capacity
+
+            self.__uuids[row] = uuid
+            self.__heads[row] = 0
+            self.__counts[row] = 0
+            self.__times[start:end] = self.blank('d')
+
+            for column in self.__columns.values():
+                column[start:end] = self.blank('f')
+        else:
+            row = len(self.__uuids)
+
+            self.__uuids.append(uuid)
+            self.__seen.append(0)
+            self.__heads.append(0)
+            self.__counts.append(0)
+            self.__times.extend(self.blank('d'))
+
+            for column in self.__columns.values():
+                column.extend(self.blank('f'))
+
+        self.__rows[uuid] = row
+
+        return row
+
+    def touch(self, uuid):
+        """Marks an agent as seen, without adding a sample.
+        """
+
+        with self.__lock:
+            self.__seen[self.row(uuid)] = time()
+
+    def add(self, uuid, sent, stats):
+        """Adds a sample of statistics, a dict of numbers, sent by an
+        agent at provided time. Values which aren't numbers are ignored.
+        """
+
+        with self.__lock:
+            row = self.row(uuid)
+            index = row * self.capacity + self.__heads[row]
+
+            for name, value in stats.items():
+                if name not in self.__columns and \
+                        not isinstance(value, bool) and \
+                        isinstance(value, (int, float)):
+                    self.__columns[name] = self.blank('f',
+                                                      len(self.__uuids))
+
+            for name, column in self.__columns.items():
+                value = stats.get(name)
+
+                if isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    value = NAN
+
+                column[index] = value
+
+            self.__times[index] = sent
+            self.__heads[row] = (self.__heads[row] + 1) % self.capacity
+            self.__counts[row] = min(self.__counts[row] + 1,
+                                     self.capacity)
+            self.__seen[row] = time()
+
+    def release(self, uuid):
+        row = self.__rows.pop(uuid)
+
+        self.__uuids[row] = None
+        self.__counts[row] = 0
+        self.__free.append(row)
+
+    def remove(self, uuid):
+        """Forgets about an agent.
+        """
+
+        with self.__lock:
+            if uuid in self.__rows:
+                self.release(uuid)
+
+    def expire(self):
+        """Forgets about agents which haven't been seen for max_age
+        seconds.
+        """
+
+        now = time()
+
+        with self.__lock:
+            for uuid, row in list(self.__rows.items()):
+                if now - self.__seen[row] > self.max_age:
+                    self.release(uuid)
+
+    def last(self, uuid, name):
+        """Returns the latest value of a statistic, or None.
+        """
+
+        with self.__lock:
+            row = self.__rows.get(uuid)
+
+            if row is None or name not in self.__columns or \
+                    not self.__counts[row]:
+                return None
+
+            value = self.__columns[name][
+                row * self.capacity +
+                (self.__heads[row] - 1) % self.capacity]
+
+        return None if isnan(value) else value
+
+    def window(self, row, column, seconds):
+        """Returns the sorted values of a statistic in a row's window.
+        """
+
+        start = row * self.capacity
+        latest = self.__times[start +
+                              (self.__heads[row] - 1) % self.capacity]
+
+        if numpy is not None:
+            times = numpy.frombuffer(self.__times, numpy.float64,
+                                     self.capacity, start * 8)
+            values = numpy.frombuffer(column, numpy.float32,
+                                      self.capacity, start * 4)
+            mask = (times >= latest - seconds) & ~numpy.isnan(values)
+
+            return numpy.sort(values[mask]).tolist()
+
+        end = start + self.capacity
+
+        return sorted(value for sent, value
+                      in zip(self.__times[start:end], column[start:end])
+                      if sent >= latest - seconds and not isnan(value))
+
+    def summary(self, uuid, window=60):
+        """Summarizes the statistics of an agent over the window in
+        seconds counting back from its latest sample.
+        Returns a dict by statistic of dicts with last, count, mean,
+        min, max and percentiles as p50 and so on, or an empty dict for
+        unknown agents.
+        """
+
+        summary = {}
+
+        with self.__lock:
+            row = self.__rows.get(uuid)
+
+            if row is None or not self.__counts[row]:
+                return summary
+
+            last = row * self.capacity + \
+                (self.__heads[row] - 1) % self.capacity
+
+            for name, column in self.__columns.items():
+                values = self.window(row, column, window)
+
+                if not values:
+                    continue
+
+                summary[name] = dict(
+                    last=None if isnan(column[last]) else column[last],
+                    count=len(values),
+                    mean=sum(values) / len(values),
+                    min=values[0],
+                    max=values[-1],
+                    **{'p%d' % p: percentile(values, p)
+                       for p in self.percentiles})
+
+        return summary
+
+    def gather(self, name):
+        """Returns the latest value of a statistic of every agent's row
+        as a NumPy array, NaN for agents without one, or None if NumPy
+        isn't installed or there are no such values.
+        """
+
+        column = self.__columns.get(name)
+        rows = len(self.__uuids)
+
+        if numpy is None or column is None or not rows:
+            return None
+
+        heads = numpy.frombuffer(self.__heads, numpy.int64)
+        counts = numpy.frombuffer(self.__counts, numpy.int64)
+        values = numpy.frombuffer(column, numpy.float32) \
+            .reshape(rows, self.capacity)[
+                numpy.arange(rows), (heads - 1) % self.capacity]
+        values[counts == 0] = NAN
+
+        return values
+
+    def latest(self, name):
+        """Returns a list of (uuid, value) tuples with the latest value
+        of a statistic of every agent which has one.
+        """
+
+        column = self.__columns.get(name)
+
+        if column is None:
+            return []
+
+        values = self.gather(name)
+
+        if values is not None:
+            valid = numpy.flatnonzero(~numpy.isnan(values))
+
+            return [(self.__uuids[row], value) for row, value
+                    in zip(valid.tolist(), values[valid].tolist())]
+
+        latest = []
+
+        for row in range(len(self.__uuids)):
+            if not self.__counts[row]:
+                continue
+
+            value = column[row * self.capacity +
+                           (self.__heads[row] - 1) % self.capacity]
+
+            if not isnan(value):
+                latest.append((self.__uuids[row], value))
+
+        return latest
+
+    def fleet_sum(self, name):
+        """Returns the sum of the latest values of a statistic over all
+        agents.
+        """
+
+        with self.__lock:
+            values = self.gather(name)
+
+            if values is not None:
+                return float(numpy.nansum(values, dtype=numpy.float64))
+
+            return sum(value for _, value in self.latest(name))
+
+    def top(self, name, count=10):
+        """Returns a list of (uuid, value) tuples with the count agents
+        with the highest latest values of a statistic, highest first.
+        """
+
+        with self.__lock:
+            values = self.gather(name)
+
+            if values is None:
+                latest = self.latest(name)
+
+                return sorted(latest, key=lambda each: each[1],
+                              reverse=True)[:count]
+
+            valid = numpy.flatnonzero(~numpy.isnan(values))
+            rows = valid
+
+            # Only the count highest are sorted
+            if count < len(valid):
+                rows = valid[numpy.argpartition(-values[valid],
+                                                count - 1)[:count]]
+
+            rows = rows[numpy.argsort(-values[rows], kind='stable')]
+
+            return [(self.__uuids[row], value) for row, value
+                    in zip(rows.tolist(), values[rows].tolist())]
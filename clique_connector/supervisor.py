@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+
+from importlib import import_module
+from rx.concurrency import AsyncIOScheduler
+from time import monotonic, sleep
+
+from .connector import Connector
+
+
+class SharedCapacity:
+    """The free resources of a host, shared between the processes of a
+    supervisor so that its workers don't take on more machines than the
+    host can run. Resources are reserved when a worker confirms a
+    machine, and released if it's not created after all, or when the
+    machine is deleted, see releasing.
+
+    Reservations are kept by machine name, in a manager process, so
+    that any worker can release a machine by its name.
+
+    Use like so:
+        capacity = SharedCapacity(cpu=32, mem=131072, disc=2048)
+
+        if capacity.reserve(cpu=1, mem=512, disc=128, name='machine'):
+            ...
+
+        capacity.release_machine('machine')
+    """
+
+    def __init__(self, cpu, mem, disc):
+        self.__free = multiprocessing.Array('d', [cpu, mem, disc])
+        self.__manager = multiprocessing.Manager()
+        self.__reserved = self.__manager.dict()
+
+    def __call__(self):
+        return self.free()
+
+    def __getstate__(self):
+        # The manager stays with the supervisor, workers only need the
+        # proxy of the reservations
+        state = dict(self.__dict__)
+        del state['_SharedCapacity__manager']
+
+        return state
+
+    def reserved(self):
+        """Returns the names of the machines with reserved resources.
+        """
+
+        return list(self.__reserved.keys())
+
+    def free(self):
+        """Returns the free resources as a dict with cpu, mem and disc,
+        like a capacity callback of wait_for_machines.
+        """
+
+        with self.__free.get_lock():
+            cpu, mem, disc = self.__free
+
+        return dict(cpu=cpu, mem=mem, disc=disc)
+
+    def reserve(self, cpu, mem, disc, name=None, **kwargs):
+        """Reserves resources, if they're free, for the machine by
+        provided name if any.
+        Returns whether they were.
+        """
+
+        with self.__free.get_lock():
+            free = self.__free
+
+            if free[0] < cpu or free[1] < mem or free[2] < disc:
+                return False
+
+            free[0] -= cpu
+            free[1] -= mem
+            free[2] -= disc
+
+            if name is not None:
+                self.__reserved[name] = (cpu, mem, disc)
+
+        return True
+
+    def release(self, cpu, mem, disc, name=None, **kwargs):
+        """Gives reserved resources back. Resources reserved for a
+        machine by name are given back once, by what was reserved.
+        """
+
+        if name is not None:
+            self.release_machine(name)
+            return
+
+        with self.__free.get_lock():
+            self.__free[0] += cpu
+            self.__free[1] += mem
+            self.__free[2] += disc
+
+    def release_machine(self, name):
+        """Gives the resources reserved for the machine by provided name
+        back.
+        Returns whether there were any.
+        """
+
+        with self.__free.get_lock():
+            reserved = self.__reserved.pop(name, None)
+
+            if reserved is None:
+                return False
+
+            for index, value in enumerate(reserved):
+                self.__free[index] += value
+
+        return True
+
+
+def reserving(capacity, confirm_callback):
+    """Wraps a confirm callback of wait_for_machines so that machines
+    are only confirmed if their resources could be reserved from
+    provided shared capacity as well.
+    """
+
+    if asyncio.iscoroutinefunction(confirm_callback):
+        async def confirm(**kwargs):
+            return await confirm_callback(**kwargs) and \
+                capacity.reserve(**kwargs)
+    else:
+        def confirm(**kwargs):
+            return confirm_callback(**kwargs) and \
+                capacity.reserve(**kwargs)
+
+    return confirm
+
+
+def releasing(capacity, delete_callback):
+    """Wraps a delete callback of manage_machines so that the resources
+    reserved for a machine are released from provided shared capacity
+    when it's deleted.
+    """
+
+    if asyncio.iscoroutinefunction(delete_callback):
+        async def delete(name):
+            result = await delete_callback(name=name)
+
+            if result is not None:
+                capacity.release_machine(name)
+
+            return result
+    else:
+        def delete(name):
+            result = delete_callback(name=name)
+
+            if result is not None:
+                capacity.release_machine(name)
+
+            return result
+
+    return delete
+
+
+def work(host, options, confirm_callback, create_callback,
+         capacity=None, prefetch=1, drain_timeout=None, lifecycle=None):
+    """Runs a worker process: a connector of its own waiting for
+    machines in a new event loop until it's told to stop by SIGTERM or
+    SIGINT. Then it stops taking on requests, drains the ones it's
+    handling, for drain_timeout seconds at the most, and closes.
+    If provided, lifecycle is a tuple of stop, delete and list
+    callbacks, see Connector.manage_machines, for the worker to handle
+    the host's lifecycle commands with as well.
+    """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    scheduler = AsyncIOScheduler(loop)
+    connector = Connector(host, **options)
+    stopping = asyncio.Event()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    if capacity is not None:
+        confirm_callback = reserving(capacity, confirm_callback)
+
+    async def serve():
+        stop, observable = connector.wait_for_machines(
+            confirm_callback,
+            create_callback,
+            scheduler,
+            prefetch,
+            cancel_callback=capacity.release
+            if capacity is not None else None)
+        subscription = observable.subscribe(
+            on_error=lambda e: logging.error('Worker failed: %s', e))
+
+        if lifecycle is not None:
+            stop_callback, delete_callback, list_callback = lifecycle
+
+            if capacity is not None and delete_callback is not None:
+                delete_callback = releasing(capacity, delete_callback)
+
+            stop_lifecycle, managed = connector.manage_machines(
+                stop_callback, delete_callback, list_callback, scheduler)
+            managing = managed.subscribe(
+                on_error=lambda e: logging.error('Lifecycle failed: %s',
+                                                 e))
+
+        await stopping.wait()
+
+        logging.info('Worker %d draining', os.getpid())
+
+        subscription.dispose()
+
+        if lifecycle is not None:
+            managing.dispose()
+            stop_lifecycle()
+        left = await connector.drain(drain_timeout)
+
+        if left:
+            logging.warning('Worker %d stopped with %d requests left',
+                            os.getpid(), left)
+
+        stop()
+        connector.messenger.close()
+
+    try:
+        loop.run_until_complete(serve())
+    finally:
+        loop.close()
+
+
+class Supervisor:
+    """Runs wait_for_machines in worker processes, each with a
+    connection of its own consuming the machine requests, so that an
+    agent can use all cores of its host. Workers which die are
+    restarted.
+
+    Callbacks are as for Connector.wait_for_machines and have to be
+    picklable, module level functions, for the workers. If provided,
+    the host's capacity is shared by the workers, see SharedCapacity,
+    and machine resources are reserved on confirm.
+
+    Lifecycle commands are handled by the first worker with the stop,
+    delete and list callbacks, as for Connector.manage_machines, if any
+    is provided. Deleted machines have their resources released.
+
+    Stopping the supervisor, by SIGTERM, SIGINT or stop, stops the
+    workers gracefully: they finish the requests they're handling, for
+    drain_timeout seconds at the most, before they exit.
+
+    Use like so:
+        supervisor = Supervisor('127.0.0.1',
+                                confirm,
+                                create,
+                                workers=8,
+                                capacity=SharedCapacity(32, 131072,
+                                                        2048))
+
+        # Blocks until stopped
+        supervisor.run()
+    """
+
+    DRAIN_TIMEOUT = 30
+    CHECK_INTERVAL = 1
+
+    def __init__(self, host, confirm_callback, create_callback,
+                 workers=None, capacity=None, prefetch=1,
+                 drain_timeout=DRAIN_TIMEOUT, stop_callback=None,
+                 delete_callback=None, list_callback=None, **options):
+        self.host = host
+        self.confirm_callback = confirm_callback
+        self.create_callback = create_callback
+        self.lifecycle = (stop_callback, delete_callback, list_callback)
+        self.workers = workers or os.cpu_count() or 1
+        self.capacity = capacity
+        self.prefetch = prefetch
+        self.drain_timeout = drain_timeout
+        self.options = options
+        self.processes = []
+        self.__stopping = False
+
+    def spawn(self, index=0):
+        """Starts a worker process, the one to handle lifecycle
+        commands if it's the first.
+        """
+
+        lifecycle = self.lifecycle \
+            if index == 0 and any(self.lifecycle) else None
+
+        process = multiprocessing.Process(
+            target=work,
+            args=(self.host,
+                  self.options,
+                  self.confirm_callback,
+                  self.create_callback,
+                  self.capacity,
+                  self.prefetch,
+                  self.drain_timeout,
+                  lifecycle),
+            daemon=True)
+        process.start()
+
+        logging.info('Started worker %d', process.pid)
+
+        return process
+
+    def start(self):
+        """Starts all workers.
+        """
+
+        self.__stopping = False
+        self.processes = [self.spawn(index)
+                          for index in range(self.workers)]
+
+    def check(self):
+        """Restarts workers which died, unless stopping.
+        """
+
+        for index, process in enumerate(self.processes):
+            if process.exitcode is not None and not self.__stopping:
+                logging.warning('Worker %d died with %s, restarting',
+                                process.pid, process.exitcode)
+                self.processes[index] = self.spawn(index)
+
+    def stop(self):
+        """Tells the workers to drain and stop by SIGTERM, then waits
+        for them and kills the ones which don't in time.
+        """
+
+        self.__stopping = True
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+        deadline = monotonic() + self.drain_timeout + 5
+
+        for process in self.processes:
+            process.join(max(0, deadline - monotonic()))
+
+            if process.is_alive():
+                logging.warning('Killing worker %d', process.pid)
+                process.kill()
+                process.join()
+
+    def run(self):
+        """Starts the workers and supervises them until stopped by
+        SIGTERM or SIGINT.
+        """
+
+        stopped = []
+
+        def handler(signum, frame):
+            stopped.append(signum)
+
+        previous = {signum: signal.signal(signum, handler)
+                    for signum in (signal.SIGTERM, signal.SIGINT)}
+
+        try:
+            self.start()
+
+            while not stopped:
+                self.check()
+                sleep(self.CHECK_INTERVAL)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+            self.stop()
+
+
+def callback(path):
+    """Imports a callback by its 'module:function' path.
+    """
+
+    module, name = path.split(':')
+
+    return getattr(import_module(module), name)
+
+
+def main(argv=None):
+    """Runs a supervisor from the command line, like so:
+        python -m clique_connector.supervisor \\
+            --confirm agent.machines:confirm \\
+            --create agent.machines:create \\
+            --delete agent.machines:delete \\
+            --workers 8 --cpu 32 --mem 131072 --disc 2048
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Runs agent workers waiting for machines.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='RabbitMQ host, or comma separated nodes')
+    parser.add_argument('--username', default='guest')
+    parser.add_argument('--password', default='guest')
+    parser.add_argument('--confirm', required=True,
+                        help='confirm callback as module:function')
+    parser.add_argument('--create', required=True,
+                        help='create callback as module:function')
+    parser.add_argument('--stop',
+                        help='stop callback as module:function')
+    parser.add_argument('--delete',
+                        help='delete callback as module:function, '
+                             'releases the capacity of deleted machines')
+    parser.add_argument('--list',
+                        help='list callback as module:function')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes, one per core if not set')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='requests each worker takes on at a time')
+    parser.add_argument('--drain-timeout', type=float,
+                        default=Supervisor.DRAIN_TIMEOUT,
+                        help='seconds to finish requests when stopping')
+    parser.add_argument('--cpu', type=float,
+                        help='CPUs of the host shared by the workers')
+    parser.add_argument('--mem', type=float,
+                        help='memory of the host in MB')
+    parser.add_argument('--disc', type=float,
+                        help='disc of the host in GB')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    capacity = None
+
+    if args.cpu is not None and args.mem is not None and \
+            args.disc is not None:
+        capacity = SharedCapacity(args.cpu, args.mem, args.disc)
+
+    Supervisor(args.host,
+               callback(args.confirm),
+               callback(args.create),
+               workers=args.workers,
+               capacity=capacity,
+               prefetch=args.prefetch,
+               drain_timeout=args.drain_timeout,
+               stop_callback=args.stop and callback(args.stop),
+               delete_callback=args.delete and callback(args.delete),
+               list_callback=args.list and callback(args.list),
+               username=args.username,
+               password=args.password).run()
+
+
+if __name__ == '__main__':
+    main()
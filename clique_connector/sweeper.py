@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import argparse
+import logging
+
+from amqpstorm import AMQPChannelError
+from functools import partial
+
+from .messenger import Messenger
+
+try:
+    from amqpstorm.management import ManagementApi
+except ImportError:
+    ManagementApi = None
+
+
+def management_queues(url, username='guest', password='guest',
+                      virtual_host='/'):
+    """Returns a function which lists the queues of provided virtual
+    host through RabbitMQ's management API at provided url, like
+    http://127.0.0.1:15672. Requires requests.
+    """
+
+    if ManagementApi is None:
+        raise ImportError('management_queues requires requests')
+
+    api = ManagementApi(url, username, password)
+
+    return partial(api.queue.list, virtual_host=virtual_host)
+
+
+class ReplyQueueSweeper:
+    """Deletes orphaned reply queues, the clique-response-* queues which
+    aren't exclusive and nobody consumes. Reply queues of running
+    messengers are exclusive to their connections, so those are the
+    ones left behind by earlier versions, which declared one durable
+    queue per request. Late replies in them are deleted with them.
+
+    Queues are listed by provided function, which returns them as dicts
+    like RabbitMQ's management API does, see management_queues, and
+    deleted through provided messenger, only if they're still unused.
+
+    Use like so:
+        sweeper = ReplyQueueSweeper(
+            Messenger('127.0.0.1'),
+            management_queues('http://127.0.0.1:15672'))
+
+        swept = sweeper.sweep()
+    """
+
+    PREFIX = Messenger.RESPONSE_QUEUE_NAME % ''
+
+    def __init__(self, messenger, list_queues):
+        self.messenger = messenger
+        self.list_queues = list_queues
+
+    def orphans(self):
+        """Returns the names of the orphaned reply queues.
+        """
+
+        return [queue['name'] for queue in self.list_queues()
+                if queue['name'].startswith(self.PREFIX) and
+                not queue.get('exclusive') and
+                not queue.get('consumers')]
+
+    def sweep(self, dry_run=False):
+        """Deletes the orphaned reply queues, or just lists them if
+        dry_run is set.
+        Returns the names of the deleted queues.
+        """
+
+        orphans = self.orphans()
+
+        if dry_run:
+            return orphans
+
+        swept = []
+        channel = None
+
+        try:
+            for name in orphans:
+                if channel is None:
+                    channel = self.messenger.channel()
+
+                try:
+                    channel.queue.delete(name, if_unused=True)
+                except AMQPChannelError as error:
+                    logging.warning('Could not sweep reply queue %s: %s',
+                                    name, error)
+
+                    # The broker closes the channel on errors
+                    channel.close()
+                    channel = None
+                    continue
+
+                logging.info('Swept reply queue %s', name)
+                swept.append(name)
+        finally:
+            if channel is not None:
+                channel.close()
+
+        return swept
+
+
+def main(argv=None):
+    """Sweeps orphaned reply queues from the command line, like so:
+        python -m clique_connector.sweeper --host 127.0.0.1 --dry-run
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Deletes orphaned clique reply queues.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='RabbitMQ host')
+    parser.add_argument('--api',
+                        help='management API url, '
+                             'http://HOST:15672 if not set')
+    parser.add_argument('--username', default='guest')
+    parser.add_argument('--password', default='guest')
+    parser.add_argument('--vhost', default='/')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the orphaned queues only')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    messenger = Messenger(args.host,
+                          username=args.username,
+                          password=args.password)
+    sweeper = ReplyQueueSweeper(
+        messenger,
+        management_queues(args.api or 'http://%s:15672' % args.host,
+                          args.username,
+                          args.password,
+                          args.vhost))
+
+    try:
+        for name in sweeper.sweep(args.dry_run):
+            print(name)
+    finally:
+        messenger.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import logging
+
+from amqpstorm import Connection, Message
+from threading import Thread
+
+
+class AmqpTransport:
+    """The default transport of a messenger, which connects to RabbitMQ
+    through the amqpstorm library.
+
+    A transport creates connections, creates messages for publishing
+    and starts consumers. Connections, channels and messages follow
+    amqpstorm's interfaces, see the memory module for another transport.
+    """
+
+    def __init__(self, username='guest', password='guest'):
+        self.username = username
+        self.password = password
+
+    def connect(self, host, heartbeat):
+        """Creates a new RabbitMQ connection.
+        """
+
+        logging.debug('Connect to AMQP: %s', host)
+
+        return Connection(host, self.username, self.password,
+                          heartbeat=heartbeat)
+
+    def message(self, channel, body, properties):
+        """Creates a message to publish in provided channel.
+        """
+
+        return Message.create(channel, body, properties)
+
+    def consume(self, channel, queue, on_message, on_error):
+        """Starts consuming provided queue in provided channel.
+        amqpstorm consumers are blocking, so this is done in a separate
+        thread which calls on_message with each message, and on_error
+        with whatever stopped it.
+        Returns the consumer tag.
+        """
+
+        def consume():
+            try:
+                channel.start_consuming(auto_decode=False)
+            except Exception as error:
+                on_error(error)
+
+        tag = channel.basic.consume(on_message, **queue)
+        Thread(target=consume, daemon=True).start()
+
+        return tag
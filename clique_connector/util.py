@@ -1,11 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+
+from functools import partial
+from inspect import signature
+
 
 def listener_error(stop, error):
     stop()
     raise error
 
 
+async def run_callback(loop, executor, callback, **kwargs):
+    if asyncio.iscoroutinefunction(callback):
+        return await callback(**kwargs)
+
+    return await loop.run_in_executor(executor,
+                                      partial(callback, **kwargs))
+
+
+def takes_argument(callback, name):
+    try:
+        return name in signature(callback).parameters
+    except (TypeError, ValueError):
+        return False
+
+
 def filter_message(test_values, message):
     body = message.json()
     return all(body[k] == test_values[k] for k in test_values)
@@ -27,7 +27,14 @@ setup(
     keywords='clique messenger rabbitmq',
     url='https://bitbucket.org/bagis/clique-connector',
     packages=['clique_connector', 'test'],
+    test_suite='test',
     long_description=read('README.md'),
     install_requires=['amqpstorm',
-                      'rx']
+                      'rx'],
+    extras_require=dict(msgpack=['msgpack'],
+                        orjson=['orjson'],
+                        numpy=['numpy'],
+                        prometheus=['prometheus_client'],
+                        management=['requests'],
+                        xxhash=['xxhash'])
 )
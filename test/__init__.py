@@ -6,5 +6,19 @@ Copyright (c) 2016 Olof Montin <olof@montin.net>
 This file is part of clique-connector.
 """
 
+from .benchmark import TestBenchmark
+from .cache import TestTtlCache
+from .capacity import TestCapacityIndex
+from .codec import TestCodec
 from .connector import TestConnector
+from .dispatcher import TestReplyDispatcher
+from .fairness import TestFairShare
+from .memory import TestMemoryBroker, TestMemoryPublish, \
+    TestMemoryReconnect
 from .messenger import TestMessenger
+from .metrics import TestMetrics
+from .pool import TestChannelPool
+from .retry import TestRetryPolicy
+from .stats import TestStatsStore
+from .supervisor import TestSupervisor
+from .sweeper import TestReplyQueueSweeper
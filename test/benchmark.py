@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from unittest import TestCase
+
+from clique_connector.benchmark import run
+
+
+class TestBenchmark(TestCase):
+
+    def test_run(self):
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(run(requests=10,
+                                              concurrency=5,
+                                              agents=2))
+
+        self.assertEqual(results['failures'], 0)
+        self.assertEqual(results['retries'], 0)
+        self.assertGreater(results['requests_per_second'], 0)
+        self.assertLessEqual(results['latency']['p50'],
+                             results['latency']['p99'])
+        self.assertEqual(results['broker_counters']['published'], 50)
+        self.assertIn('round_trips_per_request', results)
+        self.assertIn('queues_created_per_request', results)
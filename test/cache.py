@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from unittest import TestCase
+
+from clique_connector.cache import TtlCache
+
+
+class TestTtlCache(TestCase):
+
+    def test_get(self):
+        cache = TtlCache()
+        cache.put('key', 'value')
+
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertIn('key', cache)
+        self.assertIsNone(cache.get('other'))
+
+    def test_size(self):
+        cache = TtlCache(size=2)
+
+        for key in ('a', 'b', 'c'):
+            cache.put(key, key)
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('a', cache)
+
+    def test_ttl(self):
+        cache = TtlCache(ttl=-1)
+        cache.put('key', 'value')
+
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+
+    def test_pop(self):
+        cache = TtlCache()
+        cache.put('key', 'value')
+
+        self.assertIsNone(cache.pop('key', 'other'))
+        self.assertEqual(cache.pop('key', 'value'), 'value')
+        self.assertIsNone(cache.pop('key'))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from unittest import TestCase
+
+from clique_connector.capacity import CapacityIndex
+
+
+class TestCapacityIndex(TestCase):
+
+    def setUp(self):
+        self.index = CapacityIndex()
+        self.index.update('small', cpu=2, mem=1024, disc=256)
+        self.index.update('large', cpu=8, mem=8192, disc=1024)
+
+    def test_pick_most_free_memory(self):
+        self.assertEqual(self.index.pick(1, 512, 128), 'large')
+
+    def test_pick_fitting(self):
+        self.assertEqual(self.index.pick(1, 512, 512), 'large')
+        self.assertIsNone(self.index.pick(16, 512, 128))
+
+    def test_pick_reserves(self):
+        self.assertEqual(self.index.pick(1, 7680, 128), 'large')
+        self.assertEqual(self.index.pick(1, 1024, 128), 'small')
+        self.assertIsNone(self.index.pick(1, 1024, 128))
+
+    def test_pick_exclude(self):
+        self.assertEqual(self.index.pick(1, 512, 128, exclude={'large'}),
+                         'small')
+
+    def test_expire(self):
+        index = CapacityIndex(max_age=-1)
+        index.update('agent', cpu=2, mem=1024, disc=256)
+
+        self.assertIsNone(index.pick(1, 512, 128))
+        self.assertEqual(len(index), 0)
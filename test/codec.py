@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from unittest import TestCase, skipIf
+from unittest.mock import Mock
+
+from clique_connector import codec
+from clique_connector.delivery import Delivery
+
+
+class TestCodec(TestCase):
+
+    def test_json(self):
+        json_codec = codec.JsonCodec()
+        body = json_codec.dumps(dict(key='value'))
+
+        self.assertIsInstance(body, bytes)
+        self.assertEqual(json_codec.loads(body), dict(key='value'))
+
+    @skipIf(codec.orjson is None, 'orjson is not installed')
+    def test_orjson(self):
+        body = codec.OrjsonCodec().dumps(dict(key='value'))
+
+        self.assertEqual(codec.JsonCodec().loads(body),
+                         dict(key='value'))
+
+    @skipIf(codec.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        msgpack_codec = codec.get_codec('application/msgpack')
+        body = msgpack_codec.dumps(dict(key='value'))
+
+        self.assertEqual(msgpack_codec.loads(body), dict(key='value'))
+
+    def test_checksums(self):
+        body = b'{"key": "value"}'
+
+        self.assertEqual(codec.md5_checksum(body),
+                         codec.md5_checksum(body))
+        self.assertNotEqual(codec.blake2_checksum(body),
+                            codec.blake2_checksum(body + b' '))
+
+    def test_delivery_decodes_once(self):
+        json_codec = Mock(wraps=codec.JsonCodec())
+        message = Mock(body=b'{"key": "value"}', message_id='abc')
+        delivery = Delivery(message, json_codec)
+
+        self.assertEqual(delivery.json(), dict(key='value',
+                                               checksum='abc'))
+        self.assertIs(delivery.json(), delivery.json())
+        json_codec.loads.assert_called_once_with(message.body)
+
+    def test_delivery_fields(self):
+        json_codec = Mock(wraps=codec.JsonCodec())
+        message = Mock(body=b'{"uuid": "old", "name": "machine"}',
+                       message_id='abc',
+                       app_id='sender',
+                       message_type='machine-rejected')
+        delivery = Delivery(message, json_codec)
+
+        # Read from the message properties, without decoding
+        self.assertEqual(delivery.uuid, 'sender')
+        self.assertEqual(delivery.checksum, 'abc')
+        self.assertEqual(delivery.message_type, 'machine-rejected')
+        json_codec.loads.assert_not_called()
+
+        self.assertEqual(delivery['name'], 'machine')
+        self.assertIn('name', delivery)
+        self.assertIsNone(delivery.get('pkey'))
+        self.assertIs(delivery.body, message.body)
+
+        # Messages from senders which don't set the app id
+        message.app_id = None
+        self.assertEqual(delivery.uuid, 'old')
@@ -9,14 +9,22 @@ This file is part of clique-connector.
 import asyncio
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from rx import Observable
+from rx.concurrency import AsyncIOScheduler
+from threading import Lock
+from time import sleep
 from unittest import TestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 from clique_connector import Connector
+from clique_connector.capacity import CapacityIndex
+from clique_connector.retry import RetryPolicy
 from clique_connector.util import listener_error
 
+from .util import HOST, transport_options
+
 
 # logging.basicConfig(level=logging.DEBUG)
 
@@ -24,7 +32,8 @@ from clique_connector.util import listener_error
 class TestConnector(TestCase):
 
     def setUp(self):
-        self.connector = Connector('127.0.0.1')
+        self.options = transport_options()
+        self.connector = Connector(HOST, **self.options)
 
     def tearDown(self):
         self.connector.messenger.connection.close()
@@ -39,19 +48,22 @@ class TestConnector(TestCase):
                                .wait_for_machines(confirm_callback,
                                                   create_callback)
 
-        result, _ = loop.run_until_complete(asyncio.wait([
+        tasks = map(asyncio.ensure_future, [
             self.connector.create_machine(
                 'testmachine',
                 'alpine',
                 1,
                 512,
                 128,
-                'public-key'),
+                'public-key',
+                0,
+                AsyncIOScheduler()),
             observable
             .first()
             .tap(lambda _: stop())
             .catch_exception(partial(listener_error, stop))
-        ]))
+        ])
+        result, _ = loop.run_until_complete(asyncio.wait(tasks))
 
         created = [r.result() for r in result
                    if type(r.result()) is dict][0]
@@ -80,16 +92,16 @@ class TestConnector(TestCase):
                                                  username='testuser'))
 
         loop = asyncio.get_event_loop()
-        connector_1 = Connector('127.0.0.1')
+        connector_1 = Connector(HOST, **self.options)
         stop_1, observable_1 = connector_1.wait_for_machines(
                                    confirm_callback,
                                    create_callback)
-        connector_2 = Connector('127.0.0.1')
+        connector_2 = Connector(HOST, **self.options)
         stop_2, observable_2 = connector_2.wait_for_machines(
                                    confirm_callback,
                                    create_callback)
 
-        result, _ = loop.run_until_complete(asyncio.wait([
+        tasks = map(asyncio.ensure_future, [
             self.connector.create_machine(
                 'testmachine',
                 'alpine',
@@ -101,16 +113,17 @@ class TestConnector(TestCase):
             observable_1
             .first()
             .tap(lambda _: stop_1())
-            .timeout(5000)
+            .timeout(5000, scheduler=AsyncIOScheduler())
             .catch_exception(partial(listener_error, stop_1))
             .catch_exception(lambda _: Observable.just('failed')),
             observable_2
             .first()
             .tap(lambda _: stop_2())
-            .timeout(5000)
+            .timeout(5000, scheduler=AsyncIOScheduler())
             .catch_exception(partial(listener_error, stop_2))
             .catch_exception(lambda _: Observable.just('failed'))
-        ]))
+        ])
+        result, _ = loop.run_until_complete(asyncio.wait(tasks))
 
         failed = [r.result()
                   for r in result
@@ -148,17 +161,17 @@ class TestConnector(TestCase):
         create_callback = Mock(side_effect=create_calls)
         loop = asyncio.get_event_loop()
 
-        connector_1 = Connector('127.0.0.1')
+        connector_1 = Connector(HOST, **self.options)
         stop_1, observable_1 = connector_1.wait_for_machines(
                                    confirm_callback,
                                    create_callback)
 
-        connector_2 = Connector('127.0.0.1')
+        connector_2 = Connector(HOST, **self.options)
         stop_2, observable_2 = connector_2.wait_for_machines(
                                    confirm_callback,
                                    create_callback)
 
-        result, _ = loop.run_until_complete(asyncio.wait([
+        tasks = map(asyncio.ensure_future, [
             self.connector.create_machine(
                 'testmachine',
                 'alpine',
@@ -170,16 +183,17 @@ class TestConnector(TestCase):
             observable_1
             .first()
             .tap(lambda _: stop_1())
-            .timeout(20000)
+            .timeout(20000, scheduler=AsyncIOScheduler())
             .catch_exception(partial(listener_error, stop_1))
             .catch_exception(lambda _: Observable.just('failed')),
             observable_2
             .take(2)
             .tap(lambda _: stop_2())
-            .timeout(20000)
+            .timeout(20000, scheduler=AsyncIOScheduler())
             .catch_exception(partial(listener_error, stop_2))
             .catch_exception(lambda _: Observable.just('failed'))
-        ]))
+        ])
+        result, _ = loop.run_until_complete(asyncio.wait(tasks))
 
         failed = [r.result()
                   for r in result
@@ -194,3 +208,338 @@ class TestConnector(TestCase):
 
         self.assertEqual(created['host'], 'testhost')
         self.assertEqual(created['username'], 'testuser')
+
+    def test_unlimited_prefetch(self):
+        loop = asyncio.get_event_loop()
+        agent = Connector(HOST, **self.options)
+        stop, observable = agent.wait_for_machines(
+            Mock(return_value=True),
+            Mock(return_value=dict(host='testhost', username='testuser')),
+            prefetch=0)
+        subscription = observable.subscribe()
+
+        machine = loop.run_until_complete(
+            self.connector.request_machine(
+                'testmachine', 'alpine', 1, 512, 128, 'public-key',
+                retry=RetryPolicy(retries=0, timeout=1)))
+
+        subscription.dispose()
+        stop()
+        agent.messenger.close()
+
+        self.assertEqual(machine['host'], 'testhost')
+
+    def test_concurrent_requests(self):
+        lock = Lock()
+        running = []
+        peak = []
+
+        def create_callback(name, **kwargs):
+            with lock:
+                running.append(name)
+                peak.append(len(running))
+
+            sleep(0.2)
+
+            with lock:
+                running.remove(name)
+
+            if name == 'failing':
+                raise Exception('Oups')
+
+            return dict(host=name, username='testuser')
+
+        loop = asyncio.get_event_loop()
+        agent = Connector(HOST, **self.options)
+        stop, observable = agent.wait_for_machines(
+            Mock(return_value=True),
+            create_callback,
+            prefetch=4,
+            executor=ThreadPoolExecutor(4))
+        subscription = observable.subscribe()
+        names = ['testmachine-%d' % i for i in range(3)] + ['failing']
+
+        async def request(name):
+            try:
+                return await self.connector.request_machine(
+                    name, 'alpine', 1, 512, 128, 'public-key',
+                    retry=RetryPolicy(retries=0, timeout=1))
+            except Exception as error:
+                return error
+
+        async def timed(name):
+            started = loop.time()
+            result = await request(name)
+
+            return result, loop.time() - started
+
+        results, seconds = zip(*loop.run_until_complete(asyncio.gather(
+            *[timed(name) for name in names])))
+
+        subscription.dispose()
+        loop.run_until_complete(agent.drain(5))
+
+        # Unsettled requests would be requeued when the listener closes
+        stop()
+        channel = self.connector.messenger.channel()
+        left = channel.queue.declare(
+            self.connector.messenger.COMMAND_QUEUE_NAME %
+            'machine-requested', passive=True)['message_count']
+        channel.close()
+        agent.messenger.close()
+
+        self.assertEqual(max(peak), 4)
+        self.assertLess(max(seconds[:3]), 0.6)
+        self.assertEqual([r['host'] for r in results[:3]], names[:3])
+        self.assertIsInstance(results[3], Exception)
+        self.assertEqual(left, 0)
+
+    def test_idempotent_create_machine(self):
+        confirm_callback = Mock(return_value=True)
+        create_callback = Mock(return_value=dict(host='testhost',
+                                                 username='testuser'))
+
+        loop = asyncio.get_event_loop()
+        agent = Connector(HOST, **self.options)
+        stop, observable = agent.wait_for_machines(confirm_callback,
+                                                   create_callback)
+        subscription = observable.subscribe()
+
+        def request():
+            return loop.run_until_complete(
+                self.connector.request_machine('testmachine',
+                                               'alpine',
+                                               1,
+                                               512,
+                                               128,
+                                               'public-key',
+                                               key='testkey'))
+
+        first = request()
+        second = request()
+
+        subscription.dispose()
+        stop()
+        agent.messenger.close()
+
+        self.assertEqual(first, second)
+        confirm_callback.assert_called_once()
+        create_callback.assert_called_once()
+        self.assertIn('testkey', agent.created)
+
+    def test_drain_and_cancel(self):
+        created = asyncio.Event()
+        cancel_callback = Mock()
+
+        async def create_callback(**kwargs):
+            created.set()
+            await asyncio.sleep(0.1)
+            raise Exception('Oups')
+
+        loop = asyncio.get_event_loop()
+        agent = Connector(HOST, **self.options)
+        stop, observable = agent.wait_for_machines(
+            Mock(return_value=True),
+            create_callback,
+            cancel_callback=cancel_callback)
+        subscription = observable.subscribe()
+
+        async def confirm():
+            confirm = await self.connector.messenger.wait_for_response(
+                self.connector.messenger.publish_command(
+                    'machine-requested', name='testmachine',
+                    image='alpine', cpu=1, mem=512, disc=128,
+                    pkey='public-key'), 5)
+            self.connector.publish_response({}, confirm)
+            await created.wait()
+
+        loop.run_until_complete(asyncio.wait_for(confirm(), 5))
+
+        subscription.dispose()
+        left = loop.run_until_complete(agent.drain(5))
+
+        stop()
+        agent.messenger.close()
+
+        self.assertEqual(left, 0)
+        cancel_callback.assert_called_with(name='testmachine',
+                                           image='alpine',
+                                           cpu=1,
+                                           mem=512,
+                                           disc=128,
+                                           pkey='public-key')
+
+    def test_targeted_request(self):
+        loop = asyncio.get_event_loop()
+        capacity = lambda: dict(cpu=4, mem=4096, disc=1024)
+        full = Connector(HOST, **self.options)
+        free = Connector(HOST, **self.options)
+        refuse = Mock(return_value=False)
+        create_callback = Mock(return_value=dict(host=free.messenger.uuid,
+                                                 username='testuser'))
+
+        stop_watching = self.connector.watch_capacity()
+
+        # Both advertise capacity, but the full one refuses
+        stop_full, full_observable = full.wait_for_machines(
+            refuse, Mock(), capacity=capacity)
+        stop_free, free_observable = free.wait_for_machines(
+            Mock(return_value=True), create_callback, capacity=capacity)
+        subscriptions = [full_observable.subscribe(),
+                         free_observable.subscribe()]
+
+        async def request():
+            while len(self.connector.capacity) < 2:
+                await asyncio.sleep(0.01)
+
+            # The full agent is picked first
+            with patch.object(self.connector.capacity, 'pick',
+                              side_effect=[full.messenger.uuid,
+                                           free.messenger.uuid]):
+                started = loop.time()
+                machine = await self.connector.request_machine(
+                    'testmachine', 'alpine', 1, 512, 128, 'public-key',
+                    retry=RetryPolicy(retries=0, timeout=2))
+
+            return machine, loop.time() - started
+
+        machine, seconds = loop.run_until_complete(
+            asyncio.wait_for(request(), 5))
+
+        for subscription in subscriptions:
+            subscription.dispose()
+
+        stop_watching()
+        stop_full()
+        stop_free()
+        full.messenger.close()
+        free.messenger.close()
+
+        # Moved on without waiting for the request timeout
+        self.assertEqual(machine['host'], free.messenger.uuid)
+        self.assertLess(seconds, 1)
+        refuse.assert_called_once()
+        create_callback.assert_called_once()
+
+    def test_idle_agent_advertises(self):
+        loop = asyncio.get_event_loop()
+        agent = Connector(HOST, **self.options)
+        self.connector.capacity = CapacityIndex(max_age=0.2)
+
+        stop_watching = self.connector.watch_capacity()
+        stop, observable = agent.wait_for_machines(
+            Mock(return_value=True), Mock(),
+            capacity=lambda: dict(cpu=4, mem=4096, disc=1024),
+            advertise_interval=0.05)
+        subscription = observable.subscribe()
+
+        # Idle for longer than the index keeps agents
+        loop.run_until_complete(asyncio.sleep(0.5))
+        picked = self.connector.capacity.pick(1, 512, 128)
+
+        subscription.dispose()
+        stop()
+        stop_watching()
+        agent.messenger.close()
+
+        self.assertEqual(picked, agent.messenger.uuid)
+
+    def test_machine_progress(self):
+        async def create_callback(progress, **kwargs):
+            progress('image-pulled')
+            progress('booting', percent=50)
+
+            # Longer than the respond timeout, kept alive by heartbeats
+            await asyncio.sleep(1)
+
+            return dict(host='testhost', username='testuser')
+
+        loop = asyncio.get_event_loop()
+        agent = Connector(HOST, **self.options)
+        agent.PROGRESS_HEARTBEAT = 0.1
+        stop, observable = agent.wait_for_machines(
+            Mock(return_value=True),
+            create_callback)
+        subscription = observable.subscribe()
+
+        async def stream():
+            return [event async for event in self.connector.stream_machine(
+                'testmachine', 'alpine', 1, 512, 128, 'public-key',
+                retry=RetryPolicy(retries=0, timeout=0.5))]
+
+        events = loop.run_until_complete(asyncio.wait_for(stream(), 5))
+
+        subscription.dispose()
+        stop()
+        agent.messenger.close()
+
+        self.assertEqual([e['progress'] for e in events],
+                         ['accepted', 'image-pulled', 'booting', 'ready'])
+        self.assertEqual(events[2]['percent'], 50)
+        self.assertEqual(events[-1]['host'], 'testhost')
+        self.assertEqual(events[-1]['uuid'], agent.messenger.uuid)
+
+    def test_machine_lifecycle(self):
+        machines = {'machine-1': 'running', 'machine-2': 'running'}
+        loop = asyncio.get_event_loop()
+
+        def stop_callback(name):
+            if name in machines:
+                machines[name] = 'stopped'
+                return machines[name]
+
+        async def delete_callback(name):
+            if name == 'machine-2':
+                raise Exception('Oups')
+
+            return machines.pop(name, None)
+
+        def list_callback():
+            return [dict(name=name, state=state)
+                    for name, state in machines.items()]
+
+        agent = Connector(HOST, **self.options)
+        stop, observable = agent.manage_machines(stop_callback,
+                                                 delete_callback,
+                                                 list_callback)
+        subscription = observable.subscribe()
+
+        def results(observable):
+            return loop.run_until_complete(observable.to_list())
+
+        stopped = results(self.connector.stop_machines(
+            ['machine-1', 'machine-2', 'machine-3'], timeout=0.5))
+        listed = results(self.connector.list_machines(timeout=0.2))
+        deleted = results(self.connector.delete_machines(
+            ['machine-1', 'machine-2'], timeout=1))
+
+        subscription.dispose()
+        stop()
+        agent.messenger.close()
+
+        self.assertEqual(sorted((r['name'], r.get('result'), r.get('error'))
+                                for r in stopped),
+                         [('machine-1', 'stopped', None),
+                          ('machine-2', 'stopped', None),
+                          ('machine-3', None, 'timeout')])
+        self.assertEqual(stopped[0]['agent'], agent.messenger.uuid)
+        self.assertEqual(sorted(r['result']['state'] for r in listed),
+                         ['stopped', 'stopped'])
+        self.assertEqual(sorted((r['name'], r.get('error'))
+                                for r in deleted),
+                         [('machine-1', None), ('machine-2', 'Oups')])
+        self.assertEqual(list(machines), ['machine-2'])
+
+    def test_machine_command_dispose(self):
+        loop = asyncio.get_event_loop()
+        received = []
+        subscription = self.connector \
+            .stop_machines(['machine-1'], timeout=0.05) \
+            .subscribe(received.append,
+                       on_completed=lambda: received.append('completed'))
+
+        # Disposing only stops listening, there are no timeouts
+        subscription.dispose()
+        loop.run_until_complete(asyncio.sleep(0.1))
+
+        self.assertEqual(received, [])
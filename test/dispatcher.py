@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from clique_connector.dispatcher import ReplyDispatcher
+
+
+def reply(correlation_id):
+    return Mock(correlation_id=correlation_id)
+
+
+class TestReplyDispatcher(TestCase):
+
+    def setUp(self):
+        self.dispatcher = ReplyDispatcher(max_pending=2)
+
+    def test_dispatch_to_subscriber(self):
+        callback = Mock()
+        self.dispatcher.subscribe('a', callback)
+
+        message = reply('a')
+        self.dispatcher.dispatch(message)
+        self.dispatcher.dispatch(reply('b'))
+
+        callback.assert_called_once_with(message)
+
+    def test_early_reply(self):
+        message = reply('a')
+        self.dispatcher.dispatch(message)
+
+        callback = Mock()
+        self.dispatcher.subscribe('a', callback)
+
+        callback.assert_called_once_with(message)
+
+    def test_unsubscribe(self):
+        callback = Mock()
+        unsubscribe = self.dispatcher.subscribe('a', callback)
+        unsubscribe()
+
+        self.dispatcher.dispatch(reply('a'))
+
+        callback.assert_not_called()
+
+    def test_drop_unclaimed(self):
+        messages = [reply(c) for c in 'abc']
+
+        for message in messages:
+            self.dispatcher.dispatch(message)
+
+        messages[0].ack.assert_called_once_with()
+        messages[1].ack.assert_not_called()
+        messages[2].ack.assert_not_called()
+
+        callback = Mock()
+        self.dispatcher.subscribe('a', callback)
+
+        callback.assert_not_called()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from unittest import TestCase
+
+from clique_connector.fairness import FairShare
+
+
+class TestFairShare(TestCase):
+
+    def run_tasks(self, share, tenants):
+        order = []
+
+        async def task(tenant, index):
+            async with share.slot(tenant):
+                order.append('%s%d' % (tenant, index))
+                await asyncio.sleep(0)
+
+        async def run():
+            await asyncio.gather(*[task(tenant, index)
+                                   for index, tenant
+                                   in enumerate(tenants)])
+
+        asyncio.get_event_loop().run_until_complete(run())
+
+        return order
+
+    def test_round_robin(self):
+        share = FairShare(1)
+        order = self.run_tasks(share, ['a', 'a', 'a', 'a', 'b', 'c'])
+
+        # The first one runs right away, then the tenants take turns
+        self.assertEqual(order, ['a0', 'a1', 'b4', 'c5', 'a2', 'a3'])
+        self.assertEqual(share.free, 1)
+        self.assertEqual(len(share), 0)
+
+    def test_concurrency(self):
+        share = FairShare(2)
+        running = []
+        peak = []
+
+        async def task():
+            async with share.slot():
+                running.append(None)
+                peak.append(len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+
+        asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(*[task() for _ in range(6)]))
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(share.free, 2)
+
+    def test_unbounded(self):
+        share = FairShare(None)
+        running = []
+        peak = []
+
+        async def task():
+            async with share.slot('a'):
+                running.append(None)
+                peak.append(len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+
+        asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(*[task() for _ in range(6)]))
+
+        self.assertEqual(max(peak), 6)
+        self.assertEqual(len(share), 0)
+
+    def test_cancel(self):
+        share = FairShare(1)
+        loop = asyncio.get_event_loop()
+
+        async def run():
+            await share.acquire('a')
+            waiting = asyncio.ensure_future(share.acquire('b'))
+            await asyncio.sleep(0)
+
+            waiting.cancel()
+            share.release()
+
+            await asyncio.sleep(0)
+
+        loop.run_until_complete(run())
+
+        self.assertEqual(share.free, 1)
+        self.assertEqual(share.tenants(), [])
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from amqpstorm import AMQPChannelError, AMQPConnectionError
+from functools import partial
+from unittest import TestCase
+from unittest.mock import Mock
+
+from clique_connector import Connector, Messenger
+from clique_connector.memory import MemoryBroker, \
+                                    MemoryConnection, \
+                                    MemoryTransport
+from clique_connector.retry import RetryPolicy
+
+
+def run_pending(loop):
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+class TestMemoryBroker(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.broker = MemoryBroker(self.loop)
+        self.connection = MemoryConnection(self.broker)
+        self.channel = self.connection.channel()
+
+    def publish(self, body, routing_key, exchange=''):
+        self.channel.basic.publish(body, routing_key, exchange)
+
+    def test_fanout(self):
+        self.channel.exchange.declare('status', 'fanout')
+
+        for name in ('a', 'b'):
+            self.channel.queue.declare(name)
+            self.channel.queue.bind(name, 'status')
+
+        self.publish('hello', '', 'status')
+
+        self.assertEqual(self.channel.basic.get('a').body, 'hello')
+        self.assertEqual(self.channel.basic.get('b').body, 'hello')
+
+    def test_direct(self):
+        self.channel.exchange.declare('commands', 'direct')
+        self.channel.queue.declare('a')
+        self.channel.queue.bind('a', 'commands', 'a')
+
+        self.publish('a', 'a', 'commands')
+        self.publish('b', 'b', 'commands')
+
+        self.assertEqual(self.channel.basic.get('a').body, 'a')
+        self.assertIsNone(self.channel.basic.get('a'))
+
+    def test_reject_and_requeue(self):
+        self.channel.queue.declare('q')
+        self.publish('first', 'q')
+        self.publish('second', 'q')
+
+        message = self.channel.basic.get('q')
+        message.reject(requeue=True)
+
+        message = self.channel.basic.get('q')
+        self.assertEqual(message.body, 'first')
+        self.assertTrue(message.redelivered)
+        message.ack()
+
+        self.channel.basic.get('q').reject(requeue=False)
+        self.assertIsNone(self.channel.basic.get('q'))
+
+    def test_close_requeues(self):
+        self.channel.queue.declare('q')
+        self.publish('message', 'q')
+        self.channel.basic.get('q')
+        self.channel.close()
+
+        channel = self.connection.channel()
+        self.assertEqual(channel.basic.get('q').body, 'message')
+
+    def test_consume_prefetch(self):
+        received = []
+        self.channel.queue.declare('q')
+        self.channel.basic.qos(1)
+        self.channel.basic.consume(received.append, 'q')
+
+        self.publish('first', 'q')
+        self.publish('second', 'q')
+        run_pending(self.loop)
+
+        self.assertEqual([m.body for m in received], ['first'])
+
+        received[0].ack()
+        run_pending(self.loop)
+
+        self.assertEqual([m.body for m in received], ['first', 'second'])
+
+    def test_exclusive(self):
+        self.channel.queue.declare('q', exclusive=True)
+
+        other = MemoryConnection(self.broker).channel()
+        self.assertRaises(AMQPChannelError, other.queue.declare, 'q')
+
+        self.connection.close()
+        other.queue.declare('q')
+
+    def test_priority(self):
+        self.channel.queue.declare('q', arguments={'x-max-priority': 5})
+
+        for body, priority in (('low', None), ('high', 5),
+                               ('higher', 9), ('mid', 2)):
+            self.channel.basic.publish(body, 'q',
+                                       properties=dict(priority=priority))
+
+        bodies = [self.channel.basic.get('q').body for _ in range(4)]
+
+        # Priorities above the max count as the max
+        self.assertEqual(bodies, ['high', 'higher', 'mid', 'low'])
+        self.assertRaises(AMQPChannelError,
+                          self.channel.queue.declare, 'q')
+
+    def test_priority_commands(self):
+        messenger = Messenger('memory',
+                              transport=MemoryTransport(self.broker),
+                              max_priority=10)
+        messenger.publish_command('some-command', name='bulk')
+        messenger.publish_command('some-command', name='interactive',
+                                  priority=10)
+
+        queue = messenger.COMMAND_QUEUE_NAME % 'some-command'
+        names = [self.channel.basic.get(queue).json()['name']
+                 for _ in range(2)]
+
+        messenger.close()
+
+        self.assertEqual(names, ['interactive', 'bulk'])
+
+
+class TestMemoryReconnect(TestCase):
+
+    def test_reconnect(self):
+        loop = asyncio.get_event_loop()
+        messenger = Messenger('memory',
+                              transport=MemoryTransport(MemoryBroker(loop)))
+        messenger.HEALTH_INTERVAL = 0.01
+
+        stop, observable = messenger.get_command_listener('test')
+        received = asyncio.ensure_future(
+            observable
+            .tap(lambda m: m.ack())
+            .map(lambda m: m.json())
+            .first())
+
+        messenger.connection.kill()
+        loop.run_until_complete(asyncio.sleep(0.1))
+
+        checksum = messenger.publish_command('test')
+        command = loop.run_until_complete(
+            asyncio.wait_for(received, 1))
+
+        self.assertEqual(command['checksum'], checksum)
+
+        stop()
+        messenger.close()
+
+    def test_agent_survives_reconnect(self):
+        loop = asyncio.get_event_loop()
+        broker = MemoryBroker(loop)
+        agent = Connector('memory', transport=MemoryTransport(broker))
+        agent.messenger.HEALTH_INTERVAL = 0.01
+        requester = Connector('memory', transport=MemoryTransport(broker),
+                              retry=RetryPolicy(retries=0, timeout=2))
+        killed = []
+
+        async def create_callback(name, **kwargs):
+            # Lose the connection while the first request is in flight
+            if not killed:
+                killed.append(name)
+                agent.messenger.connection.kill()
+                await asyncio.sleep(0.1)
+
+            return dict(host=name, username='root')
+
+        stop, observable = agent.wait_for_machines(Mock(return_value=True),
+                                                   create_callback)
+        errors = []
+        subscription = observable.subscribe(on_error=errors.append)
+
+        def request(name):
+            return loop.run_until_complete(
+                requester.request_machine(name, 'alpine', 1, 512, 128,
+                                          'public-key'))
+
+        first = request('first')
+        second = request('second')
+
+        subscription.dispose()
+        stop()
+        agent.messenger.close()
+        requester.messenger.close()
+
+        self.assertEqual(killed, ['first'])
+        self.assertEqual(first['host'], 'first')
+        self.assertEqual(second['host'], 'second')
+        self.assertEqual(errors, [])
+
+    def test_failover(self):
+        loop = asyncio.get_event_loop()
+        transport = FlakyTransport(MemoryBroker(loop))
+        messenger = Messenger('a,b', transport=transport, connections=2)
+        messenger.HEALTH_INTERVAL = 0.01
+
+        stop, observable = messenger.get_command_listener('test')
+        received = asyncio.ensure_future(
+            observable
+            .tap(lambda m: m.ack())
+            .map(lambda m: m.json())
+            .first())
+
+        self.assertEqual(transport.hosts, ['a', 'b'])
+
+        # Lose a node, its connection fails over to the other one
+        transport.down.add('a')
+        transport.connections[0].kill()
+        loop.run_until_complete(asyncio.sleep(0.1))
+
+        checksum = messenger.publish_command('test')
+        command = loop.run_until_complete(
+            asyncio.wait_for(received, 1))
+
+        self.assertEqual(command['checksum'], checksum)
+        self.assertEqual(transport.hosts[-1], 'b')
+
+        stop()
+        messenger.close()
+
+    def test_spread(self):
+        loop = asyncio.get_event_loop()
+        transport = FlakyTransport(MemoryBroker(loop))
+        messenger = Messenger(['a', 'b'], transport=transport,
+                              connections=2)
+        channels = [messenger.channel() for _ in range(4)]
+
+        self.assertEqual(transport.hosts, ['a', 'b'])
+        self.assertEqual([len(c.channels)
+                          for c in transport.connections], [2, 2])
+
+        for channel in channels:
+            channel.close()
+
+        messenger.close()
+
+
+class TestMemoryPublish(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.transport = FlakyTransport(MemoryBroker(self.loop))
+        self.messenger = Messenger('a', transport=self.transport)
+        self.messenger.HEALTH_INTERVAL = 0.01
+        self.channel = MemoryConnection(self.transport.broker).channel()
+        self.queue = self.messenger.declare_command('test', self.channel)
+
+    def tearDown(self):
+        self.messenger.close()
+
+    def received(self):
+        messages = []
+
+        while True:
+            message = self.channel.basic.get(self.queue)
+
+            if message is None:
+                return messages
+
+            messages.append(message)
+
+    def test_batch(self):
+        with self.messenger.batch() as batch:
+            for index in range(5):
+                batch.publish_command('test', index=index)
+
+            self.assertEqual(self.received(), [])
+
+        messages = self.received()
+
+        self.assertEqual([m.message_id for m in messages],
+                         batch.checksums)
+        self.assertEqual([m.json()['index'] for m in messages],
+                         list(range(5)))
+
+    def test_confirmed_batch(self):
+        with self.messenger.batch(confirm=True) as batch:
+            batch.publish_command('test', index=0)
+
+        self.assertEqual(len(self.received()), 1)
+
+        # The broker is down, confirmed publishes raise
+        self.transport.down.add('a')
+        self.transport.connections[0].kill()
+
+        def publish():
+            with self.messenger.batch(confirm=True) as batch:
+                batch.publish_command('test', index=1)
+
+        self.assertRaises(AMQPConnectionError, publish)
+
+        self.transport.down.clear()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+        self.assertEqual(self.received(), [])
+
+    def test_buffered(self):
+        self.messenger.publish_command('test', index=0)
+        self.transport.down.add('a')
+        self.transport.connections[0].kill()
+
+        # Buffered while the broker is down
+        checksums = self.messenger.publish_many(
+            [(dict(command='test', index=index),
+              partial(self.messenger.command_exchange, 'test'),
+              None)
+             for index in (1, 2)])
+
+        self.assertEqual(len(self.received()), 1)
+
+        # And flushed when reconnected
+        self.transport.down.clear()
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+        messages = self.received()
+
+        self.assertEqual([m.message_id for m in messages], checksums)
+        self.assertEqual([m.json()['index'] for m in messages], [1, 2])
+
+
+class FlakyTransport(MemoryTransport):
+    """Refuses to connect to hosts which are down and keeps track of
+    the connections it made.
+    """
+
+    def __init__(self, broker, down=()):
+        super().__init__(broker)
+        self.down = set(down)
+        self.hosts = []
+        self.connections = []
+
+    def connect(self, host, heartbeat):
+        if host in self.down:
+            raise AMQPConnectionError('%s is down' % host)
+
+        self.hosts.append(host)
+        self.connections.append(super().connect(host, heartbeat))
+
+        return self.connections[-1]
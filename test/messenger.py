@@ -10,11 +10,14 @@ import asyncio
 import logging
 
 from functools import partial
+from rx.concurrency import AsyncIOScheduler
 from unittest import TestCase
 
 from clique_connector import Messenger
 from clique_connector.util import listener_error, filter_message
 
+from .util import HOST, transport_options
+
 
 # logging.basicConfig(level=logging.DEBUG)
 
@@ -28,7 +31,7 @@ def get_response(messenger, checksum, test_values, response_checksum):
                             **test_values))) \
         .tap(lambda m: m.ack()) \
         .first() \
-        .timeout(3000) \
+        .timeout(3000, scheduler=AsyncIOScheduler()) \
         .tap(lambda _: stop()) \
         .catch_exception(partial(listener_error, stop))
 
@@ -36,7 +39,8 @@ def get_response(messenger, checksum, test_values, response_checksum):
 class TestMessenger(TestCase):
 
     def setUp(self):
-        self.messenger = Messenger('127.0.0.1')
+        self.options = transport_options()
+        self.messenger = Messenger(HOST, **self.options)
 
     def tearDown(self):
         if self.messenger.connection is not None:
@@ -46,7 +50,8 @@ class TestMessenger(TestCase):
         loop = asyncio.get_event_loop()
         stop, observable = self.messenger.get_status_listener()
 
-        messenger = Messenger('127.0.0.1')
+        messenger = Messenger(HOST, **self.options)
+        loop.run_until_complete(messenger.start())
 
         status = loop.run_until_complete(
             observable
@@ -57,7 +62,7 @@ class TestMessenger(TestCase):
                     m['uuid'] == messenger.uuid)
             .first()
             .tap(lambda _: stop())
-            .timeout(3000)
+            .timeout(3000, scheduler=AsyncIOScheduler())
             .catch_exception(partial(listener_error, stop)))
 
         self.assertIsInstance(status['uname'], list)
@@ -66,7 +71,7 @@ class TestMessenger(TestCase):
         self.assertEqual(status['uuid'], messenger.uuid)
 
     def test_command(self):
-        stop, observable = self.messenger.get_command_listener()
+        stop, observable = self.messenger.get_command_listener('test')
         checksum = self.messenger.publish_command('test',
                                                   arg='value')
         loop = asyncio.get_event_loop()
@@ -81,7 +86,7 @@ class TestMessenger(TestCase):
                     m['checksum'] == checksum
                 )
             .first()
-            .timeout(3000)
+            .timeout(3000, scheduler=AsyncIOScheduler())
             .tap(lambda _: stop())
             .catch_exception(partial(listener_error, stop)))
 
@@ -91,7 +96,7 @@ class TestMessenger(TestCase):
         self.assertIsInstance(command['time'], float)
 
     def test_response(self):
-        stop, observable = self.messenger.get_command_listener()
+        stop, observable = self.messenger.get_command_listener('test')
         checksum = self.messenger.publish_command('test',
                                                   arg='value')
         loop = asyncio.get_event_loop()
@@ -113,7 +118,7 @@ class TestMessenger(TestCase):
                               checksum,
                               dict(test_checksum=checksum)))
             .map(lambda m: m.json())
-            .timeout(3000)
+            .timeout(3000, scheduler=AsyncIOScheduler())
             .tap(lambda _: stop())
             .catch_exception(partial(listener_error, stop)))
 
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from clique_connector import Connector
+from clique_connector.metrics import (CallbackMetrics, NullMetrics,
+                                      RegistryMetrics)
+
+from .util import HOST, transport_options
+
+
+class TestMetrics(TestCase):
+
+    def test_registry(self):
+        metrics = RegistryMetrics()
+
+        metrics.increment('messages_published')
+        metrics.increment('messages_published', 2)
+        metrics.observe('handshake_seconds', 0.5, stage='request')
+        metrics.observe('handshake_seconds', 1.5, stage='request')
+
+        self.assertEqual(metrics.counter('messages_published'), 3)
+        self.assertEqual(metrics.counter('machine_retries'), 0)
+        self.assertEqual(metrics.timing('handshake_seconds',
+                                        stage='request'),
+                         dict(count=2, sum=2.0, min=0.5, max=1.5))
+        self.assertIsNone(metrics.timing('handshake_seconds',
+                                         stage='create'))
+        self.assertEqual(len(metrics.collect()), 2)
+
+    def test_callbacks(self):
+        on_increment = Mock()
+        metrics = CallbackMetrics(on_increment=on_increment)
+
+        metrics.increment('machine_rejects')
+        metrics.observe('encode_seconds', 0.1)
+
+        on_increment.assert_called_once_with('machine_rejects', 1)
+        self.assertFalse(NullMetrics().enabled)
+
+    def test_handshake(self):
+        metrics = RegistryMetrics()
+        options = transport_options()
+        requester = Connector(HOST, metrics=metrics, **options)
+        agent = Connector(HOST, **options)
+
+        async def confirm(**kwargs):
+            return True
+
+        async def create(**kwargs):
+            return dict(host='testhost', username='testuser')
+
+        stop, observable = agent.wait_for_machines(confirm, create)
+        subscription = observable.subscribe()
+
+        loop = asyncio.get_event_loop()
+        machine = loop.run_until_complete(requester.request_machine(
+            'testmachine', 'alpine', 1, 512, 128, 'public-key'))
+
+        subscription.dispose()
+        stop()
+        requester.messenger.close()
+        agent.messenger.close()
+
+        self.assertEqual(machine['host'], 'testhost')
+        self.assertEqual(metrics.counter('messages_published'), 2)
+        self.assertGreaterEqual(metrics.counter('messages_consumed'), 2)
+        self.assertEqual(metrics.timing('encode_seconds')['count'], 2)
+        self.assertEqual(metrics.timing('handshake_seconds',
+                                        stage='request')['count'], 1)
+        self.assertEqual(metrics.timing('handshake_seconds',
+                                        stage='respond')['count'], 1)
+        self.assertEqual(metrics.timing('machine_seconds')['count'], 1)
+        self.assertEqual(metrics.counter('machine_retries'), 0)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+from threading import Thread
+from unittest import TestCase
+
+from clique_connector.memory import MemoryBroker, MemoryConnection
+from clique_connector.pool import ChannelPool
+
+
+class TestChannelPool(TestCase):
+
+    def setUp(self):
+        self.connection = MemoryConnection(MemoryBroker())
+        self.pool = ChannelPool(self.connection.channel, 2)
+
+    def test_reuse(self):
+        with self.pool.channel() as channel:
+            pass
+
+        with self.pool.channel() as reused:
+            self.assertIs(reused, channel)
+
+        self.assertEqual(len(self.connection.channels), 1)
+
+    def test_size(self):
+        channels = [self.pool.acquire() for _ in range(2)]
+        acquired = []
+        waiting = Thread(target=lambda: acquired.append(
+            self.pool.acquire()))
+        waiting.start()
+        waiting.join(0.1)
+
+        # Blocks until a channel is given back
+        self.assertTrue(waiting.is_alive())
+
+        self.pool.release(channels[0])
+        waiting.join(1)
+
+        self.assertEqual(acquired, [channels[0]])
+
+    def test_discard(self):
+        with self.pool.channel() as closed:
+            closed.close()
+
+        def fail():
+            with self.pool.channel() as failed:
+                raise ValueError(failed)
+
+        with self.assertRaises(ValueError) as context:
+            fail()
+
+        failed = context.exception.args[0]
+
+        self.assertTrue(failed.is_closed)
+
+        with self.pool.channel() as channel:
+            self.assertNotIn(channel, (closed, failed))
+
+    def test_close(self):
+        idle, borrowed = self.pool.acquire(), self.pool.acquire()
+        self.pool.release(idle)
+        self.pool.close()
+
+        self.assertTrue(idle.is_closed)
+        self.assertTrue(borrowed.is_open)
+
+        # Given back after the pool was closed
+        self.pool.release(borrowed)
+
+        self.assertTrue(borrowed.is_closed)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from time import monotonic
+from unittest import TestCase
+
+from clique_connector import Connector
+from clique_connector.retry import RetryPolicy
+
+from .util import HOST, transport_options
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_backoff(self):
+        policy = RetryPolicy(delay=1, max_delay=5, jitter=0)
+
+        self.assertEqual([policy.backoff(retries)
+                          for retries in range(1, 6)],
+                         [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        policy = RetryPolicy(delay=1, jitter=0.5)
+
+        for _ in range(100):
+            self.assertTrue(0.5 <= policy.backoff(1) <= 1)
+
+    def test_stage_timeout(self):
+        policy = RetryPolicy(timeout=5, timeouts=dict(confirm=1))
+
+        self.assertEqual(policy.stage_timeout('request'), 5)
+        self.assertEqual(policy.stage_timeout('confirm'), 1)
+        self.assertLessEqual(policy.stage_timeout('request',
+                                                  monotonic() + 2), 2)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            policy.stage_timeout('request', monotonic() - 1)
+
+    def test_should_retry(self):
+        policy = RetryPolicy(retries=2)
+
+        self.assertTrue(policy.should_retry(1))
+        self.assertFalse(policy.should_retry(2))
+        self.assertFalse(policy.should_retry(0, monotonic() - 1))
+        self.assertIsNone(policy.start())
+
+    def test_deadline(self):
+        connector = Connector(HOST, **transport_options())
+        policy = RetryPolicy(timeout=0.1, delay=0.01, deadline=0.5)
+        loop = asyncio.get_event_loop()
+        started = monotonic()
+
+        # No agents, so every attempt times out
+        with self.assertRaises(asyncio.TimeoutError):
+            loop.run_until_complete(connector.request_machine(
+                'testmachine', 'alpine', 1, 512, 128, 'public-key',
+                retry=policy))
+
+        connector.messenger.close()
+
+        self.assertLess(monotonic() - started, 2)
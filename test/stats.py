@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from clique_connector import Connector, stats
+from clique_connector.stats import StatsStore, percentile
+
+from .util import HOST, transport_options
+
+
+class TestStatsStore(TestCase):
+
+    def setUp(self):
+        self.store = StatsStore()
+
+        for second in range(600):
+            self.store.add('agent', 1000 + second,
+                           dict(load=second, name='ignored'))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 50), 3)
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 90), 5)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summary(self):
+        minute = self.store.summary('agent', 60)['load']
+
+        self.assertEqual(minute['last'], 599)
+        self.assertEqual(minute['count'], 61)
+        self.assertEqual(minute['min'], 539)
+        self.assertEqual(minute['mean'], 569)
+        self.assertEqual(minute['p50'], 569)
+        self.assertEqual(minute['p99'], 599)
+        self.assertEqual(self.store.summary('agent', 300)['load']
+                         ['count'], 301)
+        self.assertNotIn('name', self.store.summary('agent'))
+        self.assertEqual(self.store.summary('unknown'), {})
+
+    def test_ring(self):
+        store = StatsStore(capacity=10)
+
+        for second in range(25):
+            store.add('agent', second, dict(load=second))
+
+        self.assertEqual(store.last('agent', 'load'), 24)
+        self.assertEqual(store.summary('agent', 3600)['load']['count'],
+                         10)
+        self.assertEqual(store.summary('agent', 3600)['load']['min'],
+                         15)
+
+    def test_missing_values(self):
+        self.store.add('agent', 1600, dict(mem=1024))
+
+        self.assertIsNone(self.store.last('agent', 'load'))
+        self.assertEqual(self.store.last('agent', 'mem'), 1024)
+        self.assertEqual(self.store.summary('agent', 60)['mem']['count'],
+                         1)
+
+    def test_fleet(self):
+        for queries in (True, False):
+            with patch.object(stats, 'numpy',
+                              stats.numpy if queries else None):
+                store = StatsStore(capacity=10)
+
+                for index in range(5):
+                    store.add('agent-%d' % index, 1, dict(load=index))
+
+                store.touch('idle')
+                store.remove('agent-0')
+                store.add('agent-5', 1, dict(mem=1))
+
+                self.assertEqual(store.fleet_sum('load'), 10)
+                self.assertEqual(store.top('load', 2),
+                                 [('agent-4', 4), ('agent-3', 3)])
+                self.assertEqual([value for _, value
+                                  in store.top('load', 10)], [4, 3, 2, 1])
+                self.assertEqual(store.summary('agent-3', 60)['load']
+                                 ['last'], 3)
+                self.assertEqual(store.fleet_sum('unknown'), 0)
+                self.assertEqual(len(store), 6)
+
+    def test_reuse_rows(self):
+        self.store.remove('agent')
+        self.store.add('other', 1, dict(mem=1))
+
+        self.assertEqual(self.store.summary('other')['mem']['count'], 1)
+        self.assertNotIn('load', self.store.summary('other'))
+
+    def test_expire(self):
+        self.assertEqual(self.store.last('agent', 'load'), 599)
+
+        self.store.max_age = -1
+        self.store.expire()
+
+        self.assertEqual(len(self.store), 0)
+        self.assertIsNone(self.store.last('agent', 'load'))
+
+    def test_listen_for_stats(self):
+        options = transport_options()
+        listener = Connector(HOST, **options)
+        agent = Connector(HOST, **options)
+        loop = asyncio.get_event_loop()
+
+        stop_listening = listener.listen_for_stats(batch_time=0.05)
+        stop_sending = agent.send_stats(lambda: dict(load=0.5),
+                                        interval=0.01)
+
+        async def wait():
+            while listener.stats.last(agent.messenger.uuid,
+                                      'load') is None:
+                await asyncio.sleep(0.01)
+
+        loop.run_until_complete(asyncio.wait_for(wait(), 5))
+
+        stop_sending()
+        stop_listening()
+        listener.messenger.close()
+        agent.messenger.close()
+
+        self.assertEqual(listener.stats.agents(), [agent.messenger.uuid])
+        self.assertEqual(listener.stats.summary(
+            agent.messenger.uuid)['load']['mean'], 0.5)
+
+    def test_status_listeners(self):
+        options = transport_options()
+        listener = Connector(HOST, connections=2, **options)
+        agent = Connector(HOST, **options)
+        loop = asyncio.get_event_loop()
+
+        update = listener.capacity.update = Mock(
+            wraps=listener.capacity.update)
+
+        # Both listen to every status, on either connection
+        stop_watching = listener.watch_capacity()
+        stop_listening = listener.listen_for_stats(batch_time=0.05)
+
+        for _ in range(10):
+            agent.advertise_capacity(lambda: dict(cpu=1, mem=512,
+                                                  disc=128))
+
+        async def wait():
+            while update.call_count < 10 or \
+                    agent.messenger.uuid not in listener.stats.agents():
+                await asyncio.sleep(0.01)
+
+        loop.run_until_complete(asyncio.wait_for(wait(), 5))
+
+        stop_watching()
+        stop_listening()
+        listener.messenger.close()
+        agent.messenger.close()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+import multiprocessing
+
+from time import sleep
+from unittest import TestCase
+
+from clique_connector.memory import MemoryTransport
+from clique_connector.supervisor import SharedCapacity, Supervisor, \
+                                        releasing, reserving
+
+
+def confirm(**kwargs):
+    return True
+
+
+def create(**kwargs):
+    return dict(host='testhost', username='testuser')
+
+
+def delete(name):
+    return 'deleted' if name == 'testmachine' else None
+
+
+class TestSupervisor(TestCase):
+
+    def test_shared_capacity(self):
+        capacity = SharedCapacity(cpu=2, mem=1024, disc=256)
+
+        self.assertTrue(capacity.reserve(cpu=1, mem=512, disc=128))
+        self.assertFalse(capacity.reserve(cpu=1, mem=1024, disc=128))
+        self.assertEqual(capacity(), dict(cpu=1, mem=512, disc=128))
+
+        capacity.release(cpu=1, mem=512, disc=128)
+
+        self.assertEqual(capacity.free(), dict(cpu=2, mem=1024, disc=256))
+
+    def test_reserving(self):
+        capacity = SharedCapacity(cpu=1, mem=1024, disc=256)
+        machine = dict(name='testmachine', image='alpine', cpu=1,
+                       mem=512, disc=128, pkey='public-key')
+
+        self.assertTrue(reserving(capacity, confirm)(**machine))
+        self.assertFalse(reserving(capacity, confirm)(**machine))
+
+        async def refuse(**kwargs):
+            return False
+
+        capacity.release(**machine)
+        loop = asyncio.get_event_loop()
+
+        self.assertFalse(loop.run_until_complete(
+            reserving(capacity, refuse)(**machine)))
+        self.assertEqual(capacity.free()['cpu'], 1)
+
+    def test_releasing(self):
+        capacity = SharedCapacity(cpu=2, mem=1024, disc=256)
+        machine = dict(name='testmachine', image='alpine', cpu=1,
+                       mem=512, disc=128, pkey='public-key')
+
+        # Reserved by a worker, released by another one
+        worker = multiprocessing.Process(
+            target=reserving(capacity, confirm), kwargs=machine)
+        worker.start()
+        worker.join()
+
+        self.assertEqual(capacity.reserved(), ['testmachine'])
+        self.assertEqual(capacity.free()['cpu'], 1)
+
+        # Machines the agent doesn't have are left alone
+        self.assertIsNone(releasing(capacity, delete)(name='other'))
+        self.assertEqual(capacity.free()['cpu'], 1)
+
+        self.assertEqual(releasing(capacity, delete)(name='testmachine'),
+                         'deleted')
+        self.assertEqual(capacity.free(), dict(cpu=2, mem=1024, disc=256))
+        self.assertEqual(capacity.reserved(), [])
+
+        # Released once only
+        capacity.release(**machine)
+        self.assertEqual(capacity.free()['cpu'], 2)
+
+    def test_workers(self):
+        supervisor = Supervisor('memory', confirm, create, workers=2,
+                                capacity=SharedCapacity(2, 1024, 256),
+                                drain_timeout=1,
+                                delete_callback=delete,
+                                transport=MemoryTransport())
+        supervisor.start()
+        sleep(0.5)
+
+        self.assertTrue(all(p.is_alive() for p in supervisor.processes))
+
+        # A dead worker is restarted
+        supervisor.processes[0].kill()
+        supervisor.processes[0].join()
+        supervisor.check()
+
+        self.assertTrue(supervisor.processes[0].is_alive())
+
+        sleep(0.5)
+        supervisor.stop()
+
+        self.assertEqual([p.exitcode for p in supervisor.processes],
+                         [0, 0])
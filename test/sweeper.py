@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import asyncio
+
+from unittest import TestCase
+
+from clique_connector import Messenger
+from clique_connector.memory import MemoryBroker, \
+                                    MemoryConnection, \
+                                    MemoryTransport
+from clique_connector.sweeper import ReplyQueueSweeper
+
+
+class TestReplyQueueSweeper(TestCase):
+
+    def setUp(self):
+        self.broker = MemoryBroker(asyncio.get_event_loop())
+        self.messenger = Messenger('memory',
+                                   transport=MemoryTransport(self.broker),
+                                   reply_ttl=0.5)
+
+        # Sets up the messenger's own reply queue
+        self.messenger.ensure_reply_queue()
+
+    def tearDown(self):
+        self.messenger.close()
+
+    def test_reply_arguments(self):
+        queues = {queue['name']: queue
+                  for queue in self.broker.list_queues()}
+        reply = queues[Messenger.RESPONSE_QUEUE_NAME %
+                       self.messenger.uuid]
+
+        self.assertTrue(reply['exclusive'])
+        self.assertEqual(reply['arguments'], {'x-message-ttl': 500})
+
+    def test_sweep(self):
+        channel = MemoryConnection(self.broker).channel()
+
+        channel.queue.declare('clique-response-orphan', durable=True)
+        channel.basic.publish(b'late reply', 'clique-response-orphan')
+        channel.queue.declare('clique-response-consumed')
+        channel.basic.consume(lambda _: None, 'clique-response-consumed')
+        channel.queue.declare('some-other-queue')
+
+        sweeper = ReplyQueueSweeper(self.messenger,
+                                    self.broker.list_queues)
+
+        self.assertEqual(sweeper.sweep(dry_run=True),
+                         ['clique-response-orphan'])
+        self.assertEqual(sweeper.sweep(), ['clique-response-orphan'])
+        self.assertEqual(sweeper.orphans(), [])
+        self.assertEqual(
+            sorted(queue['name'] for queue in self.broker.list_queues()),
+            sorted(['clique-response-consumed',
+                    'some-other-queue',
+                    Messenger.RESPONSE_QUEUE_NAME % self.messenger.uuid]))
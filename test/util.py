@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2016 Olof Montin <olof@montin.net>
+
+This file is part of clique-connector.
+"""
+
+import os
+
+from clique_connector.memory import MemoryTransport
+
+
+# Tests run against an in-process broker, unless CLIQUE_TEST_AMQP is set
+# to the host of a RabbitMQ.
+AMQP_HOST = os.environ.get('CLIQUE_TEST_AMQP')
+HOST = AMQP_HOST or '127.0.0.1'
+
+
+def transport_options():
+    """Returns the messenger options for the test's broker. Messengers
+    in a test should share them.
+    """
+
+    if AMQP_HOST:
+        return dict()
+
+    return dict(transport=MemoryTransport())